@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import tempfile
+
+from . import checks
+from . import harness
+from . import networks
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks',
+                                     description='Benchmark the analysis phases on synthetic RLC networks.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run the benchmarks and write the results as JSON')
+    run_parser.add_argument('-n', '--networks', metavar='N', type=str, nargs='+', default=sorted(networks.NETWORKS),
+                            choices=sorted(networks.NETWORKS), help='networks to generate (default: all)')
+    run_parser.add_argument('-s', '--sizes', metavar='S', type=int, nargs='+', default=[1000, 10000],
+                            help='approximate number of nodes of each network (default: 1000 10000)')
+    run_parser.add_argument('-p', '--phases', metavar='P', type=str, nargs='+', default=list(harness.PHASES),
+                            choices=harness.PHASES, help='phases to measure (default: all)')
+    run_parser.add_argument('-r', '--reduce', metavar='R', type=int, default=20, help='order of the reduced models (default: 20)')
+    run_parser.add_argument('--dense', action='store_true', help='assemble dense instead of sparse circuit models')
+    run_parser.add_argument('--no-memory', action='store_true', help='do not trace memory (tracing slows down allocations)')
+    run_parser.add_argument('-j', '--processes', metavar='J', type=int, help='number of worker processes for frequency analysis (default: all cores)')
+    run_parser.add_argument('-o', '--output', metavar='FILE', type=str, default='benchmark.json', help='results file (default: benchmark.json)')
+
+    compare_parser = subparsers.add_parser('compare', help='compare two results files, fails on regressions')
+    compare_parser.add_argument('baseline', metavar='BASELINE', type=str, help='results file to compare against')
+    compare_parser.add_argument('current', metavar='CURRENT', type=str, help='new results file')
+    compare_parser.add_argument('-t', '--threshold', metavar='T', type=float, default=1.25, help='largest acceptable ratio current/baseline (default: 1.25)')
+
+    check_parser = subparsers.add_parser('check', help='check that analyses which should agree do, fails otherwise')
+    check_parser.add_argument('-c', '--checks', metavar='C', type=str, nargs='+', default=sorted(checks.CHECKS),
+                              choices=sorted(checks.CHECKS), help='checks to run (default: all)')
+    check_parser.add_argument('-n', '--networks', metavar='N', type=str, nargs='+', default=sorted(networks.NETWORKS),
+                              choices=sorted(networks.NETWORKS), help='networks to generate (default: all)')
+    check_parser.add_argument('-s', '--sizes', metavar='S', type=int, nargs='+', default=[60, 1000],
+                              help='approximate number of nodes of each network (default: 60 1000)')
+    check_parser.add_argument('--sparse', action='store_true', help='assemble sparse instead of dense circuit models')
+    check_parser.add_argument('-t', '--tolerance', metavar='T', type=float, default=checks.TOLERANCE, help='largest acceptable output difference in V (default: %g)' % checks.TOLERANCE)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        with tempfile.TemporaryDirectory() as directory:
+            results = harness.run(args.networks, args.sizes, directory, args.phases, args.reduce, not args.dense,
+                                  not args.no_memory, args.processes)
+        harness.save(results, args.output)
+        return 0
+
+    if args.command == 'check':
+        with tempfile.TemporaryDirectory() as directory:
+            rows = checks.run(args.checks, args.networks, args.sizes, directory, args.sparse, args.tolerance, log=None)
+        print(checks.format_rows(rows))
+        return 1 if any(row[-1] for row in rows) else 0
+
+    rows = harness.compare(harness.load(args.baseline), harness.load(args.current), args.threshold)
+    print(harness.format_comparison(rows))
+    return 1 if any(row[-1] for row in rows) else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
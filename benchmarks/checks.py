@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import contextlib
+import numpy as np
+
+from mna.circuit import Circuit
+from mna.netlist import edit_netlist, read_netlist
+from mna import cache
+from mna import prima
+from mna import transient
+from . import networks
+from .harness import TRANSIENT_WINDOW
+
+# the largest difference of the outputs (in V) accepted between two analyses that should agree
+TOLERANCE = 1e-9
+
+
+def output_difference(result_a, result_b):
+    # the largest difference between the outputs of two transient analyses on the same time points, NaN when either
+    # has NaN outputs
+    ((t_a, outputs_a), (t_b, outputs_b)) = (result_a, result_b)
+    if len(t_a) != len(t_b) or len(outputs_a) != len(outputs_b):
+        return np.inf
+    return np.max([np.max(np.abs(y_a - y_b)) for ((name_a, y_a), (name_b, y_b)) in zip(outputs_a, outputs_b)],
+                  initial=0.0)
+
+def check_cache(filename, input_sources, output_nodes, directory, sparse=False, order=20):
+    # the transients of the circuit and its PRIMA reduction are the same whether built from the netlist or loaded
+    # from the cache
+    model_cache = cache.ModelCache(os.path.join(directory, 'cache'))
+    (ti, tf, dt) = TRANSIENT_WINDOW
+    errors = []
+    for build in (lambda: model_cache.circuit(filename, input_sources, output_nodes, sparse),
+                  lambda: model_cache.reduced_circuit(filename, input_sources, output_nodes, 'prima', order,
+                                                      sparse=sparse)):
+        (built, loaded) = (build(), build())
+        errors.append(output_difference(transient.transient_analysis(built, ti, tf, dt),
+                                        transient.transient_analysis(loaded, ti, tf, dt)))
+    return np.max(errors)
+
+def network_edit(netlist, output_nodes):
+    # an ECO on a generated network: one resistor and one capacitor doubled, a load capacitor removed, a capacitor
+    # and an inductor (a new state) added at an output node, as the arguments of Circuit.edit
+    kinds = list(netlist.kinds)
+    (r, c) = (kinds.index('r'), kinds.index('c'))
+    load = [name for (name, kind) in zip(netlist.names, kinds) if kind == 'c' and name.endswith('_load')][0]
+    node = sorted(output_nodes)[0]
+    return ({ netlist.names[r] : 2*netlist.values[r], netlist.names[c] : 2*netlist.values[c] },
+            [('c_check', node, '0', 5e-15), ('l_check', node, '0', 1e-9)], [load])
+
+def check_edit(filename, input_sources, output_nodes, directory, sparse=False, order=20):
+    # the transients of a circuit edited in place (see Circuit.edit) with the factorizations of an earlier analysis,
+    # and of its PRIMA reduction updated after the edit, are those of the circuit rebuilt from the edited netlist and
+    # of its reduction
+    netlist = read_netlist(filename)
+    (set_values, add, remove) = network_edit(netlist, output_nodes)
+    (ti, tf, dt) = TRANSIENT_WINDOW
+    circuit = Circuit(netlist, input_sources, output_nodes, sparse=sparse)
+    (G, C, b) = circuit.mna_GCb_matrices
+    solvers = transient.TrapezoidalSolverCache(C, G)
+    transient.transient_analysis(circuit, ti, tf, dt, solvers=solvers)
+    reduced_circuit = prima.PrimaReducedCircuit(order, circuit)
+    circuit.edit(set_values, add, remove)
+    reduced_circuit.update(circuit)
+
+    rebuilt = Circuit(edit_netlist(netlist, set_values, add, remove), input_sources, output_nodes, sparse=sparse)
+    reduced_rebuilt = prima.PrimaReducedCircuit(order, rebuilt)
+    return np.max((output_difference(transient.transient_analysis(circuit, ti, tf, dt, solvers=solvers),
+                                     transient.transient_analysis(rebuilt, ti, tf, dt)),
+                   output_difference(transient.transient_analysis(reduced_circuit, ti, tf, dt),
+                                     transient.transient_analysis(reduced_rebuilt, ti, tf, dt))))
+
+CHECKS = { 'cache' : check_cache, 'edit' : check_edit }
+
+def run_check(check, network, size, directory, sparse=False):
+    # generates one network of about size nodes in directory, returns the error of the check on it
+    filename = os.path.join(directory, '%s_%d.sp' % (network, size))
+    (input_sources, output_nodes, num_elements) = networks.generate(network, size, filename)
+    with contextlib.redirect_stdout(io.StringIO()):
+        error = CHECKS[check](filename, input_sources, output_nodes, directory, sparse)
+    os.remove(filename)
+    return error
+
+def run(check_names, network_names, sizes, directory, sparse=False, tolerance=TOLERANCE, log=sys.stderr):
+    # returns one row per check, network and size: (check, network, size, error, failed)
+    rows = []
+    for check in check_names:
+        for network in network_names:
+            for size in sizes:
+                error = run_check(check, network, size, directory, sparse)
+                rows.append((check, network, size, error, not error <= tolerance))
+                if log is not None:
+                    print(format_rows(rows[-1:], header=False), file=log)
+    return rows
+
+def format_rows(rows, header=True):
+    lines = ['%-10s %-10s %8s %12s' % ('check', 'network', 'size', 'error')] if header else []
+    for (check, network, size, error, failed) in rows:
+        lines.append('%-10s %-10s %8d %12.6g%s' % (check, network, size, error, '  FAILED' if failed else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import gc
+import sys
+import json
+import time
+import platform
+import contextlib
+import tracemalloc
+import numpy as np
+import scipy
+
+from mna.circuit import Circuit
+from mna import prima
+from mna import transient
+from mna import frequency
+from . import networks
+
+RESULTS_FORMAT_VERSION = 1
+
+PHASES = ('circuit', 'reduce', 'transient', 'transient_reduced', 'frequency', 'frequency_reduced')
+
+# the analyses of main.py
+TRANSIENT_WINDOW = (0, 7e-9, 0.02e-9)   # ti, tf, dt
+FREQUENCY_BAND = (6, 11)                # log10 rad/s
+
+
+def measure(timings, phase, memory, function, *args, **kwargs):
+    # runs function once with its output suppressed, records the wall time and (with memory) the peak of the memory
+    # allocated through Python and numpy meanwhile, returns the function's result
+    gc.collect()
+    if memory:
+        tracemalloc.start()
+    tic = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    toc = time.perf_counter()
+    timings[phase] = { 'seconds' : toc - tic }
+    if memory:
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        timings[phase]['peak_bytes'] = peak
+    return result
+
+def run_benchmark(network, size, directory, phases=PHASES, order=20, sparse=True, memory=True, processes=None):
+    # generates one network of about size nodes in directory and measures the requested phases on it
+    filename = os.path.join(directory, '%s_%d.sp' % (network, size))
+    tic = time.perf_counter()
+    (input_sources, output_nodes, num_elements) = networks.generate(network, size, filename)
+    toc = time.perf_counter()
+    result = { 'network' : network, 'size' : size, 'num_elements' : num_elements, 'generate_seconds' : toc - tic,
+               'phases' : {} }
+    timings = result['phases']
+
+    circuit = measure(timings, 'circuit', memory, Circuit, filename, input_sources, output_nodes, sparse=sparse)
+    result['num_states'] = circuit.mna_GCb_matrices[0].shape[0]
+    reduced_circuit = None
+    if any(phase in phases for phase in ('reduce', 'transient_reduced', 'frequency_reduced')):
+        reduced_circuit = measure(timings, 'reduce', memory, prima.PrimaReducedCircuit, order, circuit)
+    (ti, tf, dt) = TRANSIENT_WINDOW
+    (w_lo, w_hi) = FREQUENCY_BAND
+    if 'transient' in phases:
+        measure(timings, 'transient', memory, transient.transient_analysis, circuit, ti, tf, dt)
+    if 'transient_reduced' in phases:
+        measure(timings, 'transient_reduced', memory, transient.transient_analysis, reduced_circuit, ti, tf, dt)
+    if 'frequency' in phases:
+        measure(timings, 'frequency', memory, frequency.frequency_analysis, circuit, w_lo, w_hi, processes)
+    if 'frequency_reduced' in phases:
+        measure(timings, 'frequency_reduced', memory, frequency.frequency_analysis, reduced_circuit, w_lo, w_hi,
+                processes)
+
+    os.remove(filename)
+    return result
+
+def environment():
+    return { 'python' : platform.python_version(), 'numpy' : np.__version__, 'scipy' : scipy.__version__,
+             'machine' : platform.machine(), 'processor' : platform.processor(), 'cpu_count' : os.cpu_count(),
+             'platform' : platform.platform() }
+
+def run(network_names, sizes, directory, phases=PHASES, order=20, sparse=True, memory=True, processes=None,
+        log=sys.stderr):
+    results = []
+    for network in network_names:
+        for size in sizes:
+            result = run_benchmark(network, size, directory, phases, order, sparse, memory, processes)
+            results.append(result)
+            if log is not None:
+                print(format_result(result), file=log)
+    return { 'version' : RESULTS_FORMAT_VERSION, 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'environment' : environment(), 'order' : order, 'sparse' : sparse, 'results' : results }
+
+def format_result(result):
+    parts = ['%s %d (%d states):' % (result['network'], result['size'], result['num_states'])]
+    for (phase, timing) in result['phases'].items():
+        if 'peak_bytes' in timing:
+            parts.append('%s %.4fs %.1fMB' % (phase, timing['seconds'], timing['peak_bytes'] / 2**20))
+        else:
+            parts.append('%s %.4fs' % (phase, timing['seconds']))
+    return ' '.join(parts)
+
+def save(results, filename):
+    with open(filename, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+def load(filename):
+    with open(filename, 'r') as input_file:
+        return json.load(input_file)
+
+def compare(baseline, current, threshold=1.25, min_seconds=0.01, min_bytes=1 << 20):
+    # matches the results of the same network and size, returns one row per phase measured in both:
+    # (network, size, phase, metric, baseline value, current value, ratio, regression)
+    # phases faster than min_seconds (or using less than min_bytes) are too noisy to count as a regression
+    baseline_results = { (r['network'], r['size']) : r for r in baseline['results'] }
+    rows = []
+    for result in current['results']:
+        key = (result['network'], result['size'])
+        if key not in baseline_results:
+            continue
+        baseline_phases = baseline_results[key]['phases']
+        for (phase, timing) in result['phases'].items():
+            if phase not in baseline_phases:
+                continue
+            for (metric, floor) in (('seconds', min_seconds), ('peak_bytes', min_bytes)):
+                if metric not in timing or metric not in baseline_phases[phase]:
+                    continue
+                (old, new) = (baseline_phases[phase][metric], timing[metric])
+                ratio = new / old if old > 0 else np.inf
+                regression = ratio > threshold and new > floor
+                rows.append(key + (phase, metric, old, new, ratio, regression))
+    return rows
+
+def format_comparison(rows):
+    lines = ['%-10s %8s %-18s %-10s %12s %12s %8s' % ('network', 'size', 'phase', 'metric', 'baseline', 'current',
+                                                      'ratio')]
+    for (network, size, phase, metric, old, new, ratio, regression) in rows:
+        lines.append('%-10s %8d %-18s %-10s %12.6g %12.6g %8.2f%s' % (network, size, phase, metric, old, new, ratio,
+                                                                      '  REGRESSION' if regression else ''))
+    return '\n'.join(lines)
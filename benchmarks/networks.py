@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import math
+
+# per segment values of the interconnect, as in reference/clock_tree.sp
+SEGMENT_R = 0.125
+SEGMENT_L = 25e-12
+SEGMENT_C = 10e-15
+LOAD_R = 5e3
+LOAD_C = 5e-15
+
+
+class NetlistBuilder:
+    # collects the elements of a synthetic network, one SPICE line each
+    def __init__(self, title):
+        self.lines = ['* %s' % title]
+
+    def element(self, name, node1, node2, value):
+        self.lines.append('%s %s %s %e' % (name, node1, node2, value))
+
+    def segment(self, name, node1, node2, inductance=True):
+        # one wire segment from node1 to node2: series R (and L), C to ground at node2
+        if inductance:
+            self.element('r_%s' % name, node1, '%s_res' % node2, SEGMENT_R)
+            self.element('l_%s' % name, '%s_res' % node2, node2, SEGMENT_L)
+        else:
+            self.element('r_%s' % name, node1, node2, SEGMENT_R)
+        self.element('c_%s' % name, node2, 0, SEGMENT_C)
+
+    def load(self, name, node):
+        self.element('r_%s_load' % name, node, 0, LOAD_R)
+        self.element('c_%s_load' % name, node, 0, LOAD_C)
+
+    def source(self, name, node):
+        self.element(name, node, 0, 1)
+
+    @property
+    def num_elements(self):
+        return len(self.lines) - 1
+
+    def write(self, filename):
+        with open(filename, 'w') as output_file:
+            output_file.write('\n'.join(self.lines))
+            output_file.write('\n')
+
+
+def tree(size, branching=2, inductance=True):
+    # a balanced tree of single segments with about size nodes, loads at the leaves
+    nodes_per_segment = 2 if inductance else 1
+    num_segments = max(size // nodes_per_segment, 1)
+    builder = NetlistBuilder('%s tree, %d segments' % ('RLC' if inductance else 'RC', num_segments))
+    builder.source('v_src', 'n0')
+    for i in range(1, num_segments+1):
+        builder.segment('seg%d' % i, 'n%d' % ((i - 1) // branching), 'n%d' % i, inductance)
+    first_leaf = num_segments // branching + 1
+    for i in range(first_leaf, num_segments+1):
+        builder.load('n%d' % i, 'n%d' % i)
+    return (builder, 'v_src', ['n%d' % first_leaf, 'n%d' % num_segments])
+
+def rc_tree(size):
+    return tree(size, inductance=False)
+
+def rlc_tree(size):
+    return tree(size, inductance=True)
+
+def mesh(size):
+    # a square RC grid (power grid like), driven at one corner
+    side = max(math.isqrt(size), 2)
+    builder = NetlistBuilder('RC mesh, %d x %d nodes' % (side, side))
+    builder.source('v_src', 'n0_0')
+    for i in range(side):
+        for j in range(side):
+            builder.element('c_%d_%d' % (i, j), 'n%d_%d' % (i, j), 0, SEGMENT_C)
+            if j + 1 < side:
+                builder.element('r_h%d_%d' % (i, j), 'n%d_%d' % (i, j), 'n%d_%d' % (i, j+1), SEGMENT_R)
+            if i + 1 < side:
+                builder.element('r_v%d_%d' % (i, j), 'n%d_%d' % (i, j), 'n%d_%d' % (i+1, j), SEGMENT_R)
+    builder.load('far', 'n%d_%d' % (side-1, side-1))
+    return (builder, 'v_src', ['n%d_%d' % (side // 2, side // 2), 'n%d_%d' % (side-1, side-1)])
+
+def ladder(size, inductance=True):
+    # a chain of segments (a long transmission line)
+    num_segments = max(size // 2, 1)
+    builder = NetlistBuilder('RLC ladder, %d segments' % num_segments)
+    builder.source('v_src', 'n0')
+    for i in range(1, num_segments+1):
+        builder.segment('seg%d' % i, 'n%d' % (i-1), 'n%d' % i, inductance)
+    builder.load('end', 'n%d' % num_segments)
+    return (builder, 'v_src', ['n%d' % (num_segments // 2), 'n%d' % num_segments])
+
+def h_tree(size, levels=None):
+    # an H-tree clock network: every level splits each branch in two, the wire length halves every second level;
+    # the number of segments of the first level is chosen so that the network has about size nodes
+    if levels is None:
+        levels = max(int(round(math.log2(max(size, 4)) / 2)), 1)
+    shape = [2**(k+1) / 2**(k // 2) for k in range(levels)]  # branches times relative length per level
+    first_segments = max(size / (2 * sum(shape)), 1)
+    builder = NetlistBuilder('H-tree, %d levels' % levels)
+    builder.source('v_clk_src', 'pt0')
+    leaves = ['pt0']
+    for k in range(levels):
+        segments = max(int(round(first_segments / 2**(k // 2))), 1)
+        branches = []
+        for (p, parent) in enumerate(leaves):
+            for side in range(2):
+                branch = 'lev%d_%d' % (k+1, 2*p + side)
+                node = parent
+                for s in range(1, segments+1):
+                    next_node = 'pt_%s' % branch if s == segments else '%s_seg%d' % (branch, s)
+                    builder.segment('%s_seg%d' % (branch, s), node, next_node)
+                    node = next_node
+                branches.append(node)
+        leaves = branches
+    for leaf in leaves:
+        builder.load(leaf, leaf)
+    return (builder, 'v_clk_src', [leaves[0], leaves[-1]])
+
+NETWORKS = { 'rc_tree' : rc_tree, 'rlc_tree' : rlc_tree, 'mesh' : mesh, 'ladder' : ladder, 'h_tree' : h_tree }
+
+def generate(network, size, filename):
+    # writes a network of about size nodes to filename, returns (input_sources, output_nodes, num_elements)
+    (builder, input_source, output_nodes) = NETWORKS[network](size)
+    builder.write(filename)
+    return ({input_source}, set(output_nodes), builder.num_elements)
@@ -1,83 +1,136 @@
 #!/usr/bin/env python3
 
 import sys
-import time
+import logging
 import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 
 from mna.circuit import Circuit
 from mna import prima
+from mna import cache
 from mna import transient
 from mna import frequency
+from mna import profiling
+from mna import export
+from mna import linalg
 
+PLOT_DPI = 200
 
-def analyze_transient(circuit, reduced_circuit=None):
+
+def pyplot():
+    # matplotlib is only loaded when plotting, with a backend that renders to files (no display needed)
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def export_outputs(basename, axis_name, axis, outputs, export_formats):
+    for export_format in export_formats:
+        with profiling.span('export', format=export_format):
+            export.write_outputs('%s.%s' % (basename, export_format), axis_name, axis, outputs, export_format)
+
+def analyze_transient(circuit, reduced_circuit=None, adaptive=False, plot=True, export_formats=(), dpi=PLOT_DPI,
+                      backend=None, periodic=False):
     print('[starting transient analysis]')
 
     # transient simulation parameters
     ti = 0      # 0 ns
     tf = 7e-9   # 7 ns
-
-    plt.figure(dpi=1200)
-
-    (full_t, full_outputs) = transient.transient_analysis(circuit, ti, tf)
+    dt = 0.02e-9 if not adaptive else (tf - ti) / 50    # fixed timestep, or largest adaptive timestep
+    # periodic: one period of the settled response instead (fixed timestep)
+    name = 'periodic_steady_state' if periodic else 'transient_analysis'
+
+    def simulate(model):
+        if periodic:
+            return transient.periodic_steady_state(model, dt=0.02e-9, backend=backend)
+        return transient.transient_analysis(model, ti, tf, dt, adaptive=adaptive, backend=backend)
+
+    with profiling.span('full'):
+        (full_t, full_outputs) = simulate(circuit)
+    export_outputs(name + '_full', 't', full_t, full_outputs, export_formats)
     if reduced_circuit is not None:
-        (reduced_t, reduced_outputs) = transient.transient_analysis(reduced_circuit, ti, tf)
-        for (node_name, output) in reduced_outputs:
-            plt.plot(reduced_t, output, label="reduced circuit node %s" % node_name, linewidth=0.5)
-    for (node_name, output) in full_outputs:
-        plt.plot(full_t, output, label="full circuit node %s" % node_name, linewidth=0.3)
-
-    plt.title('Voltage vs Time')
-    plt.xlabel('time (s)')
-    plt.xlim(ti, tf)
-    plt.ylabel('voltage (V)')
-    plt.legend(loc='lower left')
-    plt.tight_layout()
-    plt.savefig("transient_analysis.png")
-    plt.close()
+        with profiling.span('reduced'):
+            (reduced_t, reduced_outputs) = simulate(reduced_circuit)
+        export_outputs(name + '_reduced', 't', reduced_t, reduced_outputs, export_formats)
+    if periodic:
+        (ti, tf) = (full_t[0], full_t[-1])
+
+    if plot:
+        with profiling.span('plot'):
+            plt = pyplot()
+            fig = plt.figure(dpi=dpi)
+            # about two points per pixel column are enough, with the extremes of each column kept
+            num_buckets = int(fig.get_figwidth() * dpi)
+            if reduced_circuit is not None:
+                for (node_name, output) in reduced_outputs:
+                    plt.plot(*export.decimate_minmax(reduced_t, output, num_buckets),
+                             label="reduced circuit node %s" % node_name, linewidth=0.5)
+            for (node_name, output) in full_outputs:
+                plt.plot(*export.decimate_minmax(full_t, output, num_buckets),
+                         label="full circuit node %s" % node_name, linewidth=0.3)
+
+            plt.title('Voltage vs Time')
+            plt.xlabel('time (s)')
+            plt.xlim(ti, tf)
+            plt.ylabel('voltage (V)')
+            plt.legend(loc='lower left')
+            plt.tight_layout()
+            plt.savefig(name + ".png")
+            plt.close()
     print('[finished transient analysis]')
 
-def analyze_frequency(circuit, reduced_circuit=None):
+def analyze_frequency(circuit, reduced_circuit=None, processes=None, plot=True, export_formats=(), dpi=PLOT_DPI,
+                      frequency_tol=None, backend=None, band=(-1, 19)):
     print('[starting frequency analysis]')
     # frequency analysis parameters
-    w_lo = -1
-    w_hi = 19
-
-    fig = plt.figure(dpi=1200)
-    ax0 = fig.add_subplot(2, 1, 1)
-    ax1 = fig.add_subplot(2, 1, 2)
-
-    (full_w, full_outputs) = frequency.frequency_analysis(circuit, w_lo, w_hi)
-    line_handles = []
+    (w_lo, w_hi) = band
+    adaptive = frequency_tol is not None
+    rtol = frequency_tol if adaptive else 1e-2
+
+    with profiling.span('full'):
+        (full_w, full_outputs) = frequency.frequency_analysis(circuit, w_lo, w_hi, processes, adaptive, rtol,
+                                                              backend=backend)
+    export_outputs('frequency_analysis_full', 'w', full_w, full_outputs, export_formats)
     if reduced_circuit is not None:
-        (reduced_w, reduced_outputs) = frequency.frequency_analysis(reduced_circuit, w_lo, w_hi)
-        for (node_name, output) in reduced_outputs:
-            line = ax0.plot(reduced_w, np.real(output), label="reduced circuit node %s" % node_name, linewidth=0.5)
-            ax1.plot(reduced_w, np.imag(output), label="reduced circuit node %s" % node_name, linewidth=0.5)
-            line_handles.append(line[0])
-    for (node_name, output) in full_outputs:
-        line = ax0.plot(full_w, np.real(output), label="full circuit node %s" % node_name, linewidth=0.3)
-        ax1.plot(full_w, np.imag(output), label="full circuit node %s" % node_name, linewidth=0.3)
-        line_handles.append(line[0])
-
-    fig.suptitle('Frequency Response vs Frequency')
-
-    ax0.set_xlabel('s (rad/s)')
-    ax0.set_xlim(10**w_lo, 10**w_hi)
-    ax0.set_xscale('log')
-    ax0.set_ylabel('Re(H(s))')
-
-    ax1.set_xlabel('s (rad/s)')
-    ax1.set_xlim(10**w_lo, 10**w_hi)
-    ax1.set_xscale('log')
-    ax1.set_ylabel('Im(H(s))')
-
-    fig.legend(handles=line_handles, loc='upper right', fontsize='x-small', borderpad=0.2)
-    plt.tight_layout()
-    fig.savefig("frequency_analysis.png")
-    plt.close()
+        with profiling.span('reduced'):
+            (reduced_w, reduced_outputs) = frequency.frequency_analysis(reduced_circuit, w_lo, w_hi, processes, adaptive,
+                                                                        rtol, backend=backend)
+        export_outputs('frequency_analysis_reduced', 'w', reduced_w, reduced_outputs, export_formats)
+
+    if plot:
+        with profiling.span('plot'):
+            plt = pyplot()
+            fig = plt.figure(dpi=dpi)
+            ax0 = fig.add_subplot(2, 1, 1)
+            ax1 = fig.add_subplot(2, 1, 2)
+
+            line_handles = []
+            if reduced_circuit is not None:
+                for (node_name, output) in reduced_outputs:
+                    line = ax0.plot(reduced_w, np.real(output), label="reduced circuit node %s" % node_name, linewidth=0.5)
+                    ax1.plot(reduced_w, np.imag(output), label="reduced circuit node %s" % node_name, linewidth=0.5)
+                    line_handles.append(line[0])
+            for (node_name, output) in full_outputs:
+                line = ax0.plot(full_w, np.real(output), label="full circuit node %s" % node_name, linewidth=0.3)
+                ax1.plot(full_w, np.imag(output), label="full circuit node %s" % node_name, linewidth=0.3)
+                line_handles.append(line[0])
+
+            fig.suptitle('Frequency Response vs Frequency')
+
+            ax0.set_xlabel('s (rad/s)')
+            ax0.set_xlim(10**w_lo, 10**w_hi)
+            ax0.set_xscale('log')
+            ax0.set_ylabel('Re(H(s))')
+
+            ax1.set_xlabel('s (rad/s)')
+            ax1.set_xlim(10**w_lo, 10**w_hi)
+            ax1.set_xscale('log')
+            ax1.set_ylabel('Im(H(s))')
+
+            fig.legend(handles=line_handles, loc='upper right', fontsize='x-small', borderpad=0.2)
+            plt.tight_layout()
+            fig.savefig("frequency_analysis.png")
+            plt.close()
     print('[finished frequency analysis]')
 
 def main(argv):
@@ -86,26 +139,100 @@ def main(argv):
     parser.add_argument('-i', '--input_sources', metavar='I', type=str, required=True, nargs='+', help='component name(s) of circuit inputs')
     parser.add_argument('-o', '--output_nodes', metavar='O', type=str, required=True, nargs='+', help='node name(s) of circuit to observe')
     parser.add_argument('-r', '--reduce', metavar='R', type=int, nargs=1, help='experiment with model order reduction using given order')
+    parser.add_argument('-t', '--reduce-tol', metavar='T', type=float, help='experiment with multi-point model order reduction, increasing the order until the relative error of H(s) is within T')
+    parser.add_argument('--reduce-band', metavar=('W_LO', 'W_HI'), type=float, nargs=2, default=[6, 11], help='frequency band (log10 rad/s) used by --reduce-tol (default: 6 11)')
+    parser.add_argument('-k', '--partitions', metavar='K', type=int, help='with --reduce R, split the circuit into K partitions coupled through boundary nodes and reduce each to order R in parallel')
+    parser.add_argument('-j', '--processes', metavar='J', type=int, help='number of worker processes for frequency analysis (default: all cores)')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='choose transient timesteps by local truncation error')
+    parser.add_argument('--periodic', action='store_true', help='simulate one period of the settled response to periodic inputs (periodic steady state by shooting) instead of the transient')
+    parser.add_argument('--frequency-band', metavar=('W_LO', 'W_HI'), type=float, nargs=2, default=[-1, 19], help='frequency band (log10 rad/s) of the frequency analysis (default: -1 19)')
+    parser.add_argument('-f', '--frequency-tol', metavar='F', type=float, help='sample the frequency response adaptively, refining where it deviates from linear interpolation by more than F (relative)')
+    parser.add_argument('-s', '--sparse', action='store_true', help='assemble the circuit model as sparse matrices')
+    parser.add_argument('-p', '--reduce-topology', metavar='TAU', type=float, nargs='?', const=0.0, help='shrink the netlist before stamping: merge series/parallel elements, prune dangling parts and eliminate internal RC nodes exactly, or approximately when their time constant is below TAU seconds (default: 0)')
+    parser.add_argument('-m', '--subckt-order', metavar='Q', type=int, help='reduce every .subckt definition once to a macromodel of order Q (its pins kept as ports) and stamp it for each instance (default: exact)')
+    parser.add_argument('--solver', metavar='S', type=str, choices=['trial'] + list(linalg.BACKENDS), help='solver backend of transient and frequency analysis: trial (time trial factorizations and keep the fastest) or one of %s (default: chosen per model by size, sparsity and symmetry; reported with --verbose)' % ', '.join(linalg.BACKENDS))
+    parser.add_argument('--cache', metavar='DIR', type=str, help='reuse circuit models and reduced models cached in DIR')
+    parser.add_argument('-e', '--export', metavar='F', type=str, nargs='+', default=[], choices=sorted(export.WRITERS), help='save the waveforms and frequency responses as F (npz, csv and/or raw) next to the plots')
+    parser.add_argument('--no-plot', action='store_true', help='do not render plots (e.g. headless batch runs with --export)')
+    parser.add_argument('--dpi', metavar='D', type=int, default=PLOT_DPI, help='resolution of the plots (default: %d)' % PLOT_DPI)
+    parser.add_argument('-v', '--verbose', action='store_true', help='report the sources, observed nodes and model matrices')
+    parser.add_argument('--profile', metavar='FILE', type=str, nargs='?', const='', help='print the time and memory of each phase, and write them to FILE if given')
+    parser.add_argument('--profile-format', metavar='F', type=str, choices=('json', 'chrome'), default='json', help='format of the profile FILE: json (per phase totals) or chrome (trace events for chrome://tracing or Perfetto) (default: json)')
+    parser.add_argument('--profile-memory', action='store_true', help='also trace the peak memory allocated by each phase (slower)')
     args = parser.parse_args(argv)
 
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+
+    if args.profile is None:
+        run(args)
+        return
+
+    with profiling.Profiler(trace_memory=args.profile_memory) as profiler:
+        run(args)
+    print(profiler.report(), file=sys.stderr)
+    if args.profile != '':
+        if args.profile_format == 'chrome':
+            profiler.write_chrome_trace(args.profile)
+        else:
+            profiler.write_json(args.profile)
+
+def run(args):
     input_sources = set(args.input_sources)
     watch_nodes = set(args.output_nodes)
 
-    circuit = Circuit(args.network, input_sources, watch_nodes)
-    print("circuit model size:")
-    circuit.print_GCb_matrices()
+    model_cache = cache.ModelCache(args.cache) if args.cache is not None else None
+    with profiling.span('circuit'):
+        if model_cache is not None:
+            circuit = model_cache.circuit(args.network, input_sources, watch_nodes, sparse=args.sparse,
+                                          reduce_topology=args.reduce_topology, subckt_order=args.subckt_order)
+        else:
+            circuit = Circuit(args.network, input_sources, watch_nodes, sparse=args.sparse,
+                              reduce_topology=args.reduce_topology, subckt_order=args.subckt_order)
+    if args.verbose:
+        print("circuit model size:")
+        circuit.print_GCb_matrices()
 
     reduced_circuit = None
-    if args.reduce is not None:
-        tic = time.perf_counter()
-        reduced_circuit = prima.PrimaReducedCircuit(args.reduce[0], circuit)
-        toc = time.perf_counter()
-        print("reducing the circuit model took %.6f seconds" % (toc - tic))
+    if args.reduce_tol is not None:
+        (w_lo, w_hi) = args.reduce_band
+        max_order = args.reduce[0] if args.reduce is not None else 200
+        with profiling.span('reduce'):
+            if model_cache is not None:
+                reduced_circuit = model_cache.reduced_circuit(args.network, input_sources, watch_nodes, 'multipoint',
+                                                              w_lo, w_hi, args.reduce_tol, max_order,
+                                                              sparse=args.sparse, full_circuit=circuit,
+                                                              reduce_topology=args.reduce_topology,
+                                                              subckt_order=args.subckt_order)
+            else:
+                reduced_circuit = prima.MultiPointPrimaReducedCircuit(circuit, w_lo, w_hi, args.reduce_tol, max_order,
+                                                                      processes=args.processes)
+        print("reduced the circuit model to order %d (estimated error %g)"
+              % (reduced_circuit.Gq.shape[0], reduced_circuit.error_estimate))
+    elif args.reduce is not None:
+        with profiling.span('reduce'):
+            if args.partitions is not None:
+                reduced_circuit = prima.PartitionedPrimaReducedCircuit(circuit, args.reduce[0], args.partitions,
+                                                                       args.processes)
+            elif model_cache is not None:
+                reduced_circuit = model_cache.reduced_circuit(args.network, input_sources, watch_nodes, 'prima',
+                                                              args.reduce[0], sparse=args.sparse, full_circuit=circuit,
+                                                              reduce_topology=args.reduce_topology,
+                                                              subckt_order=args.subckt_order)
+            else:
+                reduced_circuit = prima.PrimaReducedCircuit(args.reduce[0], circuit)
+        if args.partitions is not None:
+            print("reduced the circuit model to order %d (%d boundary states)"
+                  % (reduced_circuit.G.shape[0], np.count_nonzero(reduced_circuit.partition_labels < 0)))
+    if reduced_circuit is not None and args.verbose:
         print("reduced circuit model size:")
         reduced_circuit.print_GCb_matrices()
 
-    analyze_transient(circuit, reduced_circuit)
-    analyze_frequency(circuit, reduced_circuit)
+    with profiling.span('transient'):
+        analyze_transient(circuit, reduced_circuit, args.adaptive, not args.no_plot, args.export, args.dpi, args.solver,
+                          args.periodic)
+    with profiling.span('frequency'):
+        analyze_frequency(circuit, reduced_circuit, args.processes, not args.no_plot, args.export, args.dpi,
+                          args.frequency_tol, args.solver, args.frequency_band)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import re
+import zipfile
+import numpy as np
+import scipy.sparse
+
+from .circuit import Circuit
+from .circuit_model import StateSpaceModel
+from . import prima
+from . import stimulus
+
+CACHE_FORMAT_VERSION = 3
+
+# the data files read by the netlist's sources, PWL(FILE=name) (see stimulus.parse_stimulus)
+_DATA_FILE_PATTERN = re.compile(rb'pwl\s*\(\s*file\s*=\s*["\']?([^"\'\s)]+)', re.IGNORECASE)
+
+
+def netlist_digest(filename, block_size=1 << 20):
+    # sha256 of the netlist followed by the contents of the data files it reads, in their order in the netlist
+    # (relative to its directory); the parser ignores .include, so the netlist file holds every .subckt definition
+    digest = hashlib.sha256()
+    data_files = []
+    with open(filename, 'rb') as netlist_file:
+        tail = b''  # the last, partial line of the previous block
+        for block in iter(lambda: netlist_file.read(block_size), b''):
+            digest.update(block)
+            lines = tail + block
+            end = lines.rfind(b'\n') + 1
+            data_files += _DATA_FILE_PATTERN.findall(lines, 0, end)
+            tail = lines[end:]
+        data_files += _DATA_FILE_PATTERN.findall(tail)
+    for data_file in data_files:
+        digest.update(b'\0' + data_file + b'\0')
+        try:
+            with open(os.path.join(os.fsencode(os.path.dirname(filename)), data_file), 'rb') as input_file:
+                for block in iter(lambda: input_file.read(block_size), b''):
+                    digest.update(block)
+        except OSError:
+            pass    # the netlist fails to parse without it, nothing is cached
+    return digest.hexdigest()
+
+def _put_matrix(arrays, name, M):
+    if scipy.sparse.issparse(M):
+        M = M.tocsc()
+        arrays[name + '.data'] = M.data
+        arrays[name + '.indices'] = M.indices
+        arrays[name + '.indptr'] = M.indptr
+        arrays[name + '.shape'] = np.array(M.shape)
+    else:
+        arrays[name] = np.asarray(M)
+
+def _get_matrix(arrays, name):
+    if name + '.data' in arrays:
+        return scipy.sparse.csc_matrix((arrays[name + '.data'], arrays[name + '.indices'], arrays[name + '.indptr']),
+                                       shape=tuple(arrays[name + '.shape']))
+    M = arrays[name]
+    M.setflags(write=False)
+    return M
+
+def _model_arrays(model):
+    (G, C, b) = model.mna_GCb_matrices
+    L_list = model.output_L_vectors
+    n = b.shape[0]
+    arrays = {}
+    _put_matrix(arrays, 'G', G)
+    _put_matrix(arrays, 'C', C)
+    arrays['b'] = b
+    arrays['B'] = model.input_B_vector
+    arrays['B_matrix'] = model.input_B_matrix
+    arrays['b_matrix'] = model.internal_b_matrix
+    arrays['L'] = np.hstack(L_list) if len(L_list) > 0 else np.zeros((n, 0))
+    # output names are stored in the order of the output vectors
+    arrays['output_nodes'] = np.array([node_name for (node_name, L) in zip(model.output_node_names, L_list)], dtype=str)
+    arrays['internal_sources'] = np.array(list(model.internal_source_names), dtype=str)
+    # stimuli are stored as their netlist text ('' for none) and parsed again on load
+    arrays['input_stimuli'] = np.array([u.spec if u is not None else '' for u in model.input_stimuli], dtype=str)
+    arrays['is_reduced'] = np.array(model.is_reduced)
+    return arrays
+
+def _stimuli_from_arrays(arrays):
+    return [stimulus.parse_stimulus(spec) if spec != '' else None for spec in arrays['input_stimuli'].tolist()]
+
+def _model_from_arrays(arrays):
+    L = _get_matrix(arrays, 'L')
+    return StateSpaceModel(_get_matrix(arrays, 'G'), _get_matrix(arrays, 'C'), _get_matrix(arrays, 'b'),
+                           _get_matrix(arrays, 'B'), _get_matrix(arrays, 'B_matrix'), _get_matrix(arrays, 'b_matrix'),
+                           [L[:, i:i+1] for i in range(L.shape[1])],
+                           arrays['internal_sources'].tolist(), arrays['output_nodes'].tolist(),
+                           _stimuli_from_arrays(arrays), bool(arrays['is_reduced']))
+
+def _topology_key(reduce_topology, subckt_order=None):
+    # models of netlists reduced by topology.reduce_netlist or with reduced subcircuit macromodels are cached apart
+    # (keys without them are unchanged)
+    key = () if reduce_topology is None else (('topology', float(reduce_topology)),)
+    return key if subckt_order is None else key + (('subckt', int(subckt_order)),)
+
+
+class ModelCache:
+    # Content-addressed on-disk cache of assembled circuit models, PRIMA reduced models and subcircuit macromodels.
+    # Entries are uncompressed .npz files named by the sha256 of (netlist contents, input sources, output nodes,
+    # reduction method and order), or of (definition contents, order) for macromodels; the least recently used
+    # entries are evicted once the cache grows beyond max_bytes. A model loaded from the cache is a StateSpaceModel,
+    # it has the matrices of the circuit but not its netlist, so it cannot be edited (see Circuit.edit); it keeps
+    # is_reduced, so it is integrated as the model it was built from.
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, *parts):
+        digest = hashlib.sha256()
+        digest.update(repr((CACHE_FORMAT_VERSION,) + parts).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+            return None     # missing, truncated or corrupt entries are misses
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def store(self, key, arrays):
+        path = self._path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_path, path)  # atomic, concurrent readers never see a partial entry
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def circuit(self, filename, input_sources, output_nodes, sparse=False, reduce_topology=None, subckt_order=None):
+        # the subcircuit macromodels are cached as well, and reused by every netlist with the same definitions
+        key = self.key('circuit', netlist_digest(filename), sorted(input_sources), sorted(output_nodes), sparse,
+                       *_topology_key(reduce_topology, subckt_order))
+        arrays = self.load(key)
+        if arrays is not None:
+            try:
+                return _model_from_arrays(arrays)
+            except KeyError:
+                pass    # an entry without all the arrays of a model is a miss
+        circuit = Circuit(filename, input_sources, output_nodes, sparse=sparse, reduce_topology=reduce_topology,
+                          subckt_order=subckt_order, model_cache=self)
+        self.store(key, _model_arrays(circuit))
+        return circuit
+
+    def reduced_circuit(self, filename, input_sources, output_nodes, method, *params, sparse=False, full_circuit=None,
+                        reduce_topology=None, subckt_order=None):
+        # method is 'prima' (params: q) or 'multipoint' (params: w_lo, w_hi, tol, max_order),
+        # full_circuit is only built (or loaded) when the reduced model is not cached yet
+        key = self.key('reduced', netlist_digest(filename), sorted(input_sources), sorted(output_nodes), method, params,
+                       *_topology_key(reduce_topology, subckt_order))
+        arrays = self.load(key)
+        if arrays is not None and 'Vq' in arrays:
+            try:
+                model = _model_from_arrays(arrays)
+            except KeyError:
+                model = None    # an entry without all the arrays of a model is a miss
+            if model is not None:
+                reduced_circuit = prima.PrimaReducedCircuit.from_projection(
+                    arrays['Vq'], model.G, model.C, model.b, model.B, model.B_matrix, model.b_matrix, model.L_list,
+                    model.internal_sources, model.output_nodes, model.input_stimuli)
+                if 'error_estimate' in arrays:
+                    reduced_circuit.error_estimate = float(arrays['error_estimate'])
+                return reduced_circuit
+
+        if full_circuit is None:
+            full_circuit = self.circuit(filename, input_sources, output_nodes, sparse, reduce_topology, subckt_order)
+        if method == 'prima':
+            reduced_circuit = prima.PrimaReducedCircuit(*params, full_circuit)
+        elif method == 'multipoint':
+            reduced_circuit = prima.MultiPointPrimaReducedCircuit(full_circuit, *params)
+        else:
+            raise ValueError('unknown reduction method %s' % method)
+
+        arrays = _model_arrays(reduced_circuit)
+        arrays['Vq'] = reduced_circuit.Vq
+        if hasattr(reduced_circuit, 'error_estimate'):
+            arrays['error_estimate'] = np.array(reduced_circuit.error_estimate)
+        self.store(key, arrays)
+        return reduced_circuit
@@ -1,235 +1,357 @@
 #!/usr/bin/env python3
 
+import logging
 import numpy as np
+import scipy.sparse
 
 from .circuit_model import CircuitModel
+from .netlist import Netlist, edit_netlist, read_netlist
+from . import profiling
+from . import subckt
+from . import topology
+
+logger = logging.getLogger(__name__)
 
 class Circuit(CircuitModel):
-    def __init__(self, filename, input_sources=set(), output_nodes=set()):
-        self.internal_sources = []
+    def __init__(self, filename, input_sources=set(), output_nodes=set(), sparse=False, reduce_topology=None,
+                 subckt_order=None, model_cache=None):
+        # filename is a SPICE netlist file or an already parsed netlist.Netlist
+        # reduce_topology=None stamps the netlist as is, a time constant (in seconds) first shrinks it with
+        # topology.reduce_netlist (0 keeps the reduction exact)
+        # subcircuit instances are stamped from the macromodel of their definition (see subckt.macromodel), exact
+        # for subckt_order=None or PRIMA reduced to that order; model_cache (a cache.ModelCache) keeps the
+        # macromodels across runs
+        self.sparse = sparse
         self.input_sources = input_sources
         self.output_nodes = output_nodes
-        self.node_name_to_id = { '0' : -1, 'node0' : -1, 'gnd' : -1, 'ground' : -1 }
-        num_default_nodes = len(self.node_name_to_id)
-        self.voltage_sources = {}   # internal voltage sources (num_internals): voltage_sources[component_name] = v_src_id
-        self.current_sources = {}   # internal current sources: current_sources[component_name] = (node1_id, node2_id)
-
-        input_file = open(filename, 'r')
-        components = []
-        i_size = 0  # number of internal current sources
-        for line in input_file:
-            line = line.strip()
-            if line == "" or line[0] == '#' or line[0] == '*' or line[0] == '.':
-                continue;
-
-            param_strs = line.split()
-            # print(param_strs)
-            assert(len(param_strs) == 4)
-
-            component_name = param_strs[0]
-            node1_name = param_strs[1]
-            node2_name = param_strs[2]
-            value = float(param_strs[3])
-
-            components.append((component_name, node1_name, node2_name, value))
-            if node1_name not in self.node_name_to_id:
-                node_id = len(self.node_name_to_id) - num_default_nodes
-                self.node_name_to_id[node1_name] = node_id
-            if node2_name not in self.node_name_to_id:
-                node_id = len(self.node_name_to_id) - num_default_nodes
-                self.node_name_to_id[node2_name] = node_id
-
-            component_type = component_name[0].lower()
-            if component_type == 'r':
-                i_size = max(i_size, self.node_name_to_id[node1_name]+1, self.node_name_to_id[node2_name]+1)
-            elif component_type == 'c':
-                i_size = max(i_size, self.node_name_to_id[node1_name]+1, self.node_name_to_id[node2_name]+1)
-            elif component_type == 'l':
-                v_src_id = len(self.voltage_sources)
-                self.voltage_sources[component_name] = v_src_id
-            elif component_type == 'v':
-                v_src_id = len(self.voltage_sources)
-                self.voltage_sources[component_name] = v_src_id
-            elif component_type == 'i':
-                i_size = max(i_size, self.node_name_to_id[node1_name]+1, self.node_name_to_id[node2_name]+1)
-                self.current_sources[component_name] = (self.node_name_to_id[node1_name], self.node_name_to_id[node2_name])
-            else:
-                print('unknown component %s' % component_name)
-        input_file.close()
-
-        num_nodes = len(self.node_name_to_id) - num_default_nodes
+        self.revision = 0   # incremented by every edit
+
+        if isinstance(filename, Netlist):
+            self.netlist = filename
+        else:
+            with profiling.span('parse'):
+                self.netlist = read_netlist(filename)
+        if reduce_topology is not None:
+            self.netlist = topology.reduce_netlist(self.netlist, output_nodes, reduce_topology)
+        netlist = self.netlist
+        self.node_name_to_id = netlist.node_name_to_id
+        kinds = netlist.kinds
+
+        for i in np.flatnonzero(~np.isin(kinds, ('r', 'c', 'l', 'v', 'i'))):
+            logger.warning('unknown component %s', netlist.names[i])
+
+        # inductors and voltage sources both get a current state, numbered in netlist order
+        is_v_src = (kinds == 'l') | (kinds == 'v')
+        v_src_ids = np.cumsum(is_v_src) - 1
+        # internal voltage sources (num_internals): voltage_sources[component_name] = v_src_id
+        self.voltage_sources = { netlist.names[i] : int(v_src_ids[i]) for i in np.flatnonzero(is_v_src) }
+        # internal current sources: current_sources[component_name] = (node1_id, node2_id)
+        self.current_sources = { netlist.names[i] : (int(netlist.node1[i]), int(netlist.node2[i]))
+                                 for i in np.flatnonzero(kinds == 'i') }
+        is_input = np.array([name in input_sources for name in netlist.names], dtype=bool)
+        self.internal_sources = [netlist.names[i] for i in np.flatnonzero(np.isin(kinds, ('v', 'i')) & ~is_input)]
+        # only input sources follow their waveform, internal ones are stamped into b with their DC value
+        for i in np.flatnonzero(np.isin(kinds, ('v', 'i')) & ~is_input):
+            if netlist.names[i] in netlist.stimuli:
+                logger.warning('%s is not an input source, its waveform %s is ignored and it is held at %g',
+                               netlist.names[i], netlist.stimuli[netlist.names[i]].spec, netlist.values[i])
+
+        num_nodes = netlist.num_nodes
         v_size = len(self.voltage_sources)
 
-        # left hand side component (Gx(t) + Cx'(t) = b(t))
-        self.GA = np.zeros((num_nodes, num_nodes))  # lhs voltages wrt rhs currents
-        self.GB = np.zeros((num_nodes, v_size))     # lhs currents wrt rhs currents
-        self.GC = np.zeros((v_size, num_nodes))     # lhs voltages wrt rhs voltages
-        self.GD = np.zeros((v_size, v_size))        # lhs currents wrt rhs voltages
-
-        # left hand side component (Gx(t) + Cx'(t) = b(t))
-        self.CA = np.zeros((num_nodes, num_nodes))  # lhs voltage changes wrt rhs currents
-        self.CB = np.zeros((num_nodes, v_size))     # lhs current changes wrt rhs currents
-        self.CC = np.zeros((v_size, num_nodes))     # lhs voltage changes wrt rhs voltages
-        self.CD = np.zeros((v_size, v_size))        # lhs current changes wrt rhs voltages
-
-        # right hand side component (non-user inputs)
-        self.i = np.zeros((num_nodes, 1))   # fixed currents (not states)
-        self.v = np.zeros((v_size, 1))      # fixed voltages (not states)
-        # print(i_size, num_nodes)
-
-        for (component_name, node1_name, node2_name, value) in components:
-            component_type = component_name[0].lower()
-            if component_type == 'r':
-                self._add_resistor(self.node_name_to_id[node1_name],
-                                   self.node_name_to_id[node2_name],
-                                   value)
-            elif component_type == 'c':
-                self._add_capacitor(self.node_name_to_id[node1_name],
-                                    self.node_name_to_id[node2_name],
-                                    value)
-            elif component_type == 'l':
-                self._add_inductor(component_name,
-                                   self.node_name_to_id[node1_name],
-                                   self.node_name_to_id[node2_name],
-                                   value)
-            elif component_type == 'v':
-                if component_name not in self.input_sources:
-                    self.internal_sources.append(component_name)
-                self._add_voltage_source(component_name,
-                                         self.node_name_to_id[node1_name],
-                                         self.node_name_to_id[node2_name],
-                                         value,
-                                         component_name in self.input_sources)
-            elif component_type == 'i':
-                if component_name not in self.input_sources:
-                    self.internal_sources.append(component_name)
-                self._add_current_source(self.node_name_to_id[node1_name],
-                                         self.node_name_to_id[node2_name],
-                                         value,
-                                         component_name in self.input_sources)
-
-        self.G = np.vstack((np.hstack((self.GA, self.GB)), np.hstack((self.GC, self.GD))))
-        self.C = np.vstack((np.hstack((self.CA, self.CB)), np.hstack((self.CC, self.CD))))
-        self.b = np.vstack((self.i, self.v))
-        assert(self.G.shape[0] == self.b.shape[0])
-        assert(self.G.shape[1] == self.b.shape[0])
-        self.G.setflags(write=False)
-        self.C.setflags(write=False)
-        self.b.setflags(write=False)
-
-        print('setting voltage/current sources as external input')
+        with profiling.span('stamp', elements=len(netlist)):
+            # left hand side components (Gx(t) + Cx'(t) = b(t)), gathered as COO triplets (row, col, value)
+            # node voltages are states [0, num_nodes), voltage source/inductor currents are states [num_nodes, num_nodes+v_size)
+            self.v_offset = num_nodes
+            self.G_triplets = ([], [], [])
+            self.C_triplets = ([], [], [])
+
+            # right hand side component (non-user inputs)
+            self.i = np.zeros((num_nodes, 1))   # fixed currents (not states)
+            self.v = np.zeros((v_size, 1))      # fixed voltages (not states)
+
+            n1 = netlist.node1
+            n2 = netlist.node2
+            values = netlist.values
+            v_src_idxs = self.v_offset + v_src_ids
+            is_r = kinds == 'r'
+            is_c = kinds == 'c'
+            is_l = kinds == 'l'
+            is_v = kinds == 'v'
+            is_i = kinds == 'i'
+            self._add_resistors(n1[is_r], n2[is_r], values[is_r])
+            self._add_capacitors(n1[is_c], n2[is_c], values[is_c])
+            self._add_inductors(v_src_idxs[is_l], n1[is_l], n2[is_l], values[is_l])
+            self._add_voltage_sources(v_src_idxs[is_v], n1[is_v], n2[is_v], values[is_v], is_input[is_v])
+            self._add_current_sources(n1[is_i], n2[is_i], values[is_i], is_input[is_i])
+
+            # the internal states of the subcircuit instances follow the currents
+            n = self._add_instances(netlist, num_nodes + v_size, subckt_order, model_cache)
+            self.G = self._assemble(self.G_triplets, n)
+            self.C = self._assemble(self.C_triplets, n)
+            self.b = np.vstack((self.i, self.v, np.zeros((n - num_nodes - v_size, 1))))
+            assert(self.G.shape[0] == self.b.shape[0])
+            assert(self.G.shape[1] == self.b.shape[0])
+            self.b.setflags(write=False)
+
+        logger.info('setting voltage/current sources as external input')
         pos_Bvec_idxs = set()
         neg_Bvec_idxs = set()
+        B_columns = []  # one column per valid input source (multi-port B matrix)
+        self.input_source_list = []     # the input sources in the order of the columns of B_matrix
         for component_name in self.input_sources:
             component_type = component_name[0].lower()
             if component_type == 'i':
                 if component_name in self.current_sources:
                     indices = self.current_sources[component_name]
-                    print('  %s [B_vector indices=%s]' % (component_name, str(indices)))
+                    logger.info('  %s [B_vector indices=%s]', component_name, str(indices))
                     neg_Bvec_idxs.add(indices[0])
                     pos_Bvec_idxs.add(indices[1])
+                    B_columns.append(self._source_column(component_name))
+                    self.input_source_list.append(component_name)
                 else:
-                    print('  %s (invalid current source)' % component_name)
+                    logger.warning('  %s (invalid current source)', component_name)
             elif component_type == 'v':
                 if component_name in self.voltage_sources:
                     index = self.i.shape[0] + self.voltage_sources[component_name]
-                    print('  %s [B_vector index=%d]' % (component_name, index))
+                    logger.info('  %s [B_vector index=%d]', component_name, index)
                     pos_Bvec_idxs.add(index)
+                    B_columns.append(self._source_column(component_name))
+                    self.input_source_list.append(component_name)
                 else:
-                    print('  %s (invalid voltage source)' % component_name)
+                    logger.warning('  %s (invalid voltage source)', component_name)
             else:
-                print('  %s (invalid input source)' % component_name)
+                logger.warning('  %s (invalid input source)', component_name)
         if len(self.internal_sources) > 0:
-            print('internal sources (non-passive circuit)')
+            logger.info('internal sources (non-passive circuit)')
             for component_name in self.internal_sources:
                 component_type = component_name[0].lower()
                 if component_type == 'i':
                     indices = self.current_sources[component_name]
-                    print('  %s [b_vector indices=%s]' % (component_name, str(indices)))
+                    logger.info('  %s [b_vector indices=%s]', component_name, str(indices))
                 elif component_type == 'v':
                     index = self.i.shape[0] + self.voltage_sources[component_name]
-                    print('  %s [b_vector index=%d]' % (component_name, index))
+                    logger.info('  %s [b_vector index=%d]', component_name, index)
 
         self.B = np.zeros(self.b.shape)
         self.B[list(pos_Bvec_idxs)] = 1.0
         self.B[list(neg_Bvec_idxs)] = -1.0
         self.B.setflags(write=False)
 
-        print('observing the following nodes:')
+        # one column per input source and one per internal source (the ports of a multi-port macromodel)
+        self.B_matrix = np.hstack(B_columns) if len(B_columns) > 0 else np.zeros((n, 0))
+        self.B_matrix.setflags(write=False)
+        b_columns = [self._source_column(component_name) for component_name in self.internal_sources]
+        self.b_matrix = np.hstack(b_columns) if len(b_columns) > 0 else np.zeros((n, 0))
+        self.b_matrix.setflags(write=False)
+
+        logger.info('observing the following nodes:')
         self.L_list = []
         for node_name in self.output_nodes:
             if node_name in self.node_name_to_id:
                 index = self.node_name_to_id[node_name]
-                print('  %s [x_vector_index=%d]' % (node_name, index))
+                logger.info('  %s [x_vector_index=%d]', node_name, index)
                 L = np.zeros(self.b.shape)
                 L[index] = 1.0
                 L.setflags(write=False)
                 self.L_list.append(L)
             else:
-                print('  %s (invalid node)' % node_name)
-
-    def _add_resistor(self, node1_id, node2_id, value):
-        if node1_id >= 0:
-            self.GA[node1_id, node1_id] += 1/value
-        if node2_id >= 0:
-            self.GA[node2_id, node2_id] += 1/value
-        if node1_id >= 0 and node2_id >= 0:
-            self.GA[node1_id, node2_id] -= 1/value
-            self.GA[node2_id, node1_id] -= 1/value
-
-    def _add_capacitor(self, node1_id, node2_id, value):
-        if node1_id >= 0:
-            self.CA[node1_id, node1_id] += value
-        if node2_id >= 0:
-            self.CA[node2_id, node2_id] += value
-        if node1_id >= 0 and node2_id >= 0:
-            self.CA[node1_id, node2_id] -= value
-            self.CA[node2_id, node1_id] -= value
-
-    def _add_inductor(self, component_name, node1_id, node2_id, value):
-        assert(node1_id >= 0 or node2_id >= 0)
-        v_src_id = self.voltage_sources[component_name]
-        
-        self.CD[v_src_id, v_src_id] = value
+                logger.warning('  %s (invalid node)', node_name)
+
+    def _assemble(self, triplets, n):
+        (rows, cols, values) = (np.concatenate(part) if len(part) > 0 else np.zeros(0) for part in triplets)
+        # duplicate (row, col) entries are summed during the conversion
+        M = scipy.sparse.coo_matrix((values, (rows, cols)), shape=(n, n)).tocsc()
+        if self.sparse:
+            return M
+        M = M.toarray()
+        M.setflags(write=False)
+        return M
+
+    def _stamp(self, triplets, rows, cols, values):
+        # stamps involving the ground node (id -1) are dropped
+        keep = (rows >= 0) & (cols >= 0)
+        triplets[0].append(rows[keep])
+        triplets[1].append(cols[keep])
+        triplets[2].append(np.broadcast_to(values, keep.shape)[keep])
+
+    def _source_column(self, component_name):
+        # unit excitation pattern of a source in the right hand side
+        column = np.zeros(self.b.shape)
+        if component_name[0].lower() == 'i':
+            (node1_id, node2_id) = self.current_sources[component_name]
+            if node1_id >= 0:
+                column[node1_id] -= 1.0
+            if node2_id >= 0:
+                column[node2_id] += 1.0
+        else:
+            column[self.v_offset + self.voltage_sources[component_name]] = 1.0
+        return column
+
+    def _add_resistors(self, node1_ids, node2_ids, values):
+        self._stamp(self.G_triplets, node1_ids, node1_ids, 1/values)
+        self._stamp(self.G_triplets, node2_ids, node2_ids, 1/values)
+        self._stamp(self.G_triplets, node1_ids, node2_ids, -1/values)
+        self._stamp(self.G_triplets, node2_ids, node1_ids, -1/values)
+
+    def _add_capacitors(self, node1_ids, node2_ids, values):
+        self._stamp(self.C_triplets, node1_ids, node1_ids, values)
+        self._stamp(self.C_triplets, node2_ids, node2_ids, values)
+        self._stamp(self.C_triplets, node1_ids, node2_ids, -values)
+        self._stamp(self.C_triplets, node2_ids, node1_ids, -values)
+
+    def _add_inductors(self, v_src_idxs, node1_ids, node2_ids, values):
+        assert(np.all((node1_ids >= 0) | (node2_ids >= 0)))
+
+        self._stamp(self.C_triplets, v_src_idxs, v_src_idxs, values)
 
         # current flowing into and out of inductor
-        if node1_id >= 0:
-            self.GB[node1_id, v_src_id] += 1
-        if node2_id >= 0:
-            self.GB[node2_id, v_src_id] -= 1
+        self._stamp(self.G_triplets, node1_ids, v_src_idxs, 1.0)
+        self._stamp(self.G_triplets, node2_ids, v_src_idxs, -1.0)
 
         # voltage drops across inductor
-        if node1_id >= 0:
-            self.GC[v_src_id, node1_id] -= 1
-        if node2_id >= 0:
-            self.GC[v_src_id, node2_id] += 1
+        self._stamp(self.G_triplets, v_src_idxs, node1_ids, -1.0)
+        self._stamp(self.G_triplets, v_src_idxs, node2_ids, 1.0)
 
-    def _add_voltage_source(self, component_name, p_node_id, n_node_id, value, override=False):
-        assert(p_node_id != n_node_id)
-        v_src_id = self.voltage_sources[component_name]
+    def _add_voltage_sources(self, v_src_idxs, p_node_ids, n_node_ids, values, override):
+        assert(np.all(p_node_ids != n_node_ids))
 
-        if not override:
-            self.v[v_src_id, 0] = value # fixed component voltage drop across voltage source
+        # fixed component voltage drop across (non-input) voltage sources
+        self.v[v_src_idxs[~override] - self.v_offset, 0] = values[~override]
 
         # current relationships (KCL)
-        if p_node_id >= 0:
-            self.GB[p_node_id, v_src_id] -= 1
-        if n_node_id >= 0:
-            self.GB[n_node_id, v_src_id] += 1
+        self._stamp(self.G_triplets, p_node_ids, v_src_idxs, -1.0)
+        self._stamp(self.G_triplets, n_node_ids, v_src_idxs, 1.0)
 
         # voltage relationships (KVL)
-        if p_node_id >= 0:
-            self.GC[v_src_id, p_node_id] += 1
-        if n_node_id >= 0:
-            self.GC[v_src_id, n_node_id] -= 1
-
-    def _add_current_source(self, node1_id, node2_id, value, override=False):
-        if override:
-            return
-        if node1_id >= 0:
-            self.i[node1_id] -= value
-        if node2_id >= 0:
-            self.i[node2_id] += value
+        self._stamp(self.G_triplets, v_src_idxs, p_node_ids, 1.0)
+        self._stamp(self.G_triplets, v_src_idxs, n_node_ids, -1.0)
+
+    def _add_current_sources(self, node1_ids, node2_ids, values, override):
+        keep = ~override & (node1_ids >= 0)
+        np.subtract.at(self.i[:, 0], node1_ids[keep], values[keep])
+        keep = ~override & (node2_ids >= 0)
+        np.add.at(self.i[:, 0], node2_ids[keep], values[keep])
+
+    def _add_instances(self, netlist, n, subckt_order, model_cache):
+        # stamps the macromodel of every subcircuit instance, its pins onto the nodes they connect and its internal
+        # states from state n on (all instances of a definition at once), returns the number of states
+        pins_by_subckt = {}
+        for instance in netlist.instances:
+            pins_by_subckt.setdefault(instance.subckt, []).append(instance.pins)
+        for (name, pins) in pins_by_subckt.items():
+            build = lambda name=name: self._definition_matrices(netlist.subcircuits[name], subckt_order, model_cache)
+            model = subckt.macromodel(netlist.subcircuits, name, subckt_order, build, model_cache)
+            # ids[k, j] is the state of instance k for state j of the macromodel
+            m = model.num_internal_states
+            ids = np.hstack((np.array(pins, dtype=int).reshape(len(pins), model.num_pins),
+                             n + np.arange(len(pins) * m).reshape(len(pins), m)))
+            n += len(pins) * m
+            for (triplets, M) in ((self.G_triplets, model.G), (self.C_triplets, model.C)):
+                self._stamp(triplets, ids[:, M.row].ravel(), ids[:, M.col].ravel(), np.tile(M.data, len(pins)))
+            logger.info('%d instances of %s (%d internal states each)', len(pins), name, m)
+        return n
+
+    def edit(self, set_values=None, add=(), remove=()):
+        # Changes, adds and removes resistors, capacitors and inductors in place (see netlist.edit_netlist for the
+        # arguments), stamping only the difference: the stamps of the changed and removed elements are taken away and
+        # those of the changed and added ones added. G and C are replaced by new matrices, which solvers holding
+        # factorizations of the old ones follow (see transient.TrapezoidalSolverCache.update, and
+        # prima.PrimaReducedCircuit.update by a low rank correction). The states stay as they are, except that every
+        # added inductor appends a current state; a removed inductor keeps its current state, held at 0.
+        set_values = set_values if set_values is not None else {}
+        old = self.netlist
+        self.netlist = edit_netlist(old, set_values, add, remove)
+        netlist = self.netlist
+        old_index = { name : i for (i, name) in enumerate(old.names) }
+        new_index = { name : i for (i, name) in enumerate(netlist.names) }
+        taken = np.array([old_index[name] for name in list(set_values) + list(remove)], dtype=int)
+        given = np.array([new_index[name] for name in list(set_values) + [element[0] for element in add]], dtype=int)
+
+        n = self.b.shape[0]
+        changed = np.array([new_index[name] for name in set_values], dtype=int)
+        added_inductors = given[(netlist.kinds[given] == 'l') & ~np.isin(given, changed)]
+        if len(added_inductors) > 0:
+            self._grow(n + len(added_inductors))
+        with profiling.span('stamp_edit', elements=len(taken) + len(given)):
+            self.G_triplets = ([], [], [])
+            self.C_triplets = ([], [], [])
+            for (elements, ids, sign) in ((old, taken, -1.0), (netlist, given, 1.0)):
+                (kinds, n1, n2, values) = (elements.kinds[ids], elements.node1[ids], elements.node2[ids],
+                                           elements.values[ids])
+                self._add_resistors(n1[kinds == 'r'], n2[kinds == 'r'], sign*values[kinds == 'r'])
+                self._add_capacitors(n1[kinds == 'c'], n2[kinds == 'c'], sign*values[kinds == 'c'])
+            for name in set_values:
+                if old.kinds[old_index[name]] == 'l':
+                    k = np.array([self.v_offset + self.voltage_sources[name]])
+                    self._stamp(self.C_triplets, k, k, netlist.values[new_index[name]] - old.values[old_index[name]])
+            for name in remove:
+                if old.kinds[old_index[name]] == 'l':
+                    # the inductor's stamps are taken away, its current state is left with the equation i = 0
+                    i = old_index[name]
+                    k = np.array([self.v_offset + self.voltage_sources.pop(name)])
+                    self._stamp(self.C_triplets, k, k, -old.values[i])
+                    self._stamp(self.G_triplets, old.node1[i:i+1], k, -1.0)
+                    self._stamp(self.G_triplets, old.node2[i:i+1], k, 1.0)
+                    self._stamp(self.G_triplets, k, old.node1[i:i+1], 1.0)
+                    self._stamp(self.G_triplets, k, old.node2[i:i+1], -1.0)
+                    self._stamp(self.G_triplets, k, k, 1.0)
+            k = np.arange(n, n + len(added_inductors))
+            for (name_id, state) in zip(added_inductors, k):
+                self.voltage_sources[netlist.names[name_id]] = int(state) - self.v_offset
+            self._add_inductors(k, netlist.node1[added_inductors], netlist.node2[added_inductors],
+                                netlist.values[added_inductors])
+
+            (self.G, self.C) = (self._edited(M, triplets) for (M, triplets) in ((self.G, self.G_triplets),
+                                                                                (self.C, self.C_triplets)))
+        self.revision += 1
+        logger.info('edited %d elements (revision %d)', len(set_values) + len(add) + len(remove), self.revision)
+
+    def set_element(self, name, value):
+        self.edit(set_values={ name : value })
+
+    def add_element(self, name, node1, node2, value):
+        self.edit(add=[(name, node1, node2, value)])
+
+    def remove_element(self, name):
+        self.edit(remove=[name])
+
+    def _edited(self, M, triplets):
+        # M plus the stamps of triplets, a new matrix in M's format
+        n = M.shape[0]
+        (rows, cols, values) = (np.concatenate(part) if len(part) > 0 else np.zeros(0) for part in triplets)
+        delta = scipy.sparse.coo_matrix((values, (rows, cols)), shape=(n, n))
+        if self.sparse:
+            return (M + delta).tocsc()
+        M = M + delta.toarray()
+        M.setflags(write=False)
+        return M
+
+    def _grow(self, n):
+        # appends states (e.g. the current of an added inductor): zero rows (and columns) in every matrix and vector
+        m = n - self.b.shape[0]
+        pad = lambda x: np.vstack((x, np.zeros((m, x.shape[1]))))
+        if self.sparse:
+            (self.G, self.C) = (scipy.sparse.block_diag((M, scipy.sparse.csc_matrix((m, m))), format='csc')
+                                for M in (self.G, self.C))
+        else:
+            (self.G, self.C) = (np.pad(M, ((0, m), (0, m))) for M in (self.G, self.C))
+        (self.b, self.B) = (pad(self.b), pad(self.B))
+        (self.B_matrix, self.b_matrix) = (pad(self.B_matrix), pad(self.b_matrix))
+        self.L_list = [pad(L) for L in self.L_list]
+        for x in [self.G, self.C, self.b, self.B, self.B_matrix, self.b_matrix] + self.L_list:
+            if not scipy.sparse.issparse(x):
+                x.setflags(write=False)
+
+    @staticmethod
+    def _definition_matrices(definition, subckt_order, model_cache):
+        # G and C of a subcircuit definition on its own, the pins are its first states
+        is_rcl = np.isin(definition.netlist.kinds, ('r', 'c', 'l'))
+        if not np.all(is_rcl):
+            raise ValueError('subcircuit %s: %s (only resistors, capacitors, inductors and instances are supported)'
+                             % (definition.name, ', '.join(np.array(definition.netlist.names)[~is_rcl])))
+        circuit = Circuit(definition.netlist, sparse=True, subckt_order=subckt_order, model_cache=model_cache)
+        return (circuit.G, circuit.C)
 
     @property
     def mna_GCb_matrices(self):
@@ -239,6 +361,18 @@ class Circuit(CircuitModel):
     def input_B_vector(self):
         return self.B
 
+    @property
+    def input_B_matrix(self):
+        return self.B_matrix
+
+    @property
+    def input_stimuli(self):
+        return [self.netlist.stimuli.get(component_name) for component_name in self.input_source_list]
+
+    @property
+    def internal_b_matrix(self):
+        return self.b_matrix
+
     @property
     def output_L_vectors(self):
         return self.L_list
@@ -252,6 +386,11 @@ class Circuit(CircuitModel):
         return self.internal_sources
 
     def print_GCb_matrices(self):
+        if self.sparse:
+            print('G(%s, nnz=%d)' % (str(self.G.shape), self.G.nnz))
+            print('C(%s, nnz=%d)' % (str(self.C.shape), self.C.nnz))
+            print('b(%s) =\n' % str(self.b.shape), self.b)
+            return
         with np.printoptions(linewidth=1000):
             print('G(%s) =\n' % str(self.G.shape), self.G)
             print('C(%s) =\n' % str(self.C.shape), self.C)
@@ -2,7 +2,13 @@
 
 from abc import ABC, abstractmethod
 
+import numpy as np
+import scipy.sparse
+
 class CircuitModel(ABC):
+    # reduced order models (see prima.py) set this, transient analysis integrates their modes exactly by default
+    is_reduced = False
+
     @property
     @abstractmethod
     def mna_GCb_matrices(self):
@@ -13,6 +19,24 @@ class CircuitModel(ABC):
     def input_B_vector(self):
         pass
 
+    @property
+    @abstractmethod
+    def input_B_matrix(self):
+        # one column per input source
+        pass
+
+    @property
+    @abstractmethod
+    def input_stimuli(self):
+        # per column of input_B_matrix, the source's waveform from the netlist (see stimulus.py) or None
+        pass
+
+    @property
+    @abstractmethod
+    def internal_b_matrix(self):
+        # one (unit) column per internal source
+        pass
+
     @property
     @abstractmethod
     def output_L_vectors(self):
@@ -31,3 +55,63 @@ class CircuitModel(ABC):
     @abstractmethod
     def print_GCb_matrices(self):
         pass
+
+
+class StateSpaceModel(CircuitModel):
+    # a circuit model given directly by its matrices (e.g. loaded from a cache), G and C may be dense or sparse
+    def __init__(self, G, C, b, B, B_matrix, b_matrix, L_list, internal_sources, output_nodes, input_stimuli=None,
+                 is_reduced=False):
+        self.G = G
+        self.C = C
+        self.b = b
+        self.B = B
+        self.B_matrix = B_matrix
+        self.b_matrix = b_matrix
+        self.L_list = list(L_list)
+        self.internal_sources = list(internal_sources)
+        self.output_nodes = list(output_nodes)
+        self.stimuli = list(input_stimuli) if input_stimuli is not None else [None] * B_matrix.shape[1]
+        self.is_reduced = is_reduced
+
+    @property
+    def mna_GCb_matrices(self):
+        return (self.G, self.C, self.b)
+
+    @property
+    def input_B_vector(self):
+        return self.B
+
+    @property
+    def input_B_matrix(self):
+        return self.B_matrix
+
+    @property
+    def input_stimuli(self):
+        return self.stimuli
+
+    @property
+    def internal_b_matrix(self):
+        return self.b_matrix
+
+    @property
+    def output_L_vectors(self):
+        return self.L_list
+
+    @property
+    def output_node_names(self):
+        return self.output_nodes
+
+    @property
+    def internal_source_names(self):
+        return self.internal_sources
+
+    def print_GCb_matrices(self):
+        if scipy.sparse.issparse(self.G):
+            print('G(%s, nnz=%d)' % (str(self.G.shape), self.G.nnz))
+            print('C(%s, nnz=%d)' % (str(self.C.shape), self.C.nnz))
+            print('b(%s) =\n' % str(self.b.shape), self.b)
+            return
+        with np.printoptions(linewidth=1000):
+            print('G(%s) =\n' % str(self.G.shape), self.G)
+            print('C(%s) =\n' % str(self.C.shape), self.C)
+            print('b(%s) =\n' % str(self.b.shape), self.b)
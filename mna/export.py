@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import struct
+import numpy as np
+
+# raw files: magic, header length (little endian uint32), JSON header, then the rows as a C-ordered array
+RAW_MAGIC = b'MNARAW1\0'
+RAW_ALIGNMENT = 64  # the array starts at a multiple of this offset
+
+
+class WaveformWriter:
+    # Writes an axis (t or w) and one column per output, chunk by chunk (see transient.stream_transient_analysis):
+    #     with open_writer('transient.raw', 't', ['pt1', 'pt16']) as writer:
+    #         for (t, y) in chunks:
+    #             writer.write(t, y)
+    # y has one row per output and one column per axis point, as returned by the analyses.
+    def __init__(self, filename, axis_name, names, dtype=float):
+        self.filename = filename
+        self.axis_name = axis_name
+        self.names = list(names)
+        self.dtype = np.dtype(dtype)
+
+    def write(self, axis, y):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class NpzWriter(WaveformWriter):
+    # one array per output plus the axis, collected until close (the .npz format cannot be appended to)
+    def __init__(self, filename, axis_name, names, dtype=float):
+        super().__init__(filename, axis_name, names, dtype)
+        self.axis_chunks = []
+        self.y_chunks = []
+
+    def write(self, axis, y):
+        self.axis_chunks.append(np.asarray(axis, dtype=float))
+        self.y_chunks.append(np.asarray(y, dtype=self.dtype).reshape(len(self.names), -1))
+
+    def close(self):
+        axis = np.concatenate(self.axis_chunks) if len(self.axis_chunks) > 0 else np.zeros(0)
+        y = np.hstack(self.y_chunks) if len(self.y_chunks) > 0 else np.zeros((len(self.names), 0), dtype=self.dtype)
+        arrays = { self.axis_name : axis }
+        arrays.update((name, y[i, :]) for (i, name) in enumerate(self.names))
+        np.savez(self.filename, **arrays)
+
+
+class CsvWriter(WaveformWriter):
+    # one row per axis point, complex outputs get a re(name) and an im(name) column
+    def __init__(self, filename, axis_name, names, dtype=float):
+        super().__init__(filename, axis_name, names, dtype)
+        self.output_file = open(filename, 'w')
+        if self.dtype.kind == 'c':
+            columns = [column for name in self.names for column in ('re(%s)' % name, 'im(%s)' % name)]
+        else:
+            columns = self.names
+        self.output_file.write(','.join([axis_name] + columns) + '\n')
+
+    def write(self, axis, y):
+        y = np.asarray(y, dtype=self.dtype).reshape(len(self.names), -1)
+        if self.dtype.kind == 'c':
+            y = np.stack((y.real, y.imag), axis=1).reshape(2*len(self.names), -1)
+        rows = np.vstack((np.asarray(axis, dtype=float)[np.newaxis, :], y)).transpose()
+        np.savetxt(self.output_file, rows, fmt='%.12g', delimiter=',')
+
+    def close(self):
+        self.output_file.close()
+
+
+class RawWriter(WaveformWriter):
+    # rows of (axis, outputs...) appended to a binary file, readable without parsing through read_raw (np.memmap);
+    # the number of rows follows from the file size, so the header never needs rewriting
+    def __init__(self, filename, axis_name, names, dtype=float):
+        super().__init__(filename, axis_name, names, dtype)
+        header = json.dumps({ 'dtype' : self.dtype.newbyteorder('<').str,
+                              'columns' : [axis_name] + self.names }).encode()
+        offset = len(RAW_MAGIC) + 4 + len(header)
+        header += b' ' * (-offset % RAW_ALIGNMENT)
+        self.output_file = open(filename, 'wb')
+        self.output_file.write(RAW_MAGIC + struct.pack('<I', len(header)) + header)
+
+    def write(self, axis, y):
+        y = np.asarray(y, dtype=self.dtype).reshape(len(self.names), -1)
+        rows = np.vstack((np.asarray(axis, dtype=self.dtype)[np.newaxis, :], y)).transpose()
+        self.output_file.write(np.ascontiguousarray(rows, dtype=self.dtype.newbyteorder('<')).tobytes())
+
+    def close(self):
+        self.output_file.close()
+
+
+def read_raw(filename):
+    # returns (columns, data) for a file of RawWriter, data is a read-only memory map with one column per name
+    with open(filename, 'rb') as input_file:
+        magic = input_file.read(len(RAW_MAGIC))
+        if magic != RAW_MAGIC:
+            raise ValueError('%s is not a raw waveform file' % filename)
+        (header_size,) = struct.unpack('<I', input_file.read(4))
+        header = json.loads(input_file.read(header_size))
+    offset = len(RAW_MAGIC) + 4 + header_size
+    dtype = np.dtype(header['dtype'])
+    num_columns = len(header['columns'])
+    num_rows = (os.path.getsize(filename) - offset) // (dtype.itemsize * num_columns)
+    if num_rows == 0:
+        return (header['columns'], np.zeros((0, num_columns), dtype=dtype))
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(num_rows, num_columns))
+    return (header['columns'], data)
+
+WRITERS = { 'npz' : NpzWriter, 'csv' : CsvWriter, 'raw' : RawWriter }
+
+def open_writer(filename, axis_name, names, dtype=float, format=None):
+    # format is 'npz', 'csv' or 'raw', by default taken from the file extension
+    if format is None:
+        format = os.path.splitext(filename)[1].lstrip('.').lower()
+    if format not in WRITERS:
+        raise ValueError('unknown export format %s (expected one of %s)' % (format, ', '.join(WRITERS)))
+    return WRITERS[format](filename, axis_name, names, dtype)
+
+def write_outputs(filename, axis_name, axis, outputs, format=None):
+    # writes the (axis, outputs) result of transient_analysis or frequency_analysis in one go
+    names = [name for (name, output) in outputs]
+    y = np.array([output for (name, output) in outputs]).reshape(len(outputs), len(axis))
+    with open_writer(filename, axis_name, names, y.dtype, format) as writer:
+        writer.write(axis, y)
+
+
+def decimate_minmax(x, y, num_buckets):
+    # keeps the first, smallest, largest and last point of each of num_buckets equal ranges of x (ascending), so that
+    # a plot at a resolution of about num_buckets pixels looks the same (peaks and edges are kept), returns (x, y);
+    # NaN values of y are never the smallest or largest of a bucket
+    n = len(x)
+    if n <= 4*num_buckets:
+        return (x, y)
+    x_edges = np.linspace(x[0], x[-1], num_buckets+1)
+    # the non-empty buckets (a non-uniform x, e.g. of adaptive timesteps, leaves some empty)
+    edges = np.unique(np.concatenate(([0], np.searchsorted(x, x_edges[1:-1]), [n])))
+    starts = edges[:-1]
+    ends = edges[1:] - 1
+    is_nan = np.isnan(y)
+    (y_low, y_high) = (np.where(is_nan, np.inf, y), np.where(is_nan, -np.inf, y))
+    bucket_min = np.minimum.reduceat(y_low, starts)
+    bucket_max = np.maximum.reduceat(y_high, starts)
+    # positions of the minimum and maximum within each bucket, n for a bucket of NaN values only
+    bucket = np.repeat(np.arange(len(starts)), np.diff(edges))
+    is_min = (y_low == bucket_min[bucket]) & ~is_nan
+    is_max = (y_high == bucket_max[bucket]) & ~is_nan
+    index = np.arange(n)
+    min_index = np.full(len(starts), n)
+    max_index = np.full(len(starts), n)
+    np.minimum.at(min_index, bucket[is_min], index[is_min])
+    np.minimum.at(max_index, bucket[is_max], index[is_max])
+    keep = np.unique(np.concatenate((starts, ends, min_index[min_index < n], max_index[max_index < n])))
+    return (x[keep], y[keep])
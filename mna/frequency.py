@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 
-import time
+import os
+import logging
 from multiprocessing import Pool
+from multiprocessing import shared_memory
 import numpy as np
+import scipy.linalg
+import scipy.sparse
 
+from . import linalg
+from . import profiling
 
-def transfer_function(G, C, B, s):
+logger = logging.getLogger(__name__)
+
+# circuit matrices attached by each worker process once (see _init_worker)
+_worker_matrices = {}
+
+# dense models up to this order (e.g. PRIMA reduced models) are swept with a PoleResidueModel instead of a process pool
+POLE_RESIDUE_MAX_ORDER = 500
+
+
+def transfer_function(G, C, B, s, backend=None):
     # Given:
     # G*x(t) + C*x'(t) = b + B*u(t)
     # y(t) = L'*x(t)
@@ -21,38 +36,259 @@ def transfer_function(G, C, B, s):
     # y(s) = L'*x(s)
     #
     # H(s) = y(s)/u(s) = L'*x(s)/u(s) = L'*(G + s*C)^-1 * B
+    #
+    # (G + s*C) is factored with backend (see linalg.Factorization)
     A = (G + s*C)
-    return np.linalg.solve(A, B)
+    return linalg.factorize(A, backend=backend).solve(B)
+
+class PoleResidueModel:
+    # Diagonalizes the pencil of a small dense model once, so that H(s) at any number of frequencies is a single
+    # vectorized expression:
+    # G^-1*C = V*diag(mu)*V^-1
+    # (G + s*C)^-1 = (I + s*G^-1*C)^-1 * G^-1 = V*diag(1/(1 + s*mu))*V^-1*G^-1
+    # H(s) = L'*(G + s*C)^-1*B = sum_i (L'*V)[:, i] * (V^-1*G^-1*B)[i] / (1 + s*mu_i)
+    # [poles are at s = -1/mu_i, mu_i = 0 terms are frequency independent]
+    # B is a single input column (e.g. the collapsed input_B_vector of a circuit), L has one column per output.
+    def __init__(self, G, C, B, L, max_condition=1e10):
+        self.G = np.asarray(G.toarray() if linalg.issparse(G) else G)
+        self.C = np.asarray(C.toarray() if linalg.issparse(C) else C)
+        self.B = np.asarray(B).reshape(self.G.shape[0], -1)
+        self.L = np.asarray(L)
+        if self.B.shape[1] != 1:
+            raise ValueError('PoleResidueModel takes a single input column, not %d' % self.B.shape[1])
+        self.defective = True
+        try:
+            (mu, V) = np.linalg.eig(np.linalg.solve(self.G, self.C))
+            condition = np.linalg.cond(V)
+            if np.isfinite(condition) and condition <= max_condition:
+                self.mu = mu
+                self.residues = (self.L.transpose() @ V) * np.linalg.solve(V, np.linalg.solve(self.G, self.B)).transpose()
+                self.defective = False
+        except np.linalg.LinAlgError:
+            pass
+
+    @property
+    def poles(self):
+        if self.defective:
+            # the eigenvalues of the pencil, G*x = -s*C*x, without the infinite ones of a singular C
+            s = scipy.linalg.eigvals(-self.G, self.C)
+            return s[np.isfinite(s)]
+        mu = self.mu[self.mu != 0]
+        return -1/mu
+
+    def evaluate(self, s):
+        # returns H(s) with shape (len(s), number of outputs)
+        s = np.asarray(s)
+        if self.defective:
+            # eigenvectors are (nearly) linearly dependent, fall back to one batched solve over all s
+            A = self.G[np.newaxis, :, :] + s[:, np.newaxis, np.newaxis]*self.C[np.newaxis, :, :]
+            X = np.linalg.solve(A, np.broadcast_to(self.B, (len(s),) + self.B.shape))
+            return (self.L.transpose()[np.newaxis, :, :] @ X)[:, :, 0]
+        return (1/(1 + np.outer(s, self.mu))) @ self.residues.transpose()
+
+def _share_array(shms, arr):
+    # copies arr into a new shared memory block, returns a picklable descriptor of it
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shms.append(shm)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return (shm.name, arr.shape, arr.dtype.str)
+
+def _share_matrix(shms, M):
+    if linalg.issparse(M):
+        M = M.tocsc()
+        return ('csc', M.shape, _share_array(shms, M.data), _share_array(shms, M.indices), _share_array(shms, M.indptr))
+    return ('dense', _share_array(shms, M))
+
+def _attach_array(shms, desc):
+    (name, shape, dtype) = desc
+    shm = shared_memory.SharedMemory(name=name)
+    shms.append(shm)    # the views below are only valid while the block stays open
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _attach_matrix(shms, desc):
+    if desc[0] == 'csc':
+        (_, shape, data, indices, indptr) = desc
+        return scipy.sparse.csc_matrix((_attach_array(shms, data), _attach_array(shms, indices), _attach_array(shms, indptr)),
+                                       shape=shape, copy=False)
+    return _attach_array(shms, desc[1])
+
+def _init_worker(G_desc, C_desc, B_desc, L_desc, backend):
+    shms = []
+    _worker_matrices['G'] = _attach_matrix(shms, G_desc)
+    _worker_matrices['C'] = _attach_matrix(shms, C_desc)
+    _worker_matrices['B'] = _attach_matrix(shms, B_desc)
+    _worker_matrices['L'] = _attach_matrix(shms, L_desc)
+    _worker_matrices['backend'] = backend
+    _worker_matrices['shms'] = shms
+
+def solver_choice(G, C, B, s_values, backend=None):
+    # the linalg.SolverChoice for every G + s*C (they share a pattern), made once on the middle of s_values with the
+    # fill reducing ordering resolved to a permutation (see linalg.select_backend); each G + s*C is factored for its
+    # own s and solved once per column of B
+    s = s_values[len(s_values) // 2] if len(s_values) > 0 else 1j
+    return linalg.select_backend(G + s*C, backend, B.shape[1] if B.ndim > 1 else 1, reuse=True)
+
+def _output_responses(G, C, B, L, s_values, backend=None):
+    # H(s) = L'*(G + s*C)^-1 * B for a chunk of s values, one row per s, one column per output
+    choice = solver_choice(G, C, B, s_values, backend)
+    H = np.empty((len(s_values), L.shape[1]), dtype=complex)
+    for (k, s) in enumerate(s_values):
+        with profiling.span('frequency_solve'):
+            H[k, :] = (L.transpose() @ transfer_function(G, C, B, s, choice)).flatten()
+    return H
 
-def frequency_analysis(circuit, w_lo, w_hi):
+def _worker_output_responses(s_values):
+    m = _worker_matrices
+    return _output_responses(m['G'], m['C'], m['B'], m['L'], s_values, m['backend'])
+
+class ResponsePool:
+    # worker processes that evaluate H(s) = L'*(G + s*C)^-1 * B for any number of batches of s:
+    #     with ResponsePool(G, C, B, L, processes) as pool:
+    #         H = pool.evaluate(s)
+    # the matrices are handed to the worker processes once, through shared memory;
+    # each task only carries a chunk of s values and returns only the L' projections;
+    # backend is passed on to every factorization (see _output_responses), best a linalg.SolverChoice made once
+    def __init__(self, G, C, B, L, processes=None, chunks_per_process=4, backend=None):
+        self.matrices = (G, C, B, L)
+        self.backend = backend
+        self.processes = processes if processes is not None else (os.cpu_count() or 1)
+        self.chunks_per_process = chunks_per_process
+        self._shms = []
+        self._pool = None
+
+    def __enter__(self):
+        try:
+            descs = tuple(_share_matrix(self._shms, M) for M in self.matrices)
+            self._pool = Pool(processes=self.processes, initializer=_init_worker, initargs=descs + (self.backend,))
+        except BaseException:
+            self._release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool.terminate()
+        self._pool.join()
+        self._release()
+        return False
+
+    def _release(self):
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def evaluate(self, s):
+        chunks = np.array_split(s, max(min(len(s), self.processes*self.chunks_per_process), 1))
+        # the per-frequency spans of the workers are not collected, only the pool as a whole
+        with profiling.span('frequency_pool', processes=self.processes, points=len(s)):
+            results = self._pool.map(_worker_output_responses, chunks)
+        return np.vstack(results)
+
+def frequency_response(G, C, B, L, s, processes=None, chunks_per_process=4, backend=None):
+    # evaluates H(s) at every point of s, returns an array of shape (len(s), number of outputs)
+    # (in a ResponsePool unless there is a single process or point), the solver backend is chosen once for all s
+    if processes is None:
+        processes = os.cpu_count() or 1
+    G = linalg.sparsify(G)
+    C = linalg.sparsify(C)
+    backend = solver_choice(G, C, B, s, backend)
+    if processes <= 1 or len(s) <= 1:
+        return _output_responses(G, C, B, L, s, backend)
+
+    with ResponsePool(G, C, B, L, processes, chunks_per_process, backend) as pool:
+        return pool.evaluate(s)
+
+def adaptive_frequency_points(evaluate, w_lo, w_hi, rtol=1e-2, atol=1e-6, points_per_decade=4, max_points=10000,
+                              min_interval=1e-6, max_phase_step=np.pi/8):
+    # Samples H(jw) on a non-uniform grid: starts with points_per_decade log-spaced points over [10^w_lo, 10^w_hi]
+    # and recursively bisects (in log10 w) every interval whose midpoint differs from the linear interpolation of its
+    # ends by more than atol + rtol*max|H| (per output), or over which the phase of H turns by more than
+    # max_phase_step, down to intervals of min_interval decades. The phase of an output is only tested where it is
+    # above rtol times its peak, a smaller output cannot deviate from the interpolation by more than the tolerance.
+    # evaluate(s) returns H(s) with shape (len(s), number of outputs), it is called once per refinement level with all
+    # the midpoints of that level; returns (w, H) sorted by w, with at most max_points points
+    log_w = np.linspace(w_lo, w_hi, max(int(np.ceil((w_hi - w_lo)*points_per_decade)), 1) + 1)
+    H = evaluate(1j*10**log_w)
+    left = np.arange(len(log_w) - 1)
+    right = left + 1
+    passed = np.zeros(len(left), dtype=bool)   # whether the interval is the half of one that met the tolerance
+    while len(left) > 0:
+        budget = max_points - len(log_w)
+        if budget <= 0:
+            logger.warning('adaptive frequency sampling stopped at %d points before reaching the tolerance', len(log_w))
+            break
+        (left, right, passed) = (left[:budget], right[:budget], passed[:budget])
+        log_w_mid = (log_w[left] + log_w[right]) / 2
+        with profiling.span('frequency_refine', points=len(log_w_mid)):
+            H_mid = evaluate(1j*10**log_w_mid)
+        mid = np.arange(len(log_w), len(log_w) + len(log_w_mid))
+        log_w = np.concatenate((log_w, log_w_mid))
+        H = np.vstack((H, H_mid))
+
+        peak = np.max(np.abs(H), axis=0)
+        error = np.tile(np.max(np.abs(H_mid - (H[left] + H[right])/2) / (atol + rtol*peak), axis=1, initial=0.0), 2)
+        (left, right) = (np.concatenate((left, mid)), np.concatenate((mid, right)))
+        phase = phase_step(H[left], H[right], rtol*peak)
+        ok = (error <= 1) & (phase <= max_phase_step)
+        # a single midpoint can agree with the interpolation by coincidence where the response oscillates faster than
+        # the grid (e.g. between the evenly spaced resonances of a transmission line): an interval is accepted once it
+        # met the tolerance on two successive levels, or on one level with half the tolerance and at most half the
+        # phase step in both of its halves (the response is smooth there, as over most of a wide band)
+        quiet = (error <= 0.5) & (np.tile(np.maximum(phase[:len(mid)], phase[len(mid):]), 2) <= max_phase_step/2)
+        refine = ~(ok & (np.tile(passed, 2) | quiet)) & ((log_w[right] - log_w[left]) > min_interval)
+        (left, right, passed) = (left[refine], right[refine], ok[refine])
+
+    order = np.argsort(log_w)
+    return (10**log_w[order], H[order])
+
+def phase_step(H_a, H_b, floor):
+    # largest phase difference (radians) between two rows of responses, ignoring outputs not above floor (per output)
+    significant = (np.abs(H_a) > floor) & (np.abs(H_b) > floor)
+    return np.max(np.where(significant, np.abs(np.angle(H_b * np.conj(H_a))), 0.0), axis=1, initial=0.0)
+
+def frequency_analysis(circuit, w_lo, w_hi, processes=None, adaptive=False, rtol=1e-2, atol=1e-6, backend=None):
+    # returns (w, outputs) over [10^w_lo, 10^w_hi] rad/s, 500 log-spaced points by default;
+    # adaptive=True refines a coarse grid where the response changes quickly (see adaptive_frequency_points), the
+    # returned w is then non-uniform
+    # backend selects the solver backend of the sparse (or large) models, see linalg.select_backend
     (G, C, b) = circuit.mna_GCb_matrices
     B = circuit.input_B_vector
     L_list = circuit.output_L_vectors
     if len(circuit.internal_source_names) > 0:
-        print('assuming internal sources are zero (passive circuit)')
+        logger.info('assuming internal sources are zero (passive circuit)')
         for component_name in circuit.internal_source_names:
-            print('  %s' % component_name)
-
-    w = np.logspace(w_lo, w_hi, 500)
-    tic = time.perf_counter()
-    with Pool(processes=8) as pool:
-        computing = []
-        for wi in w:
-            result = pool.apply_async(transfer_function, (G, C, B, 1j*wi))
-            computing.append(result)
-
-        results = []
-        for promise in computing:
-            results.append(promise.get())
-
-    outputs = []
-    for (node_name, L) in zip(circuit.output_node_names, L_list):
-        output = np.empty(w.shape, dtype=complex)
-        assert len(output) == len(results)
-        for i in range(len(results)):
-            output[i] = np.dot(L.transpose(), results[i])[0][0]
-        outputs.append((node_name, output))
-    toc = time.perf_counter()
-    print("analyzing the circuit took %.6f seconds" % (toc - tic))
+            logger.info('  %s', component_name)
+
+    with profiling.span('frequency_analysis', n=G.shape[0], adaptive=adaptive):
+        L = np.hstack(L_list) if len(L_list) > 0 else np.zeros((B.shape[0], 0))
+        if not linalg.issparse(G) and G.shape[0] <= POLE_RESIDUE_MAX_ORDER:
+            with profiling.span('pole_residue'):
+                model = PoleResidueModel(G, C, B, L)
+                if adaptive:
+                    (w, H) = adaptive_frequency_points(model.evaluate, w_lo, w_hi, rtol, atol)
+                else:
+                    w = np.logspace(w_lo, w_hi, 500)
+                    H = model.evaluate(1j*w)
+        else:
+            (G, C) = (linalg.sparsify(G), linalg.sparsify(C))
+            w = np.logspace(w_lo, w_hi, 500)
+            choice = solver_choice(G, C, B, 1j*w, backend)
+            logger.info('frequency solver: %s', choice)
+            if not adaptive:
+                H = frequency_response(G, C, B, L, 1j*w, processes, backend=choice)
+            else:
+                if processes is None:
+                    processes = os.cpu_count() or 1
+                if processes <= 1:
+                    (w, H) = adaptive_frequency_points(lambda s: _output_responses(G, C, B, L, s, choice), w_lo, w_hi,
+                                                       rtol, atol)
+                else:
+                    with ResponsePool(G, C, B, L, processes, backend=choice) as pool:
+                        (w, H) = adaptive_frequency_points(pool.evaluate, w_lo, w_hi, rtol, atol)
+
+        outputs = []
+        for (i, (node_name, L)) in enumerate(zip(circuit.output_node_names, L_list)):
+            outputs.append((node_name, H[:, i]))
 
     return (w, outputs)
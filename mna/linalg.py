@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import logging
+import time
+import warnings
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+from . import profiling
+
+try:
+    from sksparse import cholmod    # optional, provides sparse Cholesky
+except ImportError:
+    cholmod = None
+
+logger = logging.getLogger(__name__)
+
+# matrices up to this order, or denser than DENSE_MIN_DENSITY, are factored as dense arrays (LAPACK beats the
+# overhead of a sparse factorization there)
+DENSE_MAX_ORDER = 200
+DENSE_MIN_DENSITY = 0.1
+# the explicit inverse is chosen up to this order when A is solved at least as many times as its order, and accepted
+# while max|A*A^-1 - I| stays within INVERSE_TOLERANCE
+INVERSE_MAX_ORDER = 100
+INVERSE_TOLERANCE = 1e-9
+# trial factorizations (see choose_backend) try dense backends up to this order, and reject a backend whose relative
+# residual exceeds TRIAL_RESIDUAL
+TRIAL_DENSE_MAX_ORDER = 2000
+TRIAL_RESIDUAL = 1e-9
+# an UpdatableFactorization is factored anew once its low rank correction exceeds this rank (each solve costs
+# O(n*rank) more), or its capacitance matrix this condition number
+MAX_UPDATE_RANK = 64
+MAX_UPDATE_CONDITION = 1e10
+
+# the fill reducing orderings of the sparse backends, in SuperLU's and CHOLMOD's terms; 'amd' is SuperLU's minimum
+# degree ordering of A + A' (it has no AMD of its own), None is the library's default. 'rcm' (reverse Cuthill-McKee)
+# and permutation arrays are applied to A symmetrically before a 'natural' factorization (see Factorization).
+SUPERLU_ORDERINGS = { None : 'COLAMD', 'natural' : 'NATURAL', 'colamd' : 'COLAMD', 'amd' : 'MMD_AT_PLUS_A',
+                      'mmd_ata' : 'MMD_ATA' }
+CHOLMOD_ORDERINGS = { None : 'default', 'natural' : 'natural', 'colamd' : 'colamd', 'amd' : 'amd' }
+
+
+def issparse(A):
+    return scipy.sparse.issparse(A)
+
+def solve(A, b):
+    # solves A*x = b for either a dense or a sparse (scipy.sparse) A, without densifying A
+    if issparse(A):
+        x = scipy.sparse.linalg.spsolve(A.tocsc(), b)
+        return np.reshape(x, b.shape)
+    return np.linalg.solve(A, b)
+
+def sparsify(A, max_density=0.1):
+    # converts a dense matrix that is mostly zeros (e.g. an MNA matrix) to CSC, leaves others untouched
+    if issparse(A) or A.ndim != 2:
+        return A
+    if np.count_nonzero(A) <= max_density*A.size:
+        return scipy.sparse.csc_matrix(A)
+    return A
+
+def density(A):
+    nnz = A.nnz if issparse(A) else np.count_nonzero(A)
+    return nnz / max(A.shape[0]*A.shape[1], 1)
+
+def is_symmetric(A, rtol=1e-12):
+    if A.shape[0] != A.shape[1]:
+        return False
+    if issparse(A):
+        diff = abs(A - A.transpose())
+        diff_max = diff.max() if diff.nnz > 0 else 0.0
+        A_max = abs(A).max() if A.nnz > 0 else 0.0
+    else:
+        diff_max = np.max(np.abs(A - A.transpose()), initial=0.0)
+        A_max = np.max(np.abs(A), initial=0.0)
+    return diff_max <= rtol*A_max
+
+
+def is_pattern_symmetric(A):
+    P = scipy.sparse.csr_matrix(A) != 0
+    return (P != P.transpose()).nnz == 0
+
+def fill_reducing_ordering(A):
+    # a fill reducing permutation p of a sparse matrix with a (nearly) symmetric pattern: A[p][:, p] factors with
+    # little fill-in in its natural order, so matrices of the same pattern can be factored with ordering='natural'
+    # without repeating the ordering (SuperLU cannot reuse a symbolic factorization across matrices otherwise)
+    A = scipy.sparse.csc_matrix(A)
+    n = A.shape[0]
+    pattern = scipy.sparse.csc_matrix((np.ones(A.nnz), A.indices, A.indptr), shape=A.shape)
+    # a diagonally dominant matrix of the symmetrized pattern, factored with diagonal pivots (perm_r = perm_c);
+    # perm_c maps each state to its position, p is its inverse
+    pattern = pattern + pattern.transpose() + (2*n + 1)*scipy.sparse.identity(n, format='csc')
+    perm_c = scipy.sparse.linalg.splu(pattern.tocsc(), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0).perm_c
+    return np.argsort(perm_c)
+
+def rcm_ordering(A):
+    # the reverse Cuthill-McKee permutation p of the symmetrized pattern of A: A[p][:, p] is banded, which suits
+    # trees and lines (but not meshes)
+    A = abs(scipy.sparse.csr_matrix(A))
+    return scipy.sparse.csgraph.reverse_cuthill_mckee((A + A.transpose()).tocsr(), symmetric_mode=True)
+
+
+class Backend:
+    # A way of factoring A, registered in BACKENDS: factor(A, ordering) returns solve(b), with A a dense array for
+    # dense backends or a CSC matrix for sparse ones (with one of its orderings, see SUPERLU_ORDERINGS).
+    # symmetric backends need a real symmetric A, max_order limits the matrices a backend is tried on; orderings
+    # are those a trial factorization compares (the first is the default).
+    def __init__(self, name, factor, sparse, symmetric=False, max_order=None, orderings=(None,)):
+        self.name = name
+        self.factor = factor
+        self.sparse = sparse
+        self.symmetric = symmetric
+        self.max_order = max_order
+        self.orderings = orderings
+
+    def applies(self, n, symmetric):
+        return (symmetric or not self.symmetric) and (self.max_order is None or n <= self.max_order)
+
+# name -> Backend, see register_backend
+BACKENDS = OrderedDict()
+
+def register_backend(backend):
+    BACKENDS[backend.name] = backend
+    return backend
+
+def _singular_check(pivots):
+    # SuperLU raises on an exactly singular matrix, LAPACK only warns: the dense backends raise the same
+    if np.any(pivots == 0):
+        raise RuntimeError('Factor is exactly singular')
+
+def _dense_lu(A, ordering):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', scipy.linalg.LinAlgWarning)
+        factor = scipy.linalg.lu_factor(A)
+    _singular_check(np.diag(factor[0]))
+    return lambda b: scipy.linalg.lu_solve(factor, b)
+
+def _dense_cholesky(A, ordering):
+    factor = scipy.linalg.cho_factor(A)     # raises LinAlgError unless A is positive definite
+    return lambda b: scipy.linalg.cho_solve(factor, b)
+
+def _dense_inverse(A, ordering):
+    # a single matrix-vector product per solve, the fastest for small systems solved many times; rejected (as
+    # LinAlgError) when A is too ill conditioned for the product to be accurate
+    inverse = np.linalg.inv(A)
+    if np.max(np.abs(A @ inverse - np.identity(A.shape[0])), initial=0.0) > INVERSE_TOLERANCE:
+        raise np.linalg.LinAlgError('inverse is inaccurate')
+    return lambda b: inverse @ b
+
+def _sparse_lu(A, ordering):
+    return scipy.sparse.linalg.splu(A, permc_spec=SUPERLU_ORDERINGS[ordering]).solve
+
+def _sparse_cholesky(A, ordering):
+    try:
+        return cholmod.cholesky(A, ordering_method=CHOLMOD_ORDERINGS[ordering])
+    except cholmod.CholmodNotPositiveDefiniteError as e:
+        raise np.linalg.LinAlgError(str(e))
+
+register_backend(Backend('dense_lu', _dense_lu, sparse=False))
+register_backend(Backend('dense_cholesky', _dense_cholesky, sparse=False, symmetric=True))
+register_backend(Backend('dense_inverse', _dense_inverse, sparse=False, max_order=INVERSE_MAX_ORDER))
+register_backend(Backend('sparse_lu', _sparse_lu, sparse=True, orderings=('amd', 'colamd', 'rcm')))
+if cholmod is not None:
+    register_backend(Backend('sparse_cholesky', _sparse_cholesky, sparse=True, symmetric=True,
+                             orderings=('amd', 'rcm')))
+
+def _factor(backend, A, ordering):
+    # backend.factor of A in the form the backend takes, with 'rcm' and permutation orderings applied here
+    if not backend.sparse:
+        return backend.factor(A.toarray() if issparse(A) else np.asarray(A), ordering)
+    A = scipy.sparse.csc_matrix(A)
+    if ordering is None or isinstance(ordering, str) and ordering != 'rcm':
+        return backend.factor(A, ordering)
+    perm = rcm_ordering(A) if isinstance(ordering, str) else np.asarray(ordering)
+    permuted_solve = backend.factor(A[perm, :][:, perm].tocsc(), 'natural')
+    def solve(b):
+        # A[p][:, p]*y = b[p], x[p] = y
+        y = permuted_solve(b[perm])
+        x = np.empty_like(y)
+        x[perm] = y
+        return x
+    return solve
+
+
+class SolverChoice:
+    # the backend (a name in BACKENDS) and ordering chosen for a matrix and the reason; after a trial, timings holds
+    # the estimated seconds (factorization + solves) of every candidate (backend, ordering), None for those rejected.
+    # ordering_name names an ordering given as a permutation (see select_backend)
+    def __init__(self, backend, ordering=None, reason='', timings=None, ordering_name=None):
+        self.backend = backend
+        self.ordering = ordering
+        self.reason = reason
+        self.timings = timings if timings is not None else {}
+        self.ordering_name = ordering_name if ordering_name is not None or not isinstance(ordering, str) else ordering
+
+    def __str__(self):
+        ordering = ' (%s ordering)' % self.ordering_name if BACKENDS[self.backend].sparse else ''
+        return '%s%s: %s' % (self.backend, ordering, self.reason)
+
+def choose_backend(A, solves=1, trial=False):
+    # The SolverChoice for A when it is solved solves times after being factored: dense backends for small or dense
+    # matrices (the inverse when it is small and solved at least as often as its order), Cholesky for real symmetric
+    # ones (it falls back to LU unless A is also positive definite, see Factorization), and sparse LU otherwise,
+    # with a minimum degree ordering of A + A' for (structurally) symmetric A and COLAMD for others.
+    # trial=True factors A with every applicable backend and ordering instead, and chooses the fastest one whose
+    # residual is within TRIAL_RESIDUAL.
+    n = A.shape[0]
+    symmetric = not np.iscomplexobj(A) and is_symmetric(A)
+    if trial:
+        return _trial_backend(A, solves, symmetric)
+    if n <= DENSE_MAX_ORDER or density(A) > DENSE_MIN_DENSITY:
+        if n <= INVERSE_MAX_ORDER and solves >= n:
+            return SolverChoice('dense_inverse', None, 'small, solved %d times' % solves)
+        if symmetric:
+            return SolverChoice('dense_cholesky', None, 'small or dense, symmetric')
+        return SolverChoice('dense_lu', None, 'small or dense')
+    if symmetric and 'sparse_cholesky' in BACKENDS:
+        return SolverChoice('sparse_cholesky', 'amd', 'sparse, symmetric')
+    if is_pattern_symmetric(A):
+        return SolverChoice('sparse_lu', 'amd', 'sparse, symmetric pattern')
+    return SolverChoice('sparse_lu', 'colamd', 'sparse')
+
+def _trial_backend(A, solves, symmetric):
+    n = A.shape[0]
+    b = np.random.default_rng(0).standard_normal((n, 1))
+    repeats = max(min(solves, 5), 1)
+    A_norm = abs(A).sum(axis=1).max() if issparse(A) else np.max(np.sum(np.abs(A), axis=1), initial=0.0)
+    (timings, best) = ({}, None)
+    for backend in BACKENDS.values():
+        if not backend.applies(n, symmetric) or (not backend.sparse and n > TRIAL_DENSE_MAX_ORDER):
+            continue
+        for ordering in backend.orderings:
+            with profiling.span('trial_factorize', backend=backend.name, ordering=ordering):
+                try:
+                    start = time.perf_counter()
+                    solve = _factor(backend, A, ordering)
+                    factored = time.perf_counter()
+                    for _ in range(repeats):
+                        x = solve(b)
+                    solved = time.perf_counter()
+                except (np.linalg.LinAlgError, RuntimeError):
+                    timings[(backend.name, ordering)] = None
+                    continue
+            residual = np.max(np.abs(A @ x - b)) / (A_norm*np.max(np.abs(x)) + np.max(np.abs(b)))
+            if not residual <= TRIAL_RESIDUAL:
+                timings[(backend.name, ordering)] = None
+                continue
+            cost = (factored - start) + solves*(solved - factored)/repeats
+            timings[(backend.name, ordering)] = cost
+            if best is None or cost < timings[best]:
+                best = (backend.name, ordering)
+    if best is None:
+        raise RuntimeError('no solver backend factors the matrix accurately')
+    return SolverChoice(best[0], best[1], 'fastest trial (%.3g ms)' % (1e3*timings[best]), timings)
+
+def select_backend(A, backend=None, solves=1, reuse=False):
+    # The SolverChoice for Factorization's backend argument (see there) on A. reuse=True resolves an 'amd' or 'rcm'
+    # ordering to its permutation of A, so that the choice factors other matrices of the same pattern (e.g. G + s*C
+    # for other s) without ordering them again.
+    if isinstance(backend, SolverChoice):
+        choice = backend
+    elif backend is None or backend == 'trial':
+        choice = choose_backend(A, solves, trial=backend == 'trial')
+    elif backend in BACKENDS:
+        choice = SolverChoice(backend, BACKENDS[backend].orderings[0], 'requested')
+    else:
+        raise ValueError('unknown solver backend %s (expected one of %s)' % (backend, ', '.join(BACKENDS)))
+    if reuse and BACKENDS[choice.backend].sparse and isinstance(choice.ordering, str) \
+            and choice.ordering in ('amd', 'rcm'):
+        perm = fill_reducing_ordering(A) if choice.ordering == 'amd' else rcm_ordering(A)
+        choice = SolverChoice(choice.backend, perm, choice.reason, choice.timings, choice.ordering)
+    logger.debug('solver backend for order %d: %s', A.shape[0], choice)
+    return choice
+
+
+class Factorization:
+    # Factors A once so that A*x = b can be solved repeatedly for many right hand sides, with one of BACKENDS:
+    # backend=None chooses it for A (see choose_backend), 'trial' by timing trial factorizations, otherwise it is
+    # a backend name or a SolverChoice made for a matrix of the same pattern; solves is the expected number of
+    # solves. ordering overrides the choice's fill reducing ordering ('natural' factors a sparse A in its given order,
+    # see fill_reducing_ordering). A Cholesky factorization or an inverse that fails, or does not apply to A, falls
+    # back to the LU of the same (dense or sparse) kind.
+    def __init__(self, A, ordering=None, backend=None, solves=1):
+        self.shape = A.shape
+        self.dtype = A.dtype
+        self.choice = select_backend(A, backend, solves)
+        self.ordering = ordering if ordering is not None else self.choice.ordering
+        with profiling.span('factorize', n=A.shape[0]):
+            backend = BACKENDS[self.choice.backend]
+            try:
+                symmetric = not backend.symmetric or (not np.iscomplexobj(A) and is_symmetric(A))
+                if not backend.applies(A.shape[0], symmetric):
+                    raise np.linalg.LinAlgError('%s does not apply' % backend.name)
+                self._solve = _factor(backend, A, self.ordering)
+            except np.linalg.LinAlgError as e:
+                fallback = BACKENDS['sparse_lu' if backend.sparse else 'dense_lu']
+                if fallback is backend:
+                    raise
+                logger.debug('%s: %s, falling back to %s', backend.name, e, fallback.name)
+                backend = fallback
+                self._solve = _factor(backend, A, self.ordering)
+        self.backend = backend.name
+        self.kind = backend.name
+
+    def solve(self, b):
+        if np.iscomplexobj(b) and not np.issubdtype(self.dtype, np.complexfloating):
+            # real factors, complex right hand side
+            return self._solve(np.real(b)) + 1j*self._solve(np.imag(b))
+        return self._solve(b)
+
+def factorize(A, ordering=None, backend=None, solves=1):
+    return Factorization(A, ordering, backend, solves)
+
+
+class UpdatableFactorization:
+    # A Factorization of A that follows changes of A (e.g. element edits, see Circuit.edit) by a
+    # Sherman-Morrison-Woodbury correction instead of factoring it again: with A_0 the matrix last factored and
+    # D = A - A_0 nonzero in the columns K only, A = A_0 + D[:, K]*E_K' and
+    # A^-1*b = y - W*S^-1*y[K], y = A_0^-1*b, W = A_0^-1*D[:, K], S = I + W[K, :]
+    # An update solves for the columns of D that changed since the previous update only. A is factored anew when
+    # len(K) exceeds max_rank, S is ill conditioned or the corrections of the solves expected per update (solves)
+    # would take longer than factoring did. The other arguments are those of Factorization.
+    def __init__(self, A, ordering=None, backend=None, solves=1, max_rank=MAX_UPDATE_RANK):
+        self.ordering = ordering
+        self.backend = backend
+        self.solves = solves
+        self.max_rank = max_rank
+        self.refactorizations = 0
+        self._refactor(A)
+
+    def _refactor(self, A):
+        self.A_0 = A
+        start = time.perf_counter()
+        self.factorization = Factorization(A, self.ordering, self.backend, self.solves)
+        self.factor_time = time.perf_counter() - start
+        self.refactorizations += 1
+        self.D = None
+        self.K = np.zeros(0, dtype=int)
+        self.W = np.zeros((A.shape[0], 0))
+        self._S_factor = None
+
+    @property
+    def shape(self):
+        return self.factorization.shape
+
+    @property
+    def rank(self):
+        return len(self.K)
+
+    @property
+    def kind(self):
+        return self.factorization.kind
+
+    @property
+    def choice(self):
+        return self.factorization.choice
+
+    def update(self, A):
+        # A replaces the matrix factored (same shape)
+        if A.shape != self.A_0.shape:
+            raise ValueError('shape %s of the update differs from %s' % (A.shape, self.A_0.shape))
+        with profiling.span('factorization_update', n=A.shape[0]):
+            D = scipy.sparse.csc_matrix(A - self.A_0)
+            D.eliminate_zeros()
+            K = np.flatnonzero(np.diff(D.indptr))
+            if len(K) > self.max_rank:
+                logger.debug('update of rank %d, factoring anew', len(K))
+                self._refactor(A)
+                return
+            # W's columns are kept for the columns of D that did not change
+            previous = { k : j for (j, k) in enumerate(self.K) }
+            reused = np.array([k in previous and (D[:, k] != self.D[:, k]).nnz == 0 for k in K], dtype=bool)
+            W = np.zeros((A.shape[0], len(K)), dtype=np.result_type(self.W.dtype, D.dtype, self.factorization.dtype))
+            W[:, reused] = self.W[:, [previous[k] for k in K[reused]]]
+            if not np.all(reused):
+                W[:, ~reused] = self.factorization.solve(D[:, K[~reused]].toarray())
+            S = np.identity(len(K)) + W[K, :]
+            if len(K) > 0 and not np.linalg.cond(S) <= MAX_UPDATE_CONDITION:
+                logger.debug('ill conditioned update, factoring anew')
+                self._refactor(A)
+                return
+            (self.D, self.K, self.W) = (D, K, W)
+            self._S_factor = scipy.linalg.lu_factor(S) if len(K) > 0 else None
+            if self._S_factor is not None:
+                start = time.perf_counter()
+                self._correct(np.zeros(A.shape[0], dtype=W.dtype))
+                if self.solves * (time.perf_counter() - start) > self.factor_time:
+                    logger.debug('update of rank %d slower than factoring, factoring anew', len(K))
+                    self._refactor(A)
+
+    def _correct(self, y):
+        return y - self.W @ scipy.linalg.lu_solve(self._S_factor, y[self.K])
+
+    def solve(self, b):
+        y = self.factorization.solve(b)
+        if self._S_factor is None:
+            return y
+        return self._correct(y)
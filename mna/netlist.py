@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import numpy as np
+
+from . import stimulus
+
+GROUND_NODE_NAMES = ('0', 'node0', 'gnd', 'ground')
+
+# SPICE engineering suffixes (case insensitive, anything after the suffix such as a unit is ignored)
+VALUE_SUFFIXES = { 't' : 1e12, 'g' : 1e9, 'meg' : 1e6, 'k' : 1e3, 'mil' : 25.4e-6,
+                   'm' : 1e-3, 'u' : 1e-6, 'n' : 1e-9, 'p' : 1e-12, 'f' : 1e-15 }
+
+# the tokens of a source's value: stimuli such as "PULSE(0 1 ...)" are one token
+_SOURCE_TOKEN_PATTERN = re.compile(r'[a-z]+\s*\([^)]*\)|\S+', re.IGNORECASE)
+
+_VALUE_PATTERN = re.compile(r'^([+-]?(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?)(meg|mil|[tgkmunpf])?[a-z]*$', re.IGNORECASE)
+
+
+def parse_value(token):
+    # parses a SPICE number such as 10p, 1.5k, 2meg, 1e-9 or 10pF
+    match = _VALUE_PATTERN.match(token)
+    if match is None:
+        raise ValueError('invalid value %s' % token)
+    (number, suffix) = match.groups()
+    value = float(number)
+    if suffix is not None:
+        value *= VALUE_SUFFIXES[suffix.lower()]
+    return value
+
+def parse_values(tokens):
+    # vectorized parse_value: plain numbers are converted in bulk, otherwise each distinct token is parsed once
+    tokens = np.asarray(tokens, dtype=str)
+    try:
+        return tokens.astype(float)
+    except ValueError:
+        (unique_tokens, inverse) = np.unique(tokens, return_inverse=True)
+        unique_values = np.array([parse_value(token) for token in unique_tokens])
+        return unique_values[inverse.reshape(-1)]
+
+def logical_lines(input_file, chunk_size=1 << 24):
+    # reads input_file in bulk chunks, yields the statements with comments stripped and '+' continuation lines joined
+    pending = None
+    remainder = ''
+    while True:
+        chunk = input_file.read(chunk_size)
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop() if chunk else ''
+        for line in lines:
+            line = line.split(';', 1)[0].strip()   # inline comment
+            if line == '' or line[0] == '#' or line[0] == '*':
+                continue
+            if line[0] == '+':
+                if pending is not None:
+                    pending = pending + ' ' + line[1:]
+                continue
+            if pending is not None:
+                yield pending
+            pending = line
+        if not chunk:
+            break
+    if pending is not None:
+        yield pending
+
+
+class Netlist:
+    # Flat element arrays of a SPICE netlist. Element i is names[i], of kind kinds[i] ('r', 'c', 'l', 'v' or 'i'),
+    # connected between node ids node1[i] and node2[i] (-1 is ground) with value values[i]. Node ids are assigned in
+    # the order of first appearance. Sources with a time-dependent specification have it in stimuli[name].
+    # Subcircuit instances (X lines) are kept apart in instances, their definitions (.subckt) in subcircuits[name].
+    def __init__(self, names, kinds, node1, node2, values, node_names, stimuli=None, instances=None,
+                 subcircuits=None):
+        self.names = names
+        self.kinds = kinds
+        self.node1 = node1
+        self.node2 = node2
+        self.values = values
+        self.node_names = node_names
+        self.stimuli = stimuli if stimuli is not None else {}
+        self.instances = instances if instances is not None else []
+        self.subcircuits = subcircuits if subcircuits is not None else {}
+        self.node_name_to_id = { name : -1 for name in GROUND_NODE_NAMES }
+        self.node_name_to_id.update((name, node_id) for (node_id, name) in enumerate(node_names))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def num_nodes(self):
+        return len(self.node_names)
+
+class Instance:
+    # subcircuit instance name of definition subckt, with its pins connected to node ids pins (-1 is ground)
+    def __init__(self, name, subckt, pins):
+        self.name = name
+        self.subckt = subckt
+        self.pins = pins
+
+
+class Subcircuit:
+    # a .subckt definition: its elements and instances in netlist, whose node ids 0 ... len(pin_names) - 1 are
+    # the pins (in order), the internal nodes follow
+    def __init__(self, name, pin_names, netlist):
+        self.name = name
+        self.pin_names = pin_names
+        self.netlist = netlist
+
+    @property
+    def num_pins(self):
+        return len(self.pin_names)
+
+
+def intern_nodes(node1_names, node2_names):
+    # maps node names to integer ids in order of first appearance (ground names map to -1), returns
+    # (node1_ids, node2_ids, node_names)
+    count = len(node1_names)
+    all_names = np.empty(2*count, dtype=object)
+    all_names[0::2] = node1_names
+    all_names[1::2] = node2_names
+    if count == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int), [])
+    all_names = all_names.astype(str)
+
+    (unique_names, first_index, inverse) = np.unique(all_names, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    is_ground = np.isin(unique_names, GROUND_NODE_NAMES)
+    order = np.argsort(np.where(is_ground, len(all_names), first_index), kind='stable')
+    unique_to_id = np.empty(len(unique_names), dtype=int)
+    unique_to_id[order] = np.arange(len(unique_names))
+    unique_to_id[is_ground] = -1
+    node_names = unique_names[order[:np.count_nonzero(~is_ground)]].tolist()
+
+    ids = unique_to_id[inverse]
+    return (ids[0::2], ids[1::2], node_names)
+
+def split_source_value(value):
+    # splits the "[[DC] value] [AC magnitude [phase]] [stimulus]" part of a source (in any order), returns
+    # (value or None, stimulus or None); the AC specification is dropped, frequency analysis drives every input
+    # source with a unit magnitude (an AC only source is at DC 0)
+    tokens = _SOURCE_TOKEN_PATTERN.findall(value)
+    (dc_value, stimulus_spec, ac) = (None, None, False)
+    i = 0
+    while i < len(tokens):
+        keyword = tokens[i].lower()
+        if keyword == 'ac':
+            (ac, i) = (True, i + 1)
+            for _ in range(2):  # the magnitude and phase, both optional
+                if i < len(tokens) and not tokens[i][0].isalpha():
+                    i += 1
+            continue
+        if keyword == 'dc':
+            i += 1
+            if i == len(tokens) or tokens[i][0].isalpha():
+                raise ValueError('missing DC value')
+        if tokens[i][0].isalpha():
+            if stimulus_spec is not None:
+                raise ValueError('more than one waveform (%s and %s)' % (stimulus_spec, tokens[i]))
+            stimulus_spec = tokens[i]
+        else:
+            if dc_value is not None:
+                raise ValueError('more than one value (%s and %s)' % (dc_value, tokens[i]))
+            dc_value = tokens[i]
+        i += 1
+    if dc_value is None and stimulus_spec is None:
+        if not ac:
+            raise ValueError('missing value')
+        dc_value = '0'
+    return (dc_value, stimulus_spec)
+
+class _Scope:
+    # the statements of the top level netlist or of one .subckt definition, as read; the data files of the sources
+    # (PWL(FILE=...)) are relative to directory
+    def __init__(self, name=None, pin_names=(), directory=''):
+        self.name = name
+        self.directory = directory
+        self.pin_names = list(pin_names)
+        self.names = []
+        self.node1_names = []
+        self.node2_names = []
+        self.value_tokens = []
+        self.stimuli = {}
+        self.instances = []     # (name, pin node names, subckt name)
+
+    def add_element(self, line):
+        params = line.split(None, 3)
+        if len(params) != 4:
+            raise ValueError('cannot parse "%s" (expected: name node1 node2 value)' % line)
+        value = params[3]
+        if params[0][0].lower() in ('v', 'i'):
+            (value, stimulus_spec) = split_source_value(value)
+            if stimulus_spec is not None:
+                self.stimuli[params[0]] = stimulus.parse_stimulus(stimulus_spec, self.directory)
+                if value is None:
+                    value = repr(float(self.stimuli[params[0]](0.0)))
+        elif len(value.split()) != 1:
+            raise ValueError('cannot parse "%s" (expected: name node1 node2 value)' % line)
+        self.names.append(params[0])
+        self.node1_names.append(params[1])
+        self.node2_names.append(params[2])
+        self.value_tokens.append(value)
+
+    def add_instance(self, line):
+        params = line.split()
+        if len(params) < 3:
+            raise ValueError('cannot parse "%s" (expected: name node1 ... nodeN subckt)' % line)
+        self.instances.append((params[0], params[1:-1], params[-1]))
+
+    def netlist(self, subcircuits):
+        # the pins (then the nodes of the instances) are interned along with the element nodes, so the pins of a
+        # definition get the first node ids
+        instance_nodes = [node_name for (name, pin_names, subckt) in self.instances for node_name in pin_names]
+        num_pins = len(self.pin_names)
+        (node1, node2, node_names) = intern_nodes(self.pin_names + self.node1_names + instance_nodes,
+                                                  self.pin_names + self.node2_names + instance_nodes)
+        num_elements = len(self.names)
+        instance_ids = node1[num_pins + num_elements:]
+        (node1, node2) = (node1[num_pins:num_pins + num_elements], node2[num_pins:num_pins + num_elements])
+
+        instances = []
+        offset = 0
+        for (name, pin_names, subckt) in self.instances:
+            if subckt not in subcircuits:
+                raise ValueError('%s: unknown subcircuit %s' % (name, subckt))
+            if len(pin_names) != subcircuits[subckt].num_pins:
+                raise ValueError('%s: %d nodes for the %d pins of %s'
+                                 % (name, len(pin_names), subcircuits[subckt].num_pins, subckt))
+            instances.append(Instance(name, subckt, instance_ids[offset:offset + len(pin_names)]))
+            offset += len(pin_names)
+
+        kinds = np.array([name[0].lower() for name in self.names], dtype='<U1')
+        values = parse_values(self.value_tokens) if len(self.value_tokens) > 0 else np.zeros(0)
+        return Netlist(self.names, kinds, node1, node2, values, node_names, self.stimuli, instances, subcircuits)
+
+def read_netlist(filename, chunk_size=1 << 24):
+    # .subckt NAME PIN1 ... PINn / .ends define subcircuits (anywhere in the file, not nested), which
+    # X<name> NODE1 ... NODEn NAME lines instantiate; other directives are ignored
+    top = _Scope(directory=os.path.dirname(filename))
+    scope = top
+    definitions = []
+    with open(filename, 'r') as input_file:
+        for line in logical_lines(input_file, chunk_size):
+            if line[0] == '.':
+                directive = line.split()
+                keyword = directive[0].lower()
+                if keyword == '.subckt':
+                    if scope is not top:
+                        raise ValueError('nested .subckt definitions are not supported (in %s)' % scope.name)
+                    if len(directive) < 2:
+                        raise ValueError('cannot parse "%s" (expected: .subckt name pin1 ... pinN)' % line)
+                    if any(pin in GROUND_NODE_NAMES for pin in directive[2:]):
+                        raise ValueError('%s: ground cannot be a pin' % directive[1])
+                    scope = _Scope(directive[1], directive[2:], top.directory)
+                    definitions.append(scope)
+                elif keyword == '.ends':
+                    if scope is top:
+                        raise ValueError('.ends without .subckt')
+                    scope = top
+                continue    # other directives are not supported
+            if line[0] in ('x', 'X'):
+                scope.add_instance(line)
+            else:
+                scope.add_element(line)
+    if scope is not top:
+        raise ValueError('missing .ends of %s' % scope.name)
+
+    # definitions are resolved once all are read, so instances may precede the definition they use
+    subcircuits = {}
+    for definition in definitions:
+        if definition.name in subcircuits:
+            raise ValueError('subcircuit %s defined twice' % definition.name)
+        subcircuits[definition.name] = Subcircuit(definition.name, definition.pin_names, None)
+    for definition in definitions:
+        subcircuits[definition.name].netlist = definition.netlist(subcircuits)
+    return top.netlist(subcircuits)
+
+def edit_netlist(netlist, set_values=None, add=(), remove=()):
+    # A copy of netlist with resistors, capacitors and inductors edited (in this order): set_values maps element
+    # names to new values, remove lists the names of elements to delete and add lists (name, node1, node2, value)
+    # tuples of new elements between existing nodes (by name), which are appended. Values may be SPICE numbers
+    # ('10p'), the kind of a new element is the first letter of its name.
+    set_values = set_values if set_values is not None else {}
+    index = { name : i for (i, name) in enumerate(netlist.names) }
+    for name in list(set_values) + list(remove):
+        if name not in index:
+            raise ValueError('unknown element %s' % name)
+        if netlist.kinds[index[name]] not in ('r', 'c', 'l'):
+            raise ValueError('%s: only resistors, capacitors and inductors can be edited' % name)
+    if len(set(remove)) != len(remove) or any(name in set_values for name in remove):
+        raise ValueError('elements removed twice or both changed and removed')
+
+    values = netlist.values.copy()
+    for (name, value) in set_values.items():
+        values[index[name]] = _element_value(name, value)
+    keep = np.ones(len(netlist), dtype=bool)
+    keep[[index[name] for name in remove]] = False
+
+    (names, kinds, node1, node2, new_values) = ([], [], [], [], [])
+    for (name, node1_name, node2_name, value) in add:
+        if name in index and keep[index[name]] or name in names:
+            raise ValueError('element %s already exists' % name)
+        if name[0].lower() not in ('r', 'c', 'l'):
+            raise ValueError('%s: only resistors, capacitors and inductors can be added' % name)
+        for node_name in (node1_name, node2_name):
+            if node_name not in netlist.node_name_to_id:
+                raise ValueError('%s: unknown node %s (new elements connect existing nodes)' % (name, node_name))
+        if netlist.node_name_to_id[node1_name] == netlist.node_name_to_id[node2_name]:
+            raise ValueError('%s: both ends on node %s' % (name, node1_name))
+        names.append(name)
+        kinds.append(name[0].lower())
+        node1.append(netlist.node_name_to_id[node1_name])
+        node2.append(netlist.node_name_to_id[node2_name])
+        new_values.append(_element_value(name, value))
+
+    return Netlist([name for (name, kept) in zip(netlist.names, keep) if kept] + names,
+                   np.concatenate((netlist.kinds[keep], np.array(kinds, dtype='<U1'))),
+                   np.concatenate((netlist.node1[keep], np.array(node1, dtype=int))),
+                   np.concatenate((netlist.node2[keep], np.array(node2, dtype=int))),
+                   np.concatenate((values[keep], np.array(new_values, dtype=float))),
+                   netlist.node_names, netlist.stimuli, netlist.instances, netlist.subcircuits)
+
+def _element_value(name, value):
+    value = parse_value(value) if isinstance(value, str) else float(value)
+    if not np.isfinite(value) or value <= 0:
+        raise ValueError('%s: invalid value %g (expected a positive value)' % (name, value))
+    return value
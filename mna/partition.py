@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+from . import linalg
+
+logger = logging.getLogger(__name__)
+
+# below this many states a set is bisected by its order instead of its Fiedler vector
+MIN_SPECTRAL_STATES = 16
+# Laplacian eigenvectors tried for every bisection
+SPECTRAL_VECTORS = 3
+# a bisection may deviate this much (relative) from the proportional split to cut fewer couplings
+BALANCE_TOLERANCE = 0.25
+
+
+def state_graph(G, C):
+    # symmetric 0/1 adjacency (CSR, without the diagonal) of the states coupled through G or C; unweighted, since
+    # conductances and capacitances are on very different scales
+    A = abs(scipy.sparse.csr_matrix(G)) + abs(scipy.sparse.csr_matrix(C))
+    A = (A + A.transpose()).tocsr()
+    A.setdiag(0)
+    A.eliminate_zeros()
+    A.data[:] = 1.0
+    return A
+
+def _spectral_orders(A):
+    # orderings of the states of the connected graph A by the eigenvectors of the smallest nonzero eigenvalues of
+    # its Laplacian (the Fiedler vector and the next SPECTRAL_VECTORS - 1, which matter where they are degenerate, as
+    # in symmetric trees), found by shift-invert around a small negative shift
+    n = A.shape[0]
+    if n < MIN_SPECTRAL_STATES:
+        return [np.arange(n)]
+    degrees = np.asarray(A.sum(axis=1)).ravel()
+    laplacian = (scipy.sparse.diags(degrees) - A).tocsc()
+    k = min(SPECTRAL_VECTORS + 1, n - 1)
+    (values, vectors) = scipy.sparse.linalg.eigsh(laplacian, k=k, sigma=-1e-3, which='LM', tol=1e-6)
+    return [np.argsort(vectors[:, i], kind='stable') for i in np.argsort(values)[1:]]
+
+def _sweep_cut(A, order, split):
+    # the split of order (into order[:k] and order[k:]) within BALANCE_TOLERANCE of split that cuts the fewest
+    # edges of A, and the number of edges it cuts: an edge between the states ranked i < j is cut by every k in (i, j]
+    n = len(order)
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n)
+    A = scipy.sparse.triu(A, k=1, format='coo')
+    (first, last) = (np.minimum(rank[A.row], rank[A.col]), np.maximum(rank[A.row], rank[A.col]))
+    cuts = np.cumsum(np.bincount(first + 1, minlength=n + 1) - np.bincount(last + 1, minlength=n + 1))
+    slack = int(BALANCE_TOLERANCE * min(split, n - split))
+    lo = max(split - slack, 1)
+    hi = min(split + slack, n - 1)
+    if lo > hi:
+        return (split, cuts[split])
+    k = lo + int(np.argmin(cuts[lo:hi+1]))
+    return (k, cuts[k])
+
+def _bisect(A, states, num_partitions, labels, first_label):
+    # assigns labels first_label ... first_label + num_partitions - 1 to states, splitting them recursively in
+    # proportion to the number of partitions on either side
+    if num_partitions == 1 or len(states) <= 1:
+        labels[states] = first_label
+        return
+    left = num_partitions // 2
+    split = len(states) * left // num_partitions
+    A_s = A[states, :][:, states]
+    (num_components, component) = scipy.sparse.csgraph.connected_components(A_s, directed=False)
+    components = [np.flatnonzero(component == c) for c in np.argsort(-np.bincount(component), kind='stable')]
+    # component by component (largest first): the split only cuts the component it falls into, along the
+    # spectral ordering of that component that cuts the fewest edges
+    (start, best) = (0, None)
+    for members in components:
+        if start <= split < start + len(members):
+            A_c = A_s[members, :][:, members]
+            for order in _spectral_orders(A_c):
+                (k, cut) = _sweep_cut(A_c, order, split - start)
+                if best is None or cut < best[2]:
+                    best = (members[order], k, cut)
+            break
+        start += len(members)
+    order = np.concatenate(components)
+    if best is not None:
+        order[start:start + len(best[0])] = best[0]
+        split = start + best[1]
+    _bisect(A, states[order[:split]], left, labels, first_label)
+    _bisect(A, states[order[split:]], num_partitions - left, labels, first_label + left)
+
+def partition_states(G, C, num_partitions, port_states=()):
+    # Splits the states of G*x + C*x' into num_partitions interiors that are only coupled through boundary states:
+    # the state graph is bisected recursively, each time at the sweep cut of its low Laplacian eigenvectors that cuts
+    # the fewest couplings (spectral bisection, which keeps the cuts small for trees, lines and meshes alike), and
+    # of every pair of coupled states in different partitions the one in the later partition becomes a boundary
+    # state. port_states (e.g. those of sources and outputs) are always boundary states.
+    # Returns labels: the partition of each state, -1 for boundary states.
+    A = state_graph(G, C)
+    n = A.shape[0]
+    labels = np.zeros(n, dtype=int)
+    _bisect(A, np.arange(n), max(1, min(num_partitions, n)), labels, 0)
+
+    A = A.tocoo()
+    crossing = labels[A.row] < labels[A.col]
+    boundary = np.zeros(n, dtype=bool)
+    boundary[A.col[crossing]] = True
+    boundary[np.asarray(port_states, dtype=int)] = True
+    labels[boundary] = -1
+
+    # a state left without conductance to its own interior (e.g. the current of an inductor between two boundary
+    # nodes) would make the interior's G singular; it joins the boundary, until there are none
+    G = abs(scipy.sparse.coo_matrix(G))
+    while True:
+        inside = (labels[G.row] == labels[G.col]) & (labels[G.row] >= 0)
+        coupled = np.zeros(n, dtype=bool)
+        coupled[G.row[inside & (G.data != 0)]] = True
+        isolated = (labels >= 0) & ~coupled
+        if not np.any(isolated):
+            break
+        labels[isolated] = -1
+    logger.info('partitioned %d states into %d partitions and %d boundary states', n, num_partitions,
+                np.count_nonzero(labels < 0))
+    return labels
+
+def model_port_states(model):
+    # the states a reduction has to keep: those excited by the inputs and internal sources and those observed
+    (G, C, b) = model.mna_GCb_matrices
+    columns = [model.input_B_matrix, model.internal_b_matrix, b, model.input_B_vector] + list(model.output_L_vectors)
+    touched = np.zeros(b.shape[0], dtype=bool)
+    for column in columns:
+        column = column.toarray() if linalg.issparse(column) else np.asarray(column)
+        touched |= np.any(column.reshape(b.shape[0], -1) != 0, axis=1)
+    return np.flatnonzero(touched)
@@ -1,54 +1,164 @@
 #!/usr/bin/env python3
 
+import os
+import logging
+from multiprocessing import Pool
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 
-from .circuit_model import CircuitModel
+from .circuit_model import CircuitModel, StateSpaceModel
+from . import linalg
+from . import frequency
+from . import partition
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+
+def block_orthonormalize(V, W, deflation_tol=1e-10):
+    # Block classical Gram-Schmidt of W against the orthonormal columns of V, applied twice (reorthogonalization),
+    # followed by a pivoted QR of the remainder. Columns that are (numerically) in span(V) or linearly dependent
+    # within W are deflated, so the returned Q may have fewer columns than W.
+    scale = np.max(np.linalg.norm(W, axis=0), initial=0.0)
+    if scale == 0.0:
+        return W[:, 0:0]
+    for _ in range(2):
+        W = W - V @ (V.transpose() @ W)
+    (Q, R, _) = scipy.linalg.qr(W, mode='economic', pivoting=True)
+    rank = np.count_nonzero(np.abs(np.diag(R)) > deflation_tol*scale)
+    Q = Q[:, :rank]
+    # the QR amplifies what is left of span(V) in weakly independent columns, orthogonalize once more
+    Q = Q - V @ (V.transpose() @ Q)
+    (Q, _) = np.linalg.qr(Q)
+    return Q
+
+def block_arnoldi(G_factor, C, R, q):
+    # Orthonormal basis of the block Krylov subspace
+    # Kr(A, R, q) = span(R, A*R, A^2*R, ...), A = -G^-1*C, R = G^-1*ports
+    # with at most q columns, G_factor is G factored once (see linalg.factorize)
+    n = R.shape[0]
+    Vq = np.zeros((n, q))
+    k = 0   # columns of Vq filled so far
+
+    W = R
+    while k < q:
+        with profiling.span('krylov_iteration'):
+            Q = block_orthonormalize(Vq[:, :k], W)
+            if Q.shape[1] == 0:
+                break   # the Krylov subspace is exhausted (invariant)
+            m = min(Q.shape[1], q - k)
+            Vq[:, k:k+m] = Q[:, :m]
+            W = -G_factor.solve(C @ Vq[:, k:k+m])
+            k += m
+    return Vq[:, :k]
+
+
+def port_prima_basis(G, C, ports, q, s0=0.0, factorization=None):
+    # PRIMA projection basis of G*x + C*x' driven through the columns of ports: at most q orthonormal columns
+    # spanning the moments of (G + s0*C)^-1*ports around s0 (one solve per column, which linalg.factorize weighs when
+    # choosing the solver backend); factorization is G + s0*C already factored
+    with profiling.span('factorize_ports', ports=ports.shape[1]):
+        K_factor = (factorization if factorization is not None
+                    else linalg.factorize(linalg.sparsify(G + s0*C if s0 != 0 else G), solves=q))
+        R = K_factor.solve(ports)
+    return block_arnoldi(K_factor, C, R, q)
+
+def circuit_ports(circuit):
+    # one port per input source and per internal source
+    ports = np.hstack((circuit.input_B_matrix, circuit.internal_b_matrix))
+    if ports.shape[1] == 0:
+        (G, C, b) = circuit.mna_GCb_matrices
+        ports = b + circuit.input_B_vector
+    return ports
 
 
 class PrimaReducedCircuit(CircuitModel):
+    is_reduced = True
+
     def __init__(self, q, full_circuit):
         (G, C, b) = full_circuit.mna_GCb_matrices
-        B = full_circuit.input_B_vector
-        L_list = full_circuit.output_L_vectors
         self.internal_sources = full_circuit.internal_source_names
         self.output_nodes = full_circuit.output_node_names
+        self.q = q
+        ports = circuit_ports(full_circuit)
+
+        with profiling.span('prima', q=q):
+            # G is factored once and reused for the starting block and every Arnoldi iteration, and kept for update
+            self.G_factor = linalg.UpdatableFactorization(linalg.sparsify(G), solves=q)
+            Vq = port_prima_basis(G, C, ports, q, factorization=self.G_factor)
 
-        n = G.shape[0]  # Order of original system
+            self._project(Vq, full_circuit)
 
-        R = np.linalg.solve(G, b+B)
-        (Q, X) = np.linalg.qr(R)
+    def update(self, full_circuit):
+        # reduces full_circuit again after it was edited (see Circuit.edit), with the factorization of G corrected
+        # by a low rank update (see linalg.UpdatableFactorization) instead of factored anew
+        (G, C, b) = full_circuit.mna_GCb_matrices
+        with profiling.span('prima_update', q=self.q):
+            G = linalg.sparsify(G)
+            if self.G_factor is None or self.G_factor.shape != G.shape:
+                self.G_factor = linalg.UpdatableFactorization(G, solves=self.q)
+            else:
+                self.G_factor.update(G)
+            Vq = port_prima_basis(G, C, circuit_ports(full_circuit), self.q, factorization=self.G_factor)
+            self._project(Vq, full_circuit)
 
-        # Generate first block V_0 of projection matrix
-        Vq = np.zeros((n, q+1))
-        Vq[:, 0:1] = Q
+    @staticmethod
+    def from_projection(Vq, Gq, Cq, bq, Bq, Bq_matrix, bq_matrix, Lq_list, internal_sources, output_nodes,
+                        input_stimuli=None):
+        # rebuilds a reduced circuit from previously computed matrices (see cache.ModelCache) without reducing again
+        reduced_circuit = PrimaReducedCircuit.__new__(PrimaReducedCircuit)
+        reduced_circuit.q = Vq.shape[1]
+        reduced_circuit.G_factor = None
+        reduced_circuit.Vq = Vq
+        reduced_circuit.Gq = Gq
+        reduced_circuit.Cq = Cq
+        reduced_circuit.bq = bq
+        reduced_circuit.Bq = Bq
+        reduced_circuit.Bq_matrix = Bq_matrix
+        reduced_circuit.bq_matrix = bq_matrix
+        reduced_circuit.Lq_list = list(Lq_list)
+        reduced_circuit.internal_sources = list(internal_sources)
+        reduced_circuit.output_nodes = list(output_nodes)
+        reduced_circuit.stimuli = (list(input_stimuli) if input_stimuli is not None
+                                   else [None] * Bq_matrix.shape[1])
+        return reduced_circuit
 
-        # Arnoldi iteration
-        for j in range(1, q):
-            Vq[:,j] = -np.linalg.solve(G, np.matmul(C, Vq[:,j-1]))
-            # Modified Gram-Schmidt orthonormalization
-            for i in range(j):
-                delta = np.matmul(Vq[:,i].transpose(), Vq[:,j])
-                Vq[:,j] = Vq[:,j] - delta*Vq[:,i]
-            (Q, X) = np.linalg.qr(Vq[:,j:j+1])
-            Vq[:,j:j+1] = Q
-        Vq = Vq[:, 0:q]
-        # print(Vq.shape)
+    def _project(self, Vq, full_circuit):
+        with profiling.span('project', q=Vq.shape[1]):
+            self._project_matrices(Vq, full_circuit)
+
+    def _project_matrices(self, Vq, full_circuit):
+        self.internal_sources = full_circuit.internal_source_names
+        self.output_nodes = full_circuit.output_node_names
+        self.stimuli = full_circuit.input_stimuli
+        (G, C, b) = full_circuit.mna_GCb_matrices
+        B = full_circuit.input_B_vector
+        L_list = full_circuit.output_L_vectors
+        self.Vq = Vq
 
         # Matrices projection
-        self.Gq = Vq.transpose() @ G @ Vq
-        self.Cq = Vq.transpose() @ C @ Vq
+        # (G and C may be scipy.sparse matrices, so they are applied to Vq first)
+        self.Gq = Vq.transpose() @ (G @ Vq)
+        self.Cq = Vq.transpose() @ (C @ Vq)
         self.bq = Vq.transpose() @ b
         self.Bq = Vq.transpose() @ B
+        self.Bq_matrix = Vq.transpose() @ full_circuit.input_B_matrix
+        self.bq_matrix = Vq.transpose() @ full_circuit.internal_b_matrix
         self.Lq_list = []
         for L in L_list:
             Lq = Vq.transpose() @ L
             Lq.setflags(write=False)
             self.Lq_list.append(Lq)
 
+        self.Vq.setflags(write=False)
         self.Gq.setflags(write=False)
         self.Cq.setflags(write=False)
         self.bq.setflags(write=False)
         self.Bq.setflags(write=False)
+        self.Bq_matrix.setflags(write=False)
+        self.bq_matrix.setflags(write=False)
 
     @property
     def mna_GCb_matrices(self):
@@ -58,6 +168,18 @@ class PrimaReducedCircuit(CircuitModel):
     def input_B_vector(self):
         return self.Bq
 
+    @property
+    def input_B_matrix(self):
+        return self.Bq_matrix
+
+    @property
+    def input_stimuli(self):
+        return self.stimuli
+
+    @property
+    def internal_b_matrix(self):
+        return self.bq_matrix
+
     @property
     def output_L_vectors(self):
         return self.Lq_list
@@ -75,3 +197,172 @@ class PrimaReducedCircuit(CircuitModel):
             print('G(%s) =\n' % str(self.Gq.shape), self.Gq)
             print('C(%s) =\n' % str(self.Cq.shape), self.Cq)
             print('b(%s) =\n' % str(self.bq.shape), self.bq)
+
+
+class _ExpansionPoint:
+    # rational Krylov sequence (G + s0*C)^-1*ports, ((G + s0*C)^-1*C)*(G + s0*C)^-1*ports, ... around one point s0
+    def __init__(self, s0, G, C, ports):
+        self.s0 = s0
+        self.C = C
+        self.K_factor = linalg.factorize(linalg.sparsify(G + s0*C))
+        self.next_block = self.K_factor.solve(ports)
+
+    def advance(self, basis_block):
+        self.next_block = -self.K_factor.solve(self.C @ basis_block)
+
+
+class MultiPointPrimaReducedCircuit(PrimaReducedCircuit):
+    # PRIMA over several expansion points (rational Krylov). The projection basis is grown one block at a time, each
+    # time at the expansion point closest to the check frequency where the reduced model is currently worst, until
+    # the largest error of H(s) at the check frequencies (relative to each output's peak |H|) is within tol.
+    # Without expansion_points, points are added adaptively: s0 = 0 first, then s0 = j*w at the worst check
+    # frequency whenever that frequency is more than a decade away from every existing point.
+    def __init__(self, full_circuit, w_lo, w_hi, tol=1e-3, max_order=200, expansion_points=None, num_check=40,
+                 processes=None):
+        self.parameters = (w_lo, w_hi, tol, max_order, expansion_points, num_check, processes)
+        (G, C, b) = full_circuit.mna_GCb_matrices
+        B = full_circuit.input_B_vector
+        L_list = full_circuit.output_L_vectors
+        L = np.hstack(L_list) if len(L_list) > 0 else B
+        ports = circuit_ports(full_circuit)
+        n = G.shape[0]
+
+        w_check = np.logspace(w_lo, w_hi, num_check)
+        with profiling.span('check_response', points=num_check):
+            H_full = frequency.frequency_response(G, C, B, L, 1j*w_check, processes)
+        H_scale = np.maximum(np.max(np.abs(H_full), axis=0), np.finfo(float).tiny)
+
+        adaptive = expansion_points is None
+        points = [_ExpansionPoint(s0, G, C, ports) for s0 in (expansion_points or [0.0])]
+
+        Vq = np.zeros((n, 0))
+        exhausted = []  # expansion points whose Krylov subspace is already contained in Vq
+        self.error_estimate = np.inf
+        w_worst = w_check[0]
+        while Vq.shape[1] < max_order and len(points) > 0:
+            with profiling.span('krylov_iteration'):
+                distance = lambda s0: abs(np.log10(max(abs(s0), 10.0**w_lo)) - np.log10(w_worst))
+                point = min(points, key=lambda p: distance(p.s0))
+                if adaptive and distance(point.s0) > 1 and 1j*w_worst not in exhausted:
+                    point = _ExpansionPoint(1j*w_worst, G, C, ports)
+                    points.append(point)
+
+                # complex moments contribute their real and imaginary parts, the projection (and Gq, Cq) stays real
+                W = point.next_block
+                if np.iscomplexobj(W):
+                    W = np.hstack((W.real, W.imag))
+                Q = block_orthonormalize(Vq, W)[:, :max_order - Vq.shape[1]]
+                if Q.shape[1] == 0:
+                    points.remove(point)
+                    exhausted.append(point.s0)
+                    continue
+                Vq = np.hstack((Vq, Q))
+                point.advance(Q)
+
+                self._project(Vq, full_circuit)
+                H_reduced = frequency.PoleResidueModel(self.Gq, self.Cq, self.Bq, np.hstack(self.Lq_list) if len(L_list) > 0
+                                                       else self.Bq).evaluate(1j*w_check)
+                error = np.max(np.abs(H_reduced - H_full) / H_scale, axis=1)
+                self.error_estimate = np.max(error)
+                if self.error_estimate <= tol:
+                    break
+                w_worst = w_check[np.argmax(error)]
+
+        self.expansion_points = [p.s0 for p in points] + exhausted
+        self._project(Vq, full_circuit)
+
+    def update(self, full_circuit):
+        # the expansion points and the order depend on the edited response, it is reduced anew
+        self.__init__(full_circuit, *self.parameters)
+
+
+def interior_task(G, C, interior, boundary, q, s0=0.0):
+    # the arguments of interior_basis for the states interior of G*x + C*x' (sparse), with the boundary states
+    # coupled to them (the columns of G_ib and C_ib) as ports; the order is never below one full block of ports (a
+    # smaller one would lose some couplings altogether)
+    G_ib = G[interior, :][:, boundary]
+    C_ib = C[interior, :][:, boundary]
+    coupled = np.flatnonzero(np.asarray((abs(G_ib) + abs(C_ib)).sum(axis=0)).ravel() > 0)
+    ports = np.hstack((G_ib[:, coupled].toarray(), C_ib[:, coupled].toarray()))
+    G_ii = G[interior, :][:, interior].tocsc()
+    C_ii = C[interior, :][:, interior].tocsc()
+    return (G_ii, C_ii, ports, max(q, ports.shape[1]), s0)
+
+def interior_basis(args):
+    # PRIMA basis of one interior (see interior_task), driven by its couplings to the boundary states. An interior
+    # without a DC path of its own (coupled to the boundary only through capacitors or inductors) has a singular
+    # G_ii; it is expanded around a small real s0 instead, where G_ii + s0*C_ii is regular: 1e-3*|G_ii|/|C_ii|, well
+    # below the fastest time constants of the interior (an s0 of that order loses the low frequency response).
+    (G_ii, C_ii, ports, q, s0) = args
+    with profiling.span('interior_reduce', n=G_ii.shape[0]):
+        try:
+            return port_prima_basis(G_ii, C_ii, ports, q, s0)
+        except RuntimeError:
+            if s0 != 0:
+                raise
+            s0 = 1e-3 * scipy.sparse.linalg.norm(G_ii, 1) / scipy.sparse.linalg.norm(C_ii, 1)
+            logger.info('singular interior (%d states), expanding around s0 = %g', G_ii.shape[0], s0)
+            return port_prima_basis(G_ii, C_ii, ports, q, s0)
+
+class PartitionedPrimaReducedCircuit(StateSpaceModel):
+    # PRIMA by domain decomposition: the states are split into partitions that are only coupled through boundary
+    # states (see partition.partition_states; the states of sources and outputs are boundary states). The interior
+    # of every partition is reduced on its own (see interior_task), in parallel worker processes, to order q with its
+    # couplings to the boundary as ports; the boundary states are kept as they are:
+    # V = blockdiag(V_1, ..., V_k, I)
+    # Gq = V'*G*V, Cq = V'*C*V, ... keep the coupling between the blocks (and passivity, V is orthonormal), and
+    # stay sparse, so the reduced model is simulated like any other sparse model.
+    def __init__(self, full_circuit, q, num_partitions=None, processes=None, s0=0.0):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if num_partitions is None:
+            num_partitions = max(processes, 2)
+        (G, C, b) = full_circuit.mna_GCb_matrices
+        G = scipy.sparse.csr_matrix(G)
+        C = scipy.sparse.csr_matrix(C)
+        n = G.shape[0]
+
+        with profiling.span('partitioned_prima', q=q, partitions=num_partitions):
+            with profiling.span('partition'):
+                labels = partition.partition_states(G, C, num_partitions, partition.model_port_states(full_circuit))
+            boundary = np.flatnonzero(labels < 0)
+            interiors = [np.flatnonzero(labels == k) for k in range(num_partitions)]
+            interiors = [interior for interior in interiors if len(interior) > 0]
+
+            tasks = [interior_task(G, C, interior, boundary, q, s0) for interior in interiors]
+
+            if processes <= 1 or len(tasks) <= 1:
+                bases = [interior_basis(task) for task in tasks]
+            else:
+                # the per-partition spans of the workers are not collected, only the pool as a whole
+                with profiling.span('partition_pool', processes=processes):
+                    with Pool(processes=min(processes, len(tasks))) as pool:
+                        bases = pool.map(interior_basis, tasks)
+
+            # V = blockdiag(V_1, ..., V_k, I) with the rows in the original state order
+            (rows, cols, values) = ([], [], [])
+            offset = 0
+            for (interior, V_k) in zip(interiors, bases):
+                (i, j) = np.meshgrid(interior, offset + np.arange(V_k.shape[1]), indexing='ij')
+                rows.append(i.ravel())
+                cols.append(j.ravel())
+                values.append(V_k.ravel())
+                offset += V_k.shape[1]
+            rows.append(boundary)
+            cols.append(offset + np.arange(len(boundary)))
+            values.append(np.ones(len(boundary)))
+            order = offset + len(boundary)
+            self.Vq = scipy.sparse.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                              shape=(n, order))
+            self.partition_labels = labels
+            self.partition_orders = [V_k.shape[1] for V_k in bases]
+
+            with profiling.span('project', q=order):
+                Vt = self.Vq.transpose().tocsr()
+                project = lambda M: (Vt @ M).toarray() if linalg.issparse(M) else Vt @ np.asarray(M)
+                super().__init__((Vt @ G @ self.Vq).tocsc(), (Vt @ C @ self.Vq).tocsc(), project(b),
+                                 project(full_circuit.input_B_vector), project(full_circuit.input_B_matrix),
+                                 project(full_circuit.internal_b_matrix),
+                                 [project(L) for L in full_circuit.output_L_vectors],
+                                 full_circuit.internal_source_names, full_circuit.output_node_names,
+                                 full_circuit.input_stimuli, is_reduced=True)
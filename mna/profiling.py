@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+import contextlib
+try:
+    import resource
+except ImportError:     # not available on Windows, spans are then recorded without their RSS
+    resource = None
+
+# tracemalloc.reset_peak is new in Python 3.9; without it, the peaks of the spans are sampled (see _traced_memory)
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+
+# the profiler that span() reports to, None when profiling is off (spans then cost one function call)
+_active_profiler = None
+
+
+class SpanRecord:
+    # one finished span: its name, the names of the enclosing spans (path), start time and duration in seconds
+    # (relative to the profiler's start), the process's peak RSS in bytes at its end, the peak of the memory allocated
+    # while it ran in bytes (only with trace_memory, None otherwise) and the attributes given to span()
+    __slots__ = ('name', 'path', 'start', 'seconds', 'peak_rss', 'peak_alloc', 'attrs')
+
+    def __init__(self, name, path, start, seconds, peak_rss, peak_alloc, attrs):
+        self.name = name
+        self.path = path
+        self.start = start
+        self.seconds = seconds
+        self.peak_rss = peak_rss
+        self.peak_alloc = peak_alloc
+        self.attrs = attrs
+
+
+class SpanStats:
+    # aggregate of all the spans with the same path
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.min_seconds = float('inf')
+        self.max_seconds = 0.0
+        self.peak_rss = None
+        self.peak_alloc = None
+
+    def add(self, record):
+        self.count += 1
+        self.seconds += record.seconds
+        self.min_seconds = min(self.min_seconds, record.seconds)
+        self.max_seconds = max(self.max_seconds, record.seconds)
+        if record.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, record.peak_rss)
+        if record.peak_alloc is not None:
+            self.peak_alloc = max(self.peak_alloc or 0, record.peak_alloc)
+
+    def to_dict(self):
+        return { 'count' : self.count, 'seconds' : self.seconds, 'min_seconds' : self.min_seconds,
+                 'max_seconds' : self.max_seconds, 'peak_rss' : self.peak_rss, 'peak_alloc' : self.peak_alloc }
+
+
+def peak_rss():
+    # peak resident set size of this process in bytes (ru_maxrss is in kilobytes on Linux, bytes on macOS),
+    # None without the resource module
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _traced_memory():
+    # (current, peak) memory traced by tracemalloc, peak since the last _reset_peak; without reset_peak the peak is
+    # the current memory, so span peaks are the largest memory traced at the start or end of a span or its children
+    (current, peak) = tracemalloc.get_traced_memory()
+    return (current, peak if _reset_peak is not None else current)
+
+
+class Profiler:
+    # Collects named, nested spans (see span()) while it is active:
+    #     with Profiler() as profiler:
+    #         transient.transient_analysis(circuit, ti, tf)
+    #     print(profiler.report())
+    # Spans are aggregated per path (e.g. transient_analysis/integrate/step_solve) into stats, and the first
+    # max_events spans are also kept individually in events for a timeline (see write_chrome_trace).
+    # Every finished span is passed to the callbacks (functions of a SpanRecord) as well.
+    # With trace_memory, the peak of the memory allocated by Python and numpy is measured per span (tracemalloc,
+    # which slows down allocations); on Python 3.8 it is only sampled at the boundaries of the spans, and misses the
+    # temporaries allocated and freed within a span without nested spans.
+    def __init__(self, trace_memory=False, max_events=100000, callbacks=()):
+        self.trace_memory = trace_memory
+        self.max_events = max_events
+        self.callbacks = list(callbacks)
+        self.stats = {}
+        self.events = []
+        self.dropped_events = 0
+        self._first_start = {}  # start of the first span of each path, orders the report
+        self._stack = []    # [name, traced memory at its start, peak traced memory so far] of the open spans
+        self._previous = None
+        self._t0 = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def __enter__(self):
+        global _active_profiler
+        self._previous = _active_profiler
+        _active_profiler = self
+        self._t0 = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_profiler
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        _active_profiler = self._previous
+        return False
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        if self.trace_memory:
+            # the peak since the last reset belongs to the enclosing span, tracemalloc's peak is then restarted
+            (current, peak) = _traced_memory()
+            if len(self._stack) > 0:
+                self._stack[-1][2] = max(self._stack[-1][2], peak)
+            if _reset_peak is not None:
+                _reset_peak()
+            self._stack.append([name, current, current])
+        else:
+            self._stack.append([name, 0, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            (_, alloc_start, alloc_peak) = self._stack.pop()
+            peak_alloc = None
+            if self.trace_memory:
+                alloc_peak = max(alloc_peak, _traced_memory()[1])
+                peak_alloc = alloc_peak - alloc_start
+                if len(self._stack) > 0:
+                    self._stack[-1][2] = max(self._stack[-1][2], alloc_peak)
+            path = tuple(frame[0] for frame in self._stack) + (name,)
+            record = SpanRecord(name, path, start - self._t0, end - start, peak_rss(), peak_alloc, attrs)
+            self._record(record)
+
+    def _record(self, record):
+        if record.path not in self.stats:
+            self.stats[record.path] = SpanStats()
+            self._first_start[record.path] = record.start
+        self.stats[record.path].add(record)
+        if len(self.events) < self.max_events:
+            self.events.append(record)
+        else:
+            self.dropped_events += 1
+        for callback in self.callbacks:
+            callback(record)
+
+    def report(self):
+        # one line per span path, indented by nesting depth, in the order the paths first occurred
+        lines = ['%-44s %9s %12s %12s %10s %10s' % ('span', 'count', 'total [s]', 'mean [s]', 'RSS [MB]', 'alloc [MB]')]
+        order = lambda path: tuple(self._first_start[path[:k]] for k in range(1, len(path)+1))
+        for path in sorted(self.stats, key=order):
+            stats = self.stats[path]
+            label = '  '*(len(path) - 1) + path[-1]
+            rss = '%10.1f' % (stats.peak_rss / 2**20) if stats.peak_rss is not None else '%10s' % '-'
+            alloc = '%10.1f' % (stats.peak_alloc / 2**20) if stats.peak_alloc is not None else '%10s' % '-'
+            lines.append('%-44s %9d %12.6f %12.6f %s %s' % (label, stats.count, stats.seconds,
+                                                            stats.seconds / stats.count, rss, alloc))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return { 'spans' : [dict(path='/'.join(path), **stats.to_dict()) for (path, stats) in self.stats.items()],
+                 'dropped_events' : self.dropped_events }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as output_file:
+            json.dump(self.to_dict(), output_file, indent=2)
+
+    def write_chrome_trace(self, filename):
+        # Chrome trace event format (complete events, times in microseconds), for chrome://tracing or Perfetto
+        events = []
+        for record in self.events:
+            args = dict(record.attrs)
+            if record.peak_rss is not None:
+                args['peak_rss'] = record.peak_rss
+            if record.peak_alloc is not None:
+                args['peak_alloc'] = record.peak_alloc
+            events.append({ 'name' : record.name, 'cat' : '/'.join(record.path[:-1]), 'ph' : 'X',
+                            'ts' : record.start * 1e6, 'dur' : record.seconds * 1e6, 'pid' : os.getpid(), 'tid' : 0,
+                            'args' : args })
+        with open(filename, 'w') as output_file:
+            json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, output_file)
+
+
+_no_span = contextlib.nullcontext()
+
+def span(name, **attrs):
+    # a named span of the active profiler (nested in the currently open one), does nothing without a profiler:
+    #     with profiling.span('factorize', n=A.shape[0]):
+    #         ...
+    if _active_profiler is None:
+        return _no_span
+    return _active_profiler.span(name, **attrs)
+
+def active_profiler():
+    return _active_profiler
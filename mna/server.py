@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import logging
+import argparse
+import socketserver
+import numpy as np
+
+from .session import Session
+from . import export
+from . import linalg
+
+logger = logging.getLogger(__name__)
+
+# Line-delimited JSON protocol, one request and one response per line:
+#   {"id": 1, "method": "transient", "params": {"inputs": ["v_clk_src"], "outputs": ["pt16"], "tf": 7e-9, "order": 20}}
+#   {"id": 1, "result": {"t": [...], "outputs": {"pt16": [...]}}}
+# methods:
+#   transient  inputs, outputs, ti, tf, dt, order, adaptive, stimulus (a source specification for every input, or
+#              an object of one per input source), export
+#   frequency  inputs, outputs, w_lo, w_hi, order, adaptive, rtol, export; complex outputs are {"re": [...], "im": [...]}
+#   edit       values (an object of the new value per element name), add (a list of [name, node1, node2, value]), remove
+#              (a list of element names): changes resistors, capacitors and inductors in place
+#   info       the netlist's size and the models computed so far
+#   shutdown   stops the server after responding
+# with "export": FILENAME the waveforms are written to FILENAME (see mna.export, format by extension) and the result
+# is {"export": FILENAME} instead; errors are reported as {"id": 1, "error": "message"}.
+
+
+def _outputs_json(axis_name, axis, outputs, filename=None):
+    if filename is not None:
+        export.write_outputs(filename, axis_name, axis, outputs)
+        return { 'export' : filename }
+    result = { axis_name : np.asarray(axis).tolist(), 'outputs' : {} }
+    for (node_name, y) in outputs:
+        if np.iscomplexobj(y):
+            result['outputs'][node_name] = { 're' : np.real(y).tolist(), 'im' : np.imag(y).tolist() }
+        else:
+            result['outputs'][node_name] = np.asarray(y).tolist()
+    return result
+
+def _transient(session, inputs, outputs, ti=0, tf=7e-9, dt=0.02e-9, order=None, adaptive=False, stimulus=None,
+               export=None):
+    (t, node_outputs) = session.transient(inputs, outputs, ti, tf, dt, order, stimulus, adaptive)
+    return _outputs_json('t', t, node_outputs, export)
+
+def _frequency(session, inputs, outputs, w_lo=-1, w_hi=19, order=None, adaptive=False, rtol=1e-2, export=None):
+    (w, node_outputs) = session.frequency(inputs, outputs, w_lo, w_hi, order, adaptive, rtol)
+    return _outputs_json('w', w, node_outputs, export)
+
+def _edit(session, values=None, add=(), remove=()):
+    session.edit(values, [tuple(element) for element in add], remove)
+    return session.info()
+
+METHODS = { 'transient' : _transient, 'frequency' : _frequency, 'edit' : _edit,
+            'info' : lambda session: session.info(), 'shutdown' : lambda session: {} }
+
+def handle(session, request):
+    # the response to one decoded request
+    request_id = request.get('id') if isinstance(request, dict) else None
+    try:
+        method = request['method']
+        if method not in METHODS:
+            raise ValueError('unknown method %s (expected one of %s)' % (method, ', '.join(METHODS)))
+        return { 'id' : request_id, 'result' : METHODS[method](session, **request.get('params', {})) }
+    except Exception as error:
+        logger.info('request %s failed', request_id, exc_info=True)
+        return { 'id' : request_id, 'error' : '%s: %s' % (type(error).__name__, error) }
+
+def serve(session, input_file, output_file):
+    # answers the requests read line by line from input_file, until its end or a shutdown request;
+    # returns True after a shutdown request
+    for line in input_file:
+        if line.strip() == '':
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            response = { 'id' : None, 'error' : 'invalid JSON: %s' % error }
+            request = None
+        else:
+            response = handle(session, request)
+        output_file.write(json.dumps(response) + '\n')
+        output_file.flush()
+        if isinstance(request, dict) and request.get('method') == 'shutdown':
+            return True
+    return False
+
+
+class SessionServer(socketserver.UnixStreamServer):
+    # serves one session over a Unix socket, one connection at a time (the session is not thread safe)
+    def __init__(self, path, session):
+        self.session = session
+        self.stopped = False
+        super().__init__(path, SessionRequestHandler)
+
+
+class SessionRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        reader = (line.decode() for line in self.rfile)
+        writer = _TextWriter(self.wfile)
+        if serve(self.server.session, reader, writer):
+            self.server.stopped = True
+
+
+class _TextWriter:
+    def __init__(self, binary_file):
+        self.binary_file = binary_file
+
+    def write(self, text):
+        self.binary_file.write(text.encode())
+
+    def flush(self):
+        self.binary_file.flush()
+
+
+def serve_unix(session, path):
+    # listens on the Unix socket path (replacing a stale one) until a shutdown request
+    if os.path.exists(path):
+        os.remove(path)
+    with SessionServer(path, session) as server:
+        logger.info('listening on %s', path)
+        try:
+            while not server.stopped:
+                server.handle_request()
+        finally:
+            os.remove(path)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python3 -m mna.server',
+                                     description='Answer transient and frequency queries on one netlist (line-delimited JSON).')
+    parser.add_argument('network', metavar='N', type=str, help='filename of circuit (SPICE format)')
+    parser.add_argument('--socket', metavar='PATH', type=str, help='listen on a Unix socket instead of stdin/stdout')
+    parser.add_argument('--dense', action='store_true', help='assemble dense instead of sparse circuit models')
+    parser.add_argument('-j', '--processes', metavar='J', type=int, help='number of worker processes for frequency analysis (default: all cores)')
+    parser.add_argument('--solver', metavar='S', type=str, choices=['trial'] + list(linalg.BACKENDS), help='solver backend: trial (time trial factorizations and keep the fastest) or one of %s (default: chosen per model by size, sparsity and symmetry)' % ', '.join(linalg.BACKENDS))
+    parser.add_argument('-v', '--verbose', action='store_true', help='log the sources, observed nodes and failed requests')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s',
+                        stream=sys.stderr)
+
+    session = Session(args.network, sparse=not args.dense, processes=args.processes, backend=args.solver)
+    if args.socket is not None:
+        serve_unix(session, args.socket)
+    else:
+        serve(session, sys.stdin, sys.stdout)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
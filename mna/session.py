@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import numpy as np
+
+from .circuit import Circuit
+from .netlist import edit_netlist, read_netlist
+from . import frequency
+from . import prima
+from . import profiling
+from . import stimulus
+from . import transient
+
+
+class SessionModel:
+    # a circuit model of a Session with what it has computed so far: the trapezoidal factorizations (per dt) and
+    # the frequency responses (per band)
+    def __init__(self, model, backend=None):
+        self.model = model
+        (G, C, b) = model.mna_GCb_matrices
+        self.solvers = transient.TrapezoidalSolverCache(C, G, backend=backend)
+        self.responses = {}
+
+
+class Session:
+    # A netlist parsed once, answering transient and frequency queries for any input sources and output nodes:
+    #     session = Session('reference/clock_tree.sp', sparse=True)
+    #     (t, outputs) = session.transient({'v_clk_src'}, {'pt16'}, 0, 7e-9, order=20)
+    #     (w, outputs) = session.frequency({'v_clk_src'}, {'pt16'}, -1, 19)
+    # Circuit models are assembled per (input sources, output nodes) and PRIMA reduced per order when first asked
+    # for; the least recently used ones are dropped beyond max_models (see mna/server.py for a query server).
+    # backend selects the solver backend of every model (see linalg.select_backend), chosen per model by default.
+    # edit() changes elements in place (an ECO): the models are edited instead of being rebuilt, the reduced ones by a
+    # low rank update of the factorization of G.
+    def __init__(self, filename, sparse=True, processes=None, max_models=16, backend=None):
+        self.filename = filename
+        self.sparse = sparse
+        self.processes = processes
+        self.backend = backend
+        self.max_models = max_models
+        with profiling.span('parse'):
+            self.netlist = read_netlist(filename)
+        self.models = OrderedDict()     # (input sources, output nodes, order) -> SessionModel
+
+    def model(self, input_sources, output_nodes, order=None):
+        # the SessionModel of the full circuit (order None) or of its reduced model of the given order
+        key = (frozenset(input_sources), frozenset(output_nodes), order)
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+        if order is None:
+            with profiling.span('circuit'):
+                model = Circuit(self.netlist, set(input_sources), set(output_nodes), sparse=self.sparse)
+        else:
+            circuit = self.model(input_sources, output_nodes).model
+            with profiling.span('reduce', order=order):
+                model = prima.PrimaReducedCircuit(order, circuit)
+        entry = SessionModel(model, self.backend)
+        self.models[key] = entry
+        while len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return entry
+
+    def input_stimulus(self, input_sources, output_nodes, u):
+        # the u of transient.transient_analysis for a query: None (the netlist's waveforms), a Stimulus or a source
+        # specification such as "PULSE(0 1 0 0.1n 0.1n 1n 2n)" for every input, or a dict of either per input source
+        # (the others keep their netlist waveform, or the square wave)
+        if isinstance(u, str):
+            return stimulus.parse_stimulus(u)
+        if not isinstance(u, dict):
+            return u
+        circuit = self.model(input_sources, output_nodes).model
+        unknown = [name for name in u if name not in circuit.input_source_list]
+        if len(unknown) > 0:
+            raise ValueError('%s not among the input sources' % ', '.join(unknown))
+        stimuli = []
+        for (name, netlist_stimulus) in zip(circuit.input_source_list, circuit.input_stimuli):
+            source = u.get(name, netlist_stimulus)
+            if isinstance(source, str):
+                source = stimulus.parse_stimulus(source)
+            stimuli.append(source if source is not None else transient.square_wave)
+        return stimulus.Stimuli(stimuli)
+
+    def transient(self, input_sources, output_nodes, ti=0, tf=7e-9, dt=0.02e-9, order=None, u=None, adaptive=False):
+        # transient.transient_analysis of the full (or reduced) model, returns (t, outputs)
+        entry = self.model(input_sources, output_nodes, order)
+        u = self.input_stimulus(input_sources, output_nodes, u)
+        return transient.transient_analysis(entry.model, ti, tf, dt, adaptive=adaptive, u=u, solvers=entry.solvers)
+
+    def frequency(self, input_sources, output_nodes, w_lo=-1, w_hi=19, order=None, adaptive=False, rtol=1e-2):
+        # frequency.frequency_analysis of the full (or reduced) model, returns (w, outputs)
+        entry = self.model(input_sources, output_nodes, order)
+        key = (w_lo, w_hi, adaptive, rtol)
+        if key not in entry.responses:
+            entry.responses[key] = frequency.frequency_analysis(entry.model, w_lo, w_hi, self.processes, adaptive, rtol,
+                                                                backend=self.backend)
+        return entry.responses[key]
+
+    def edit(self, set_values=None, add=(), remove=()):
+        # changes, adds and removes elements (see netlist.edit_netlist): every full circuit model is edited in place
+        # (see Circuit.edit), its factorizations updated when next used and its reduced models updated (see
+        # prima.PrimaReducedCircuit.update); the frequency responses are computed anew
+        self.netlist = edit_netlist(self.netlist, set_values, add, remove)
+        with profiling.span('edit'):
+            for ((inputs, outputs, order), entry) in list(self.models.items()):
+                if order is None:
+                    entry.model.edit(set_values, add, remove)
+                    entry.responses.clear()
+            for ((inputs, outputs, order), entry) in list(self.models.items()):
+                if order is None:
+                    continue
+                full = self.models.get((inputs, outputs, None))
+                if full is None:
+                    del self.models[(inputs, outputs, order)]
+                    continue
+                entry.model.update(full.model)
+                entry.responses.clear()
+
+    def info(self):
+        # the netlist's size and the models computed so far, with the transient solver backend chosen for each
+        num_states = self.netlist.num_nodes + int(np.count_nonzero(np.isin(self.netlist.kinds, ('l', 'v'))))
+        return { 'filename' : self.filename, 'elements' : len(self.netlist), 'nodes' : self.netlist.num_nodes,
+                 'states' : num_states, 'sparse' : self.sparse,
+                 'models' : [{ 'input_sources' : sorted(inputs), 'output_nodes' : sorted(outputs), 'order' : order,
+                               'factorizations' : len(entry.solvers.solvers), 'responses' : len(entry.responses),
+                               'solver' : str(entry.solvers.choice) if entry.solvers.choice is not None else None }
+                             for ((inputs, outputs, order), entry) in self.models.items()] }
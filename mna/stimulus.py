@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import math
+from abc import ABC, abstractmethod
+import numpy as np
+
+from . import netlist
+
+
+class Stimulus(ABC):
+    # a source waveform u(t), evaluated vectorized over a whole array of times
+    spec = None     # netlist text the stimulus was parsed from, if any
+
+    @abstractmethod
+    def __call__(self, t):
+        pass
+
+    def breakpoints(self, ti, tf):
+        # times in (ti, tf] where the waveform (or its slope) changes abruptly, for timestep control
+        return np.zeros(0)
+
+    def periodicity(self):
+        # (period, start) when the waveform repeats every period from start on (period 0 for a constant waveform),
+        # None when it is not periodic
+        return None
+
+def _within(t, ti, tf):
+    t = np.unique(t)
+    return t[(t > ti) & (t <= tf)]
+
+
+class Dc(Stimulus):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, t):
+        return np.full(np.shape(t), self.value, dtype=float)
+
+    def periodicity(self):
+        return (0.0, 0.0)
+
+
+class Pulse(Stimulus):
+    # SPICE PULSE(v1 v2 td tr tf pw per)
+    def __init__(self, v1, v2, td=0.0, tr=0.0, tf=0.0, pw=math.inf, per=math.inf):
+        self.v1 = v1
+        self.v2 = v2
+        self.td = td
+        self.tr = tr
+        self.tf = tf
+        self.pw = pw
+        self.per = per
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        pos = t - self.td
+        if math.isfinite(self.per):
+            pos = np.mod(pos, self.per)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = np.select([pos < self.tr,
+                           pos <= self.tr + self.pw,
+                           pos < self.tr + self.pw + self.tf],
+                          [self.v1 + (self.v2 - self.v1) * pos / self.tr,
+                           self.v2,
+                           self.v2 + (self.v1 - self.v2) * (pos - self.tr - self.pw) / self.tf],
+                          self.v1)
+        return np.where(t < self.td, self.v1, u)
+
+    def periodicity(self):
+        return (self.per, self.td) if math.isfinite(self.per) else None
+
+    def breakpoints(self, ti, tf):
+        corners = self.td + np.array([0, self.tr, self.tr + self.pw, self.tr + self.pw + self.tf])
+        corners = corners[np.isfinite(corners)]
+        if not math.isfinite(self.per):
+            return _within(corners, ti, tf)
+        first_period = max(math.floor((ti - corners[-1]) / self.per), 0)
+        last_period = max(math.ceil((tf - corners[0]) / self.per), 0)
+        periods = np.arange(first_period, last_period+1)
+        return _within((corners[np.newaxis, :] + self.per*periods[:, np.newaxis]).flatten(), ti, tf)
+
+
+class Pwl(Stimulus):
+    # SPICE PWL(t1 v1 t2 v2 ...), constant before the first and after the last point
+    def __init__(self, times, values):
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        if self.times.ndim != 1 or self.times.shape != self.values.shape:
+            raise ValueError('PWL needs a value for every time, got %d times and %d values' %
+                             (self.times.size, self.values.size))
+        if self.times.shape[0] == 0:
+            raise ValueError('PWL needs at least one point')
+        if np.any(np.diff(self.times) < 0):
+            raise ValueError('PWL times must not decrease')
+
+    def __call__(self, t):
+        return np.interp(t, self.times, self.values)
+
+    def breakpoints(self, ti, tf):
+        return _within(self.times, ti, tf)
+
+    def periodicity(self):
+        # constant after the last point
+        return (0.0, float(self.times[-1]))
+
+
+class Sampled(Pwl):
+    # waveform sampled at arbitrary times, loaded from a text file with (t, u) columns or a .npy array of them
+    @staticmethod
+    def from_file(filename):
+        if filename.endswith('.npy'):
+            samples = np.load(filename)
+        else:
+            samples = np.loadtxt(filename, ndmin=2, comments=('#', '*'))
+        if samples.shape[0] == 2 and samples.shape[1] != 2:
+            samples = samples.transpose()
+        return Sampled(samples[:, 0], samples[:, 1])
+
+    def breakpoints(self, ti, tf):
+        return np.zeros(0)  # densely sampled, every sample would be a breakpoint
+
+
+class Sin(Stimulus):
+    # SPICE SIN(vo va freq td theta phase), phase in degrees
+    def __init__(self, vo, va, freq, td=0.0, theta=0.0, phase=0.0):
+        self.vo = vo
+        self.va = va
+        self.freq = freq
+        self.td = td
+        self.theta = theta
+        self.phase = phase
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        tt = np.maximum(t - self.td, 0)
+        return self.vo + self.va * np.exp(-self.theta*tt) * np.sin(2*math.pi*self.freq*tt + math.radians(self.phase))
+
+    def periodicity(self):
+        if self.theta != 0 or self.freq < 0:
+            return None
+        return (1/self.freq if self.freq > 0 else 0.0, self.td)
+
+    def breakpoints(self, ti, tf):
+        return _within(np.array([self.td]), ti, tf)
+
+
+class Exp(Stimulus):
+    # SPICE EXP(v1 v2 td1 tau1 td2 tau2)
+    def __init__(self, v1, v2, td1=0.0, tau1=1.0, td2=math.inf, tau2=1.0):
+        self.v1 = v1
+        self.v2 = v2
+        self.td1 = td1
+        self.tau1 = tau1
+        self.td2 = td2
+        self.tau2 = tau2
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        rise = (self.v2 - self.v1) * -np.expm1(-np.maximum(t - self.td1, 0) / self.tau1)
+        fall = (self.v1 - self.v2) * -np.expm1(-np.maximum(t - self.td2, 0) / self.tau2)
+        return self.v1 + rise + fall
+
+    def breakpoints(self, ti, tf):
+        return _within(np.array([self.td1, self.td2]), ti, tf)
+
+
+class Stimuli(Stimulus):
+    # one stimulus per input (rows of the returned array), e.g. one per column of CircuitModel.input_B_matrix
+    def __init__(self, stimuli):
+        self.stimuli = list(stimuli)
+
+    def __call__(self, t):
+        return np.array([np.broadcast_to(stimulus(t), np.shape(t)) for stimulus in self.stimuli])
+
+    def breakpoints(self, ti, tf):
+        return _within(np.concatenate([stimulus_breakpoints(stimulus, ti, tf) for stimulus in self.stimuli] + [[]]),
+                       ti, tf)
+
+    def periodicity(self):
+        # the longest period, when every other one divides it, from the latest start on
+        periodicities = [stimulus_periodicity(stimulus) for stimulus in self.stimuli]
+        if any(periodicity is None for periodicity in periodicities):
+            return None
+        period = max((period for (period, start) in periodicities), default=0.0)
+        for (other, start) in periodicities:
+            if other > 0 and abs(period/other - round(period/other)) > 1e-9*period/other:
+                return None
+        return (period, max((start for (other, start) in periodicities), default=0.0))
+
+def stimulus_breakpoints(u, ti, tf):
+    if hasattr(u, 'breakpoints'):
+        return u.breakpoints(ti, tf)
+    return np.zeros(0)
+
+def stimulus_periodicity(u):
+    # see Stimulus.periodicity, None for plain functions and sampled values
+    if hasattr(u, 'periodicity'):
+        return u.periodicity()
+    return None
+
+def sample(u, t):
+    # evaluates u over the time array t as an (m, len(t)) array (m = 1 for a single scalar waveform);
+    # u is a Stimulus, a scalar-only function u(t) (evaluated per time point) or already sampled values
+    t = np.asarray(t, dtype=float)
+    if callable(u):
+        try:
+            U = np.asarray(u(t), dtype=float)
+        except (ValueError, TypeError):
+            U = None
+        if U is None or U.shape[-1:] != t.shape:
+            U = np.array([u(t_i) for t_i in t], dtype=float).transpose()
+    else:
+        U = np.asarray(u, dtype=float)
+    return U.reshape(-1, t.shape[0])
+
+
+# the clock of the examples: 0 -> 1 V, 0.1 ns edges, 2 ns period
+SQUARE_WAVE = Pulse(0, 1, 0.1e-9, 0.1e-9, 0.1e-9, 0.9e-9, 2e-9)
+
+_STIMULUS_PATTERN = re.compile(r'^(pulse|pwl|sin|exp)\s*\((.*)\)$', re.IGNORECASE)
+
+def parse_stimulus(spec, directory=''):
+    # parses a SPICE source specification such as "PULSE(0 1 0.1n 0.1n 0.1n 0.9n 2n)", "PWL(0 0 1n 1)",
+    # "SIN(0 1 1g)", "EXP(0 1 1n 0.2n)" or "PWL(FILE=samples.txt)", a relative file name is taken from directory
+    # (that of the netlist, see netlist.read_netlist), the spec of the stimulus keeps its absolute path
+    match = _STIMULUS_PATTERN.match(spec.strip())
+    if match is None:
+        raise ValueError('invalid source specification %s' % spec)
+    kind = match.group(1).lower()
+    args = match.group(2).replace(',', ' ').split()
+
+    if kind == 'pwl' and len(args) == 1 and args[0].lower().startswith('file='):
+        filename = os.path.abspath(os.path.join(directory, args[0][len('file='):].strip('"\'')))
+        stimulus = Sampled.from_file(filename)
+        spec = 'PWL(FILE=%s)' % filename
+    else:
+        values = [netlist.parse_value(arg) for arg in args]
+        if kind == 'pulse':
+            stimulus = Pulse(*values)
+        elif kind == 'pwl':
+            stimulus = Pwl(values[0::2], values[1::2])
+        elif kind == 'sin':
+            stimulus = Sin(*values)
+        else:
+            stimulus = Exp(*values)
+    stimulus.spec = spec.strip()
+    return stimulus
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+import numpy as np
+import scipy.sparse
+
+from . import prima
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+# the macromodels built so far in this process: (definition digest, order) -> Macromodel
+_macromodels = {}
+
+
+class Macromodel:
+    # G*x + C*x' of one subcircuit definition (sparse COO) over its pins, the first num_pins states (node voltages),
+    # and its internal states; stamped once per instance by Circuit
+    def __init__(self, G, C, num_pins):
+        self.G = scipy.sparse.coo_matrix(G)
+        self.C = scipy.sparse.coo_matrix(C)
+        self.num_pins = num_pins
+
+    @property
+    def num_internal_states(self):
+        return self.G.shape[0] - self.num_pins
+
+    def arrays(self):
+        # for cache.ModelCache
+        arrays = { 'num_pins' : np.array(self.num_pins), 'size' : np.array(self.G.shape[0]) }
+        for (name, M) in (('G', self.G), ('C', self.C)):
+            arrays[name + '.row'] = M.row
+            arrays[name + '.col'] = M.col
+            arrays[name + '.data'] = M.data
+        return arrays
+
+    @staticmethod
+    def from_arrays(arrays):
+        n = int(arrays['size'])
+        (G, C) = (scipy.sparse.coo_matrix((arrays[name + '.data'], (arrays[name + '.row'], arrays[name + '.col'])),
+                                          shape=(n, n)) for name in ('G', 'C'))
+        return Macromodel(G, C, int(arrays['num_pins']))
+
+
+def definition_digest(subcircuits, name, visiting=()):
+    # content hash of a definition, including the definitions it instantiates (a definition instantiating itself,
+    # directly or not, is rejected)
+    if name in visiting:
+        raise ValueError('subcircuit %s instantiates itself' % name)
+    definition = subcircuits[name]
+    netlist = definition.netlist
+    digest = hashlib.sha256()
+    digest.update(repr((definition.num_pins, netlist.num_nodes, netlist.kinds.tolist())).encode())
+    for array in (netlist.node1, netlist.node2):
+        digest.update(np.asarray(array, dtype=np.int64).tobytes())
+    digest.update(np.asarray(netlist.values, dtype=float).tobytes())
+    for instance in netlist.instances:
+        digest.update(definition_digest(subcircuits, instance.subckt, visiting + (name,)).encode())
+        digest.update(np.asarray(instance.pins, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def reduce_definition(G, C, num_pins, order=None):
+    # the Macromodel of a definition stamped as G, C (pins first): exact for order None, otherwise its internal
+    # states are PRIMA reduced with the pins as ports (prima.interior_task) while the pins are kept:
+    # V = blockdiag(I, V_i), Gm = V'*G*V, Cm = V'*C*V
+    n = G.shape[0]
+    if order is None or n == num_pins:
+        return Macromodel(G, C, num_pins)
+    G = scipy.sparse.csr_matrix(G)
+    C = scipy.sparse.csr_matrix(C)
+    V_i = prima.interior_basis(prima.interior_task(G, C, np.arange(num_pins, n), np.arange(num_pins), order))
+    if V_i.shape[1] >= n - num_pins:
+        return Macromodel(G, C, num_pins)
+    V = scipy.sparse.block_diag((scipy.sparse.identity(num_pins), scipy.sparse.csr_matrix(V_i)), format='csc')
+    Vt = V.transpose().tocsr()
+    return Macromodel(Vt @ G @ V, Vt @ C @ V, num_pins)
+
+def macromodel(subcircuits, name, order, build, model_cache=None):
+    # The Macromodel of definition name (reduced to order, None keeps it exact), built only the first time it is
+    # asked for in this process, or with a cache.ModelCache, the first time ever. build() returns the definition's
+    # (G, C), pins first.
+    digest = definition_digest(subcircuits, name)
+    if (digest, order) in _macromodels:
+        return _macromodels[(digest, order)]
+    key = model_cache.key('macromodel', digest, order) if model_cache is not None else None
+    arrays = model_cache.load(key) if model_cache is not None else None
+    if arrays is not None:
+        model = Macromodel.from_arrays(arrays)
+    else:
+        num_pins = subcircuits[name].num_pins
+        with profiling.span('macromodel', order=order):
+            (G, C) = build()
+            model = reduce_definition(G, C, num_pins, order)
+        logger.info('subcircuit %s: %d pins, %d internal states -> %d', name, num_pins, G.shape[0] - num_pins,
+                    model.num_internal_states)
+        if model_cache is not None:
+            model_cache.store(key, model.arrays())
+    _macromodels[(digest, order)] = model
+    return model
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import os
+from multiprocessing import Pool
+import numpy as np
+import scipy.sparse
+
+from .circuit import Circuit
+from .frequency import _share_matrix, _attach_matrix
+from . import linalg
+from . import profiling
+from . import stimulus
+from . import transient
+
+# the element kinds whose values can be swept, each enters the matrices linearly through its (transformed) value:
+# 1/R into G for resistors, C into C for capacitors, L into C for inductors
+SWEEP_KINDS = ('r', 'c', 'l')
+
+METRICS = ('delay', 'slew')
+DELAY_THRESHOLD = 0.5           # fraction of the input swing
+SLEW_THRESHOLDS = (0.1, 0.9)
+
+# the SweepModel and evaluation options attached by each worker process once (see _init_worker)
+_worker_sweep = {}
+
+
+def crossing_time(t, y, level, rising=True):
+    # first time y crosses level in the given direction (linearly interpolated), nan if it never does
+    above = y >= level
+    crossings = np.flatnonzero(above[1:] & ~above[:-1] if rising else ~above[1:] & above[:-1])
+    if len(crossings) == 0:
+        return np.nan
+    k = crossings[0]
+    return t[k] + (level - y[k]) * (t[k+1] - t[k]) / (y[k+1] - y[k])
+
+def first_edge(t, u):
+    # (rising, low, high) of the first transition of the input waveform u, levels taken from its range
+    (low, high) = (np.min(u), np.max(u))
+    middle = low + DELAY_THRESHOLD*(high - low)
+    rise = crossing_time(t, u, middle, rising=True)
+    fall = crossing_time(t, u, middle, rising=False)
+    rising = np.isnan(fall) or rise < fall
+    return (rising, low, high)
+
+def delay(t, u, y):
+    # time between the DELAY_THRESHOLD crossings of the input u and the output y on the first input edge
+    (rising, low, high) = first_edge(t, u)
+    level = low + DELAY_THRESHOLD*(high - low)
+    return crossing_time(t, y, level, rising) - crossing_time(t, u, level, rising)
+
+def slew(t, u, y):
+    # transition time of the output y between the SLEW_THRESHOLDS of the input swing, on the first input edge
+    (rising, low, high) = first_edge(t, u)
+    (lo, hi) = (low + fraction*(high - low) for fraction in SLEW_THRESHOLDS)
+    if rising:
+        return crossing_time(t, y, hi, True) - crossing_time(t, y, lo, True)
+    return crossing_time(t, y, lo, False) - crossing_time(t, y, hi, False)
+
+
+class SweepModel:
+    # The fill-reduced system of a ParameterSweep and its stamp maps, all a (worker) process needs to evaluate
+    # variants. G and C keep their sparsity pattern for every variant, only the data is refilled:
+    # G.data = G_fixed + S_G*p, C.data = C_fixed + S_C*p
+    # where p are the transformed values of the swept elements (1/R, C, L) and S_G, S_C hold the signs of their
+    # stamps at the positions of G.data and C.data.
+    ARRAYS = ('G', 'C', 'S_G', 'S_C', 'G_fixed', 'C_fixed', 'reciprocal', 'b', 'B', 'B_H', 'L_select')
+
+    def __init__(self, G, C, S_G, S_C, G_fixed, C_fixed, reciprocal, b, B, B_H, L_select):
+        self.G = G
+        self.C = C
+        self.S_G = S_G
+        self.S_C = S_C
+        self.G_fixed = G_fixed
+        self.C_fixed = C_fixed
+        self.reciprocal = reciprocal
+        self.b = b
+        self.B = B
+        self.B_H = B_H
+        self.L_select = L_select
+
+    def matrices(self, values):
+        # (G, C) of one variant, values are the element values (ohm, farad, henry) of the swept elements
+        p = np.where(self.reciprocal, 1/values, values)
+        G = scipy.sparse.csc_matrix((self.G_fixed + self.S_G @ p, self.G.indices, self.G.indptr), shape=self.G.shape)
+        C = scipy.sparse.csc_matrix((self.C_fixed + self.S_C @ p, self.C.indices, self.C.indptr), shape=self.C.shape)
+        return (G, C)
+
+    def evaluate(self, values, options):
+        # the requested metrics of one variant, each an array with one entry per output (per frequency for H)
+        (G, C) = self.matrices(values)
+        (ti, tf, dt, u, metrics, w, num_inputs) = options
+        result = {}
+        if len(metrics) > 0:
+            x0 = np.zeros(self.b.shape)
+            chunks = list(transient.implicit_integrate_outputs(C, G, self.b, self.B, x0, ti, tf, dt, self.L_select,
+                                                               u=u, ordering='natural'))
+            t = np.concatenate([t_chunk for (t_chunk, y_chunk) in chunks])
+            y = np.hstack([y_chunk for (t_chunk, y_chunk) in chunks])
+            # one reference waveform per input source, a single waveform drives all of them
+            U = stimulus.sample(u, t)
+            if U.shape[0] == 1:
+                U = np.broadcast_to(U, (num_inputs, len(t)))
+            for metric in metrics:
+                function = { 'delay' : delay, 'slew' : slew }[metric]
+                result[metric] = np.array([[function(t, U[j, :], y[i, :]) for i in range(y.shape[0])]
+                                           for j in range(U.shape[0])]).reshape(U.shape[0], y.shape[0])
+        if len(w) > 0:
+            H = np.empty((len(w), self.L_select.shape[0]))
+            for (k, s) in enumerate(1j*np.asarray(w)):
+                with profiling.span('frequency_solve'):
+                    x = linalg.factorize(G + s*C, ordering='natural').solve(self.B_H)
+                H[k, :] = np.abs(self.L_select @ x).flatten()
+            result['H'] = H
+        return result
+
+
+def _evaluate_variants(model, values, options):
+    # metrics of a chunk of variants, stacked with one row per variant
+    results = []
+    for row in values:
+        with profiling.span('variant'):
+            results.append(model.evaluate(row, options))
+    if len(results) == 0:
+        return {}
+    return { metric : np.stack([result[metric] for result in results]) for metric in results[0] }
+
+def _init_worker(descs, options):
+    shms = []
+    _worker_sweep['model'] = SweepModel(**{ name : _attach_matrix(shms, desc) for (name, desc) in descs.items() })
+    _worker_sweep['options'] = options
+    _worker_sweep['shms'] = shms
+
+def _worker_evaluate_variants(values):
+    return _evaluate_variants(_worker_sweep['model'], values, _worker_sweep['options'])
+
+
+class ParameterSweep:
+    # Evaluates many variants of one circuit that only differ in element values (corners, Monte Carlo samples):
+    #     sweep = ParameterSweep('reference/clock_tree.sp', {'v_clk_src'}, {'pt1', 'pt16'})
+    #     values = sweep.monte_carlo(0.05, 1000)
+    #     result = sweep.run(values, 0, 7e-9, frequencies=[1e9, 1e10])
+    # The netlist is parsed and stamped once; a variant only refills the data of G and C through the stamp maps
+    # of SweepModel. The system is permuted once by a fill reducing ordering (see linalg.fill_reducing_ordering),
+    # so that the factorizations of all variants skip the ordering. Only the requested metrics of each variant are
+    # returned, never its waveforms.
+    # parameters are the names of the swept elements (by default all resistors, capacitors and inductors), the
+    # values of all other elements stay at those of the netlist.
+    def __init__(self, filename, input_sources=set(), output_nodes=set(), parameters=None):
+        self.circuit = Circuit(filename, input_sources, output_nodes, sparse=True)
+        netlist = self.circuit.netlist
+        if parameters is None:
+            element_ids = np.flatnonzero(np.isin(netlist.kinds, SWEEP_KINDS))
+        else:
+            index = { name : i for (i, name) in enumerate(netlist.names) }
+            unknown = [name for name in parameters if name not in index]
+            if len(unknown) > 0:
+                raise ValueError('unknown elements %s' % ', '.join(unknown))
+            element_ids = np.array([index[name] for name in parameters], dtype=int)
+            invalid = [netlist.names[i] for i in element_ids if netlist.kinds[i] not in SWEEP_KINDS]
+            if len(invalid) > 0:
+                raise ValueError('only resistors, capacitors and inductors can be swept, not %s' % ', '.join(invalid))
+        self.parameters = [netlist.names[i] for i in element_ids]
+        self.nominal = netlist.values[element_ids].astype(float)
+        self.output_names = [name for (name, L) in zip(self.circuit.output_node_names, self.circuit.output_L_vectors)]
+        self.input_names = list(self.circuit.input_source_list)
+
+        with profiling.span('sweep_setup', parameters=len(element_ids)):
+            self.model = self._build_model(element_ids)
+
+    def _build_model(self, element_ids):
+        circuit = self.circuit
+        netlist = circuit.netlist
+        (G, C, b) = circuit.mna_GCb_matrices
+        (B, self.u) = transient.circuit_inputs(circuit)
+        L_select = transient.output_selection_matrix(circuit.output_L_vectors, b.shape[0])
+
+        perm = linalg.fill_reducing_ordering(G + C)
+        inverse = np.empty_like(perm)
+        inverse[perm] = np.arange(len(perm))
+        (G, C) = (M[perm, :][:, perm].tocsc() for M in (G, C))
+        for M in (G, C):
+            M.sort_indices()
+
+        # the stamps of Circuit._add_resistors, _add_capacitors and _add_inductors, one per (element, entry)
+        kinds = netlist.kinds[element_ids]
+        n1 = netlist.node1[element_ids]
+        n2 = netlist.node2[element_ids]
+        params = np.arange(len(element_ids))
+        v_src = np.array([circuit.v_offset + circuit.voltage_sources[netlist.names[i]] if kinds[k] == 'l' else -1
+                          for (k, i) in enumerate(element_ids)], dtype=int)
+        is_r = kinds == 'r'
+        is_c = kinds == 'c'
+        is_l = kinds == 'l'
+        (G_stamps, C_stamps) = ([], [])
+        for (stamps, is_kind) in ((G_stamps, is_r), (C_stamps, is_c)):
+            for (rows, cols, sign) in ((n1, n1, 1.0), (n2, n2, 1.0), (n1, n2, -1.0), (n2, n1, -1.0)):
+                stamps.append((rows[is_kind], cols[is_kind], sign, params[is_kind]))
+        C_stamps.append((v_src[is_l], v_src[is_l], 1.0, params[is_l]))
+
+        reciprocal = is_r
+        p = np.where(reciprocal, 1/self.nominal, self.nominal)
+        S_G = self._stamp_map(G, G_stamps, inverse, len(element_ids))
+        S_C = self._stamp_map(C, C_stamps, inverse, len(element_ids))
+        return SweepModel(G, C, S_G, S_C, G.data - S_G @ p, C.data - S_C @ p, reciprocal, b[perm], np.asarray(B)[perm],
+                          circuit.input_B_vector[perm], L_select[:, perm].tocsr())
+
+    @staticmethod
+    def _stamp_map(M, stamps, inverse, num_parameters):
+        # sparse (nnz(M) x num_parameters) matrix of the signs of the stamps at the positions of M.data,
+        # stamps involving the ground node are dropped as in Circuit._stamp
+        n = M.shape[0]
+        keys = np.repeat(np.arange(n), np.diff(M.indptr)) * n + M.indices     # ascending in CSC order
+        (positions, signs, columns) = ([], [], [])
+        for (rows, cols, sign, params) in stamps:
+            keep = (rows >= 0) & (cols >= 0)
+            query = inverse[cols[keep]] * n + inverse[rows[keep]]
+            position = np.searchsorted(keys, query)
+            assert(np.all(keys[np.minimum(position, len(keys)-1)] == query))
+            positions.append(position)
+            signs.append(np.full(len(position), sign))
+            columns.append(params[keep])
+        (positions, signs, columns) = (np.concatenate(part) for part in (positions, signs, columns))
+        return scipy.sparse.csr_matrix((signs, (positions, columns)), shape=(M.nnz, num_parameters))
+
+    def parameter_index(self, names):
+        index = { name : i for (i, name) in enumerate(self.parameters) }
+        return np.array([index[name] for name in names], dtype=int)
+
+    def monte_carlo(self, relative_sigma, num_samples, seed=None):
+        # num_samples x len(parameters) lognormally distributed values around the nominal ones (always positive,
+        # relative standard deviation about relative_sigma, a scalar or one per parameter)
+        rng = np.random.default_rng(seed)
+        z = rng.standard_normal((num_samples, len(self.parameters)))
+        return self.nominal * np.exp(np.asarray(relative_sigma) * z)
+
+    def run(self, values, ti=0, tf=7e-9, dt=0.02e-9, metrics=METRICS, frequencies=(), u=None, processes=None,
+            chunks_per_process=4):
+        # evaluates the variants (rows of values, one column per parameter) and returns a dict of
+        #   'delay', 'slew': arrays of shape (num_variants, num_inputs, num_outputs), in seconds, each measured on the
+        #   first edge of that input (see delay and slew); with several inputs switching together, every output is
+        #   measured against each of them
+        #   'H': |H(jw)| at the frequencies w (rad/s), an array of shape (num_variants, len(frequencies), num_outputs)
+        # for the metrics requested; the inputs are in the order of input_names, the outputs in that of output_names
+        # u overrides the input waveform(s) as in transient.transient_analysis, it must be picklable with processes
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        if values.shape[1] != len(self.parameters):
+            raise ValueError('expected %d values per variant, got %d' % (len(self.parameters), values.shape[1]))
+        for metric in metrics:
+            if metric not in METRICS:
+                raise ValueError('unknown metric %s (expected one of %s)' % (metric, ', '.join(METRICS)))
+        if processes is None:
+            processes = os.cpu_count() or 1
+        options = (ti, tf, dt, u if u is not None else self.u, tuple(metrics), tuple(frequencies),
+                   len(self.input_names))
+
+        with profiling.span('sweep', variants=values.shape[0], processes=processes):
+            if processes <= 1 or values.shape[0] <= 1:
+                return _evaluate_variants(self.model, values, options)
+
+            shms = []
+            try:
+                descs = { name : _share_matrix(shms, getattr(self.model, name)) for name in SweepModel.ARRAYS }
+                chunks = np.array_split(values, min(values.shape[0], processes*chunks_per_process))
+                # the per-variant spans of the workers are not collected, only the sweep as a whole
+                with Pool(processes=processes, initializer=_init_worker, initargs=(descs, options)) as pool:
+                    results = pool.map(_worker_evaluate_variants, chunks)
+            finally:
+                for shm in shms:
+                    shm.close()
+                    shm.unlink()
+            return { metric : np.concatenate([result[metric] for result in results]) for metric in results[0] }
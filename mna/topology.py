@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from .netlist import Instance, Netlist
+from . import profiling
+
+logger = logging.getLogger(__name__)
+
+# a node eliminated by star-mesh transformation with d neighbours is replaced by up to d*(d-1)/2 elements, so only
+# nodes of up to this degree are eliminated (3 never increases the number of elements)
+MAX_ELIMINATION_DEGREE = 3
+
+
+class _Elements:
+    # the element arrays of a netlist while it is being reduced; new elements are named <kind>_<tag><k>, with a tag
+    # ('reduced' unless the netlist already uses it) that no name of the netlist contains
+    def __init__(self, names, kinds, node1, node2, values):
+        self.names = names
+        self.kinds = kinds
+        self.node1 = node1
+        self.node2 = node2
+        self.values = values
+        self.num_created = 0
+        self.tag = 'reduced'
+        lower_names = [name.lower() for name in names]
+        while any(self.tag in name for name in lower_names):
+            self.tag = '_' + self.tag
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def keep(self, mask):
+        self.names = self.names[mask]
+        self.kinds = self.kinds[mask]
+        self.node1 = self.node1[mask]
+        self.node2 = self.node2[mask]
+        self.values = self.values[mask]
+
+    def add(self, kind, node1, node2, values):
+        count = len(values)
+        names = np.array(['%s_%s%d' % (kind, self.tag, self.num_created + k) for k in range(count)], dtype=object)
+        self.num_created += count
+        self.names = np.concatenate((self.names, names))
+        self.kinds = np.concatenate((self.kinds, np.full(count, kind, dtype=self.kinds.dtype)))
+        self.node1 = np.concatenate((self.node1, node1))
+        self.node2 = np.concatenate((self.node2, node2))
+        self.values = np.concatenate((self.values, values))
+
+    def degrees(self, num_nodes):
+        # number of element terminals at each node
+        ends = np.concatenate((self.node1, self.node2))
+        return np.bincount(ends[ends >= 0], minlength=num_nodes)
+
+    def neighbours(self, num_nodes):
+        # number of distinct nodes (ground included) each node connects to
+        ends = np.concatenate((self.node1, self.node2))
+        others = np.concatenate((self.node2, self.node1))
+        valid = ends >= 0
+        pairs = np.unique(np.stack((ends[valid], others[valid])), axis=1)
+        return np.bincount(pairs[0], minlength=num_nodes)
+
+    def conductances(self):
+        # 1/R of the resistors, 0 for the other elements
+        g = np.zeros(len(self))
+        is_r = self.kinds == 'r'
+        g[is_r] = 1/self.values[is_r]
+        return g
+
+
+def _prune_islands(elements, num_nodes, port):
+    # removes the connected parts of the network (apart from ground) without a port: nothing flows between them and
+    # the rest through the single ground node
+    internal = (elements.node1 >= 0) & (elements.node2 >= 0)
+    graph = scipy.sparse.coo_matrix((np.ones(np.count_nonzero(internal)),
+                                     (elements.node1[internal], elements.node2[internal])), shape=(num_nodes, num_nodes))
+    (num_components, labels) = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    has_port = np.zeros(num_components, dtype=bool)
+    has_port[labels[port]] = True
+    node = np.where(elements.node1 >= 0, elements.node1, elements.node2)
+    keep = (node < 0) | has_port[labels[np.maximum(node, 0)]]
+    elements.keep(keep)
+    return np.count_nonzero(~keep)
+
+def _prune_dangling(elements, num_nodes, port):
+    # removes passive elements that loop on one node and, repeatedly, the elements of a node that connects to a
+    # single other node (e.g. a stub of a resistor and a capacitor in parallel): no current flows through them
+    keep = (elements.node1 != elements.node2) | ~np.isin(elements.kinds, ('r', 'c', 'l'))
+    elements.keep(keep)
+    removed = np.count_nonzero(~keep)
+    while True:
+        dangling = (elements.neighbours(num_nodes) == 1) & ~port
+        dangling = np.append(dangling, False)   # ground (-1) is never dangling
+        keep = ~dangling[elements.node1] & ~dangling[elements.node2]
+        if np.all(keep):
+            return removed
+        removed += np.count_nonzero(~keep)
+        elements.keep(keep)
+
+def _merge_parallel(elements):
+    # combines the resistors, capacitors and inductors of the same kind between the same two nodes into one
+    reducible = np.isin(elements.kinds, ('r', 'c', 'l'))
+    ids = np.flatnonzero(reducible)
+    lo = np.minimum(elements.node1[ids], elements.node2[ids])
+    hi = np.maximum(elements.node1[ids], elements.node2[ids])
+    kind_id = np.searchsorted(np.array(['c', 'l', 'r']), elements.kinds[ids])
+    (keys, first, group) = np.unique(np.stack((kind_id, lo, hi)), axis=1, return_index=True, return_inverse=True)
+    group = group.reshape(-1)
+    if keys.shape[1] == len(ids):
+        return 0
+    # capacitances add, conductances and inverse inductances add
+    additive = elements.kinds[ids] == 'c'
+    terms = elements.values[ids].copy()
+    terms[~additive] = 1/terms[~additive]
+    sums = np.bincount(group, weights=terms, minlength=keys.shape[1])
+    first_ids = ids[first]
+    elements.values[first_ids] = np.where(additive[first], sums, 1/sums)
+    keep = np.ones(len(elements), dtype=bool)
+    keep[ids] = False
+    keep[first_ids] = True
+    elements.keep(keep)
+    return len(ids) - len(first_ids)
+
+def _independent(candidate, elements, priority):
+    # a subset of the candidate nodes of which no two are connected by an element: the candidates whose priority is
+    # below that of all their candidate neighbours
+    (n1, n2) = (elements.node1, elements.node2)
+    both = (n1 >= 0) & (n2 >= 0)
+    (n1, n2) = (n1[both], n2[both])
+    both = candidate[n1] & candidate[n2]
+    blocked = np.zeros(len(candidate), dtype=bool)
+    (n1, n2) = (n1[both], n2[both])
+    blocked[np.where(priority[n1] > priority[n2], n1, n2)] = True
+    return candidate & ~blocked
+
+def _merge_series_inductors(elements, num_nodes, port, priority):
+    # replaces two inductors that meet at an otherwise unconnected node by one
+    is_l = elements.kinds == 'l'
+    degree = elements.degrees(num_nodes)
+    ends = np.concatenate((elements.node1, elements.node2))
+    inductor_ends = np.tile(is_l, 2)
+    inductor_degree = np.bincount(ends[inductor_ends & (ends >= 0)], minlength=num_nodes)
+    candidate = (degree == 2) & (inductor_degree == 2) & ~port
+    selected = _independent(candidate, elements, priority)
+    if not np.any(selected):
+        return 0
+    # the two inductors of each selected node, and their other ends
+    element_ids = np.tile(np.arange(len(elements)), 2)
+    at_selected = (ends >= 0) & selected[np.maximum(ends, 0)]
+    order = np.argsort(ends[at_selected], kind='stable')
+    pairs = element_ids[at_selected][order].reshape(-1, 2)
+    nodes = ends[at_selected][order][0::2]
+    other = np.where(elements.node1[pairs] == nodes[:, np.newaxis], elements.node2[pairs], elements.node1[pairs])
+    values = elements.values[pairs[:, 0]] + elements.values[pairs[:, 1]]
+    keep = np.ones(len(elements), dtype=bool)
+    keep[pairs.reshape(-1)] = False
+    elements.keep(keep)
+    elements.add('l', other[:, 0], other[:, 1], values)
+    return len(nodes)
+
+def _eliminate_nodes(elements, num_nodes, port, priority, max_time_constant, max_degree):
+    # Star-mesh elimination of internal nodes connected only through resistors and capacitors. With conductances
+    # g_i and capacitances c_i from node N to its neighbours i (G = sum g_i, C = sum c_i), N is replaced by
+    #   g_ij = g_i*g_j/G and c_ij = (g_i*c_j + g_j*c_i)/G between every pair of neighbours (TICER)
+    # which is exact without capacitances (series/star resistors), and by c_ij = c_i*c_j/C for nodes without
+    # conductances (series/star capacitors, exact). Other nodes are eliminated when their time constant C/G is at
+    # most max_time_constant; the error is then of the order of s*C/G at the frequencies of interest.
+    is_r = elements.kinds == 'r'
+    is_c = elements.kinds == 'c'
+    ends = np.concatenate((elements.node1, elements.node2))
+    others = np.concatenate((elements.node2, elements.node1))
+    g = np.tile(elements.conductances(), 2)
+    c = np.tile(np.where(is_c, elements.values, 0.0), 2)
+    rc = np.tile(is_r | is_c, 2)
+    valid = ends >= 0
+
+    pinned = port.copy()
+    pinned[ends[valid & ~rc]] = True     # nodes of inductors, sources and unknown elements
+    G = np.bincount(ends[valid], weights=g[valid], minlength=num_nodes)
+    C = np.bincount(ends[valid], weights=c[valid], minlength=num_nodes)
+
+    # (node, neighbour) pairs, parallel resistors and capacitors aggregated
+    (pair_keys, pair_inverse) = np.unique(np.stack((ends[valid], others[valid])), axis=1, return_inverse=True)
+    pair_inverse = pair_inverse.reshape(-1)
+    pair_g = np.bincount(pair_inverse, weights=g[valid], minlength=pair_keys.shape[1])
+    pair_c = np.bincount(pair_inverse, weights=c[valid], minlength=pair_keys.shape[1])
+    degree = np.bincount(pair_keys[0], minlength=num_nodes)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quick = (C == 0) | (G == 0) | (C <= max_time_constant*G)
+    candidate = ~pinned & (degree >= 1) & (degree <= max_degree) & quick
+    selected = _independent(candidate, elements, priority)
+    if not np.any(selected):
+        return 0
+
+    rows = np.flatnonzero(selected[pair_keys[0]])   # sorted by node, one row per neighbour
+    (nodes, starts, counts) = np.unique(pair_keys[0, rows], return_index=True, return_counts=True)
+    new_r = ([], [], [])
+    new_c = ([], [], [])
+    for d in np.unique(counts):
+        index = rows[starts[counts == d][:, np.newaxis] + np.arange(d)]     # (nodes of degree d) x d
+        (neighbour, g_i, c_i) = (pair_keys[1][index], pair_g[index], pair_c[index])
+        G_N = G[pair_keys[0][index[:, 0]]][:, np.newaxis]
+        C_N = C[pair_keys[0][index[:, 0]]][:, np.newaxis]
+        (p, q) = np.triu_indices(d, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            g_pq = np.where(G_N > 0, g_i[:, p]*g_i[:, q]/G_N, 0.0)
+            c_pq = np.where(G_N > 0, (g_i[:, p]*c_i[:, q] + g_i[:, q]*c_i[:, p])/G_N, c_i[:, p]*c_i[:, q]/C_N)
+        (n_p, n_q) = (neighbour[:, p], neighbour[:, q])
+        for (new, values) in ((new_r, g_pq), (new_c, c_pq)):
+            keep = values > 0
+            new[0].append(n_p[keep])
+            new[1].append(n_q[keep])
+            new[2].append(values[keep])
+
+    eliminated = np.append(selected, False)
+    elements.keep(~eliminated[elements.node1] & ~eliminated[elements.node2])
+    elements.add('r', np.concatenate(new_r[0]), np.concatenate(new_r[1]), 1/np.concatenate(new_r[2]))
+    elements.add('c', np.concatenate(new_c[0]), np.concatenate(new_c[1]), np.concatenate(new_c[2]))
+    return len(nodes)
+
+def reduce_netlist(netlist, output_nodes=(), max_time_constant=0.0,
+                   max_degree=MAX_ELIMINATION_DEGREE, max_passes=100, seed=0):
+    # Shrinks a netlist before it is stamped, keeping the voltages of the output nodes and the nodes of all sources
+    # (the ports), the pins of subcircuit instances and the sources themselves:
+    #   - removes the parts of the network without a port, and dangling stubs
+    #   - merges parallel resistors, capacitors and inductors, and series inductors
+    #   - eliminates internal resistor/capacitor nodes of up to max_degree neighbours (see _eliminate_nodes): exactly
+    #     when they only connect resistors or only capacitors (series chains), approximately (TICER) when their time
+    #     constant is at most max_time_constant seconds (0 keeps the reduction exact)
+    # Eliminated nodes are removed from the returned Netlist, new elements are named <kind>_reduced<k>.
+    names = np.array(netlist.names, dtype=object)
+    elements = _Elements(names, netlist.kinds.copy(), netlist.node1.copy(), netlist.node2.copy(),
+                         np.array(netlist.values, dtype=float))
+    num_nodes = netlist.num_nodes
+    port = np.zeros(num_nodes, dtype=bool)
+    for node_name in output_nodes:
+        node_id = netlist.node_name_to_id.get(node_name, -1)
+        if node_id >= 0:
+            port[node_id] = True
+    is_fixed = ~np.isin(elements.kinds, ('r', 'c', 'l'))    # sources and unknown elements
+    for node in (elements.node1[is_fixed], elements.node2[is_fixed]) + tuple(x.pins for x in netlist.instances):
+        port[node[node >= 0]] = True
+    priority = np.random.default_rng(seed).permutation(num_nodes)
+
+    with profiling.span('topology_reduction', elements=len(elements)):
+        removed = _prune_islands(elements, num_nodes, port)
+        (merged, eliminated) = (0, 0)
+        for k in range(max_passes):
+            removed += _prune_dangling(elements, num_nodes, port)
+            merged += _merge_parallel(elements)
+            series = _merge_series_inductors(elements, num_nodes, port, priority)
+            nodes = _eliminate_nodes(elements, num_nodes, port, priority, max_time_constant, max_degree)
+            merged += series
+            eliminated += nodes
+            if series == 0 and nodes == 0:
+                break
+        removed += _prune_dangling(elements, num_nodes, port)
+        merged += _merge_parallel(elements)
+
+        # renumber the remaining nodes in their original order
+        used = port.copy()
+        for node in (elements.node1, elements.node2):
+            used[node[node >= 0]] = True
+        new_ids = np.append(np.cumsum(used) - 1, -1)
+        node_names = [name for (name, is_used) in zip(netlist.node_names, used) if is_used]
+        instances = [Instance(x.name, x.subckt, new_ids[x.pins]) for x in netlist.instances]
+        reduced = Netlist(elements.names.tolist(), elements.kinds, new_ids[elements.node1], new_ids[elements.node2],
+                          elements.values, node_names, netlist.stimuli, instances, netlist.subcircuits)
+
+    logger.info('topology reduction: %d -> %d elements, %d -> %d nodes (%d removed, %d merged, %d nodes eliminated)',
+                len(netlist), len(reduced), num_nodes, reduced.num_nodes, removed, merged, eliminated)
+    return reduced
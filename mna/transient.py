@@ -1,60 +1,39 @@
 #!/usr/bin/env python3
 
-from enum import Enum
-import time
+from collections import OrderedDict, namedtuple
+import inspect
+import logging
 import math
 import numpy as np
 import scipy
+import scipy.signal
+import scipy.sparse
+import scipy.sparse.linalg
 
-class SolverMethod(Enum):
-    SOLVE = 1
-    FORWARD_BACKWARD_SUBSTITUTION = 2
-    INVERSE = 3
-
-METHOD = SolverMethod.INVERSE
-
-def square_wave(t):
-    MAX_VALUE = 1
-    PERIOD_S = 2e-9
-    RISING_FALLING_TIME_S = 0.1e-9
-
-    # period of 2 nanoseconds
-    periodic_pos = (t - RISING_FALLING_TIME_S) % PERIOD_S
-    assert(periodic_pos >= 0)
-
-    # rise/fall time is 0.1 ns
-    if 0 <= periodic_pos and periodic_pos <= RISING_FALLING_TIME_S:
-        u = MAX_VALUE * (periodic_pos / RISING_FALLING_TIME_S)
-    elif RISING_FALLING_TIME_S <= periodic_pos and periodic_pos <= PERIOD_S/2:
-        u = MAX_VALUE
-    elif PERIOD_S/2 <= periodic_pos and periodic_pos <= PERIOD_S/2+RISING_FALLING_TIME_S:
-        u = MAX_VALUE - ((periodic_pos - PERIOD_S/2) / RISING_FALLING_TIME_S)
-    else:
-        u = 0
+from . import linalg
+from . import stimulus
+from . import profiling
+
+logger = logging.getLogger(__name__)
 
-    return u
+# dense reduced models up to this order (e.g. PRIMA reduced models) are integrated modally, see ModalIntegrator
+MODAL_MAX_ORDER = 500
 
-def fwd_bwd_sub(L, U, P, b):
-    b = np.dot(P, b)
+# scipy 1.12 renamed gmres's relative tolerance from tol to rtol (the Pipfile pins an older scipy)
+GMRES_RTOL = 'rtol' if 'rtol' in inspect.signature(scipy.sparse.linalg.gmres).parameters else 'tol'
 
-    # initializing forward elimination
-    y = np.zeros(b.shape)
-    y[0] = b[0] / L[0, 0]
-    # forward elimination
-    n = L.shape[0]
-    for i in range(1, n):
-        y[i] = (b[i] - np.dot(L[i,:i], y[:i])) / L[i,i]
+# the result of transient_analysis and periodic_steady_state with full_state=True: the time points t, the outputs
+# [(node_name, y)] and the state history x of shape (states, len(t)), unpacks as (t, outputs, x)
+TransientResult = namedtuple('TransientResult', ['t', 'outputs', 'x'])
 
-    # initializing backward substitution
-    x = np.zeros(y.shape)
-    x[-1] = y[-1] / U[-1, -1]
-    # backward substitution
-    for i in range(n-2, -1, -1):
-        x[i] = (y[i] - np.dot(U[i,i:], x[i:])) / U[i,i]
+# the default input waveform, vectorized over arrays of times (see stimulus.Pulse)
+square_wave = stimulus.SQUARE_WAVE
 
-    return x
+def square_wave_breakpoints(ti, tf):
+    # times in (ti, tf] where the slope of square_wave changes
+    return square_wave.breakpoints(ti, tf)
 
-def implicit_integrate(C, G, b, B, x0, ti, tf, dt):
+def trapezoidal_solver(C, G, dt, ordering=None, backend=None, solves=1):
     # Given:
     # G*x(t) + C*x'(t) = b + B*u(t)
     # C*x'(t) = b + B*u(t) - G*x(t)
@@ -65,65 +44,559 @@ def implicit_integrate(C, G, b, B, x0, ti, tf, dt):
     # C*x(t+dt) = C*x(t) + 0.5*dt*(C*x'(t+dt) + C*x(t))
     # C*x(t+dt) = C*x(t) + 0.5*dt*((b + B*u(t+dt) - G*x(t+dt)) + (b + B*u(t) - G*x(t)))
     # (C + 0.5*dt*G)*x(t+dt) = (C - 0.5*dt*G)*x(t) + 0.5*dt*(2*b + B*(u(t+dt) + u(t)))
+    #
+    # returns (A_rhs, solve), where solve(rhs) returns x(t+dt) given rhs = A_rhs*x(t) + dt*(b + B*u_avg)
+    # (C + 0.5*dt*G) is factored once with linalg.factorize (ordering, backend and the expected number of steps
+    # solves are passed on), O(nnz(factors)) per step
+
+    (A_rhs, A) = trapezoidal_matrices(C, G, dt)
+    A_factor = linalg.factorize(A, ordering, backend, solves)
+    return (A_rhs, A_factor.solve)
+
+def trapezoidal_matrices(C, G, dt):
+    # (A_rhs, A) of trapezoidal_solver: C - 0.5*dt*G (CSR when sparse, the fastest format for the per-step matvec)
+    # and C + 0.5*dt*G
+    A_rhs = linalg.sparsify(C - (dt/2)*G)
+    if linalg.issparse(A_rhs):
+        A_rhs = A_rhs.tocsr()
+    return (A_rhs, linalg.sparsify(C + (dt/2)*G))
 
+def time_grid(ti, tf, dt):
+    num_points = math.ceil((tf - ti) / dt)
+    return ti + dt*np.arange(num_points+1)
+
+def implicit_integrate(C, G, b, B, x0, ti, tf, dt, u=square_wave, solvers=None):
     # b are the constant inputs, internal sources, no longer passive circuit
     # B are the (user-defined) time-dependent inputs, multiply it with u(t)
+    # (see trapezoidal_solver), returns the full state history x, one column per timestep
+    # u is evaluated over the whole time grid up front (see stimulus.sample), with one row per column of B
+    # solvers (a TrapezoidalSolverCache of C and G) reuses the factorization of earlier integrations with the same dt
 
-    A_rhs = (C - (dt/2)*G)
-    A = (C + (dt/2)*G)
-    if METHOD == SolverMethod.FORWARD_BACKWARD_SUBSTITUTION:
-        (P, L, U) = scipy.linalg.lu(A)
-        # with np.printoptions(linewidth=1000):
-        #     print(P)
-        #     print(L)
-        #     print(U)
-    elif METHOD == SolverMethod.INVERSE:
-        inv_A = np.linalg.inv(A)
+    (A_rhs, solve) = solvers(dt) if solvers is not None else trapezoidal_solver(C, G, dt,
+                                                                                solves=math.ceil((tf - ti) / dt))
 
-    num_points = math.ceil((tf - ti) / dt)
+    t = time_grid(ti, tf, dt)
+    num_points = t.shape[0] - 1
+    U = stimulus.sample(u, t)
+    U_avg = (U[:, :-1] + U[:, 1:]) / 2
 
-    t = np.empty(num_points+1)
     x = np.empty((x0.shape[0], num_points+1))
-
-    t[0] = ti
     x[:, 0:1] = x0
 
     for i in range(num_points):
         x_curr = x[:, i:i+1]
-        t_curr = ti + i*dt
-        t_next = ti + (i+1)*dt
-        u_curr = square_wave(t_curr)
-        u_next = square_wave(t_next)
-        u_avg = (u_curr + u_next) / 2
-
-        rhs = np.matmul(A_rhs, x_curr) + dt*(b + B*u_avg)
-
-        if METHOD == SolverMethod.SOLVE:
-            x_next = np.linalg.solve(A, rhs)    # this is slower, but more numerically stable
-        elif METHOD == SolverMethod.FORWARD_BACKWARD_SUBSTITUTION:
-            x_next = fwd_bwd_sub(L, U, P, rhs)  # TODO: why is this numerically unstable when dt is small
-        elif METHOD == SolverMethod.INVERSE:
-            x_next = np.matmul(inv_A, rhs)      # this is fastest. unsure about stability
-
-        t[i+1] = t_next
+        with profiling.span('step_solve'):
+            rhs = A_rhs @ x_curr + dt*(b + B @ U_avg[:, i:i+1])
+            x_next = solve(rhs)
         x[:, i+1:i+2] = x_next
 
     return (t, x)
 
-def transient_analysis(circuit, ti, tf):
+def implicit_integrate_outputs(C, G, b, B, x0, ti, tf, dt, L_select, chunk_size=4096, u=square_wave, ordering=None,
+                               solvers=None):
+    # same integration as implicit_integrate, but only the current state is kept; each state is projected onto
+    # the output selection matrix L_select (num_outputs x n) on the fly, and (t, y) are yielded in chunks of up to
+    # chunk_size timesteps, with y of shape (num_outputs, len(t))
+
+    (A_rhs, solve) = solvers(dt) if solvers is not None else trapezoidal_solver(C, G, dt, ordering,
+                                                                                solves=math.ceil((tf - ti) / dt))
+
+    t_grid = time_grid(ti, tf, dt)
+    num_points = t_grid.shape[0] - 1
+    U = stimulus.sample(u, t_grid)
+    U_avg = (U[:, :-1] + U[:, 1:]) / 2
+
+    t = np.empty(min(chunk_size, num_points+1))
+    y = np.empty((L_select.shape[0], t.shape[0]))
+
+    x_curr = x0
+    t[0] = ti
+    y[:, 0:1] = L_select @ x_curr
+    j = 1   # position within the current chunk
+
+    for i in range(num_points):
+        if j == t.shape[0]:
+            yield (t, y)
+            t = np.empty(min(chunk_size, num_points-i))
+            y = np.empty((L_select.shape[0], t.shape[0]))
+            j = 0
+
+        with profiling.span('step_solve'):
+            rhs = A_rhs @ x_curr + dt*(b + B @ U_avg[:, i:i+1])
+            x_curr = solve(rhs)
+
+        t[j] = t_grid[i+1]
+        with profiling.span('output_projection'):
+            y[:, j:j+1] = L_select @ x_curr
+        j += 1
+
+    yield (t[:j], y[:, :j])
+
+def implicit_integrate_batch_outputs(C, G, b, B, X0, ti, tf, dt, L_select, stimuli, backend=None):
+    # simulates K stimuli at once: the state is an n x K matrix X (one column per stimulus), so that every timestep
+    # is one matrix-matrix product with A_rhs and one factored solve with K right hand sides
+    # stimuli is a list of K functions u(t) or an array of shape (K, num_points+1) sampled on the time grid,
+    # returns (t, Y) with Y of shape (num_outputs, K, num_points+1)
+
+    t = time_grid(ti, tf, dt)
+    num_points = t.shape[0] - 1
+    (A_rhs, solve) = trapezoidal_solver(C, G, dt, backend=backend, solves=num_points)
+    if callable(stimuli[0]):
+        U = np.vstack([stimulus.sample(u, t) for u in stimuli])
+    else:
+        U = np.asarray(stimuli, dtype=float)
+    assert(U.shape[1] == num_points+1)
+    U_avg = (U[:, :-1] + U[:, 1:]) / 2
+
+    Y = np.empty((L_select.shape[0], U.shape[0], num_points+1))
+    X = np.broadcast_to(X0, (X0.shape[0], U.shape[0]))
+    Y[:, :, 0] = L_select @ X
+    for i in range(num_points):
+        rhs = A_rhs @ X + dt*(b + B @ U_avg[np.newaxis, :, i])
+        with profiling.span('step_solve'):
+            X = solve(rhs)
+        with profiling.span('output_projection'):
+            Y[:, :, i+1] = L_select @ X
+
+    return (t, Y)
+
+class TrapezoidalSolverCache:
+    # trapezoidal_solver per distinct dt, the least recently used ones are dropped beyond max_entries
+    # the solver backend is chosen once, for the first dt (see linalg.select_backend: backend is None, 'trial', a
+    # backend name or a linalg.SolverChoice), with its fill reducing ordering computed once for all dt; solves is the
+    # expected number of steps per dt, which weighs solving against factoring. choice is the linalg.SolverChoice.
+    # update(C, G) follows edits of the circuit (see Circuit.edit), transient_analysis calls it for the solvers it is
+    # given: the factorizations are made again when next needed, in the ordering already chosen. A low rank
+    # correction (see linalg.UpdatableFactorization) costs every solve a product with an n x rank matrix, which the
+    # thousands of steps of a transient never amortize.
+    def __init__(self, C, G, max_entries=32, backend=None, solves=1000):
+        self.C = C
+        self.G = G
+        self.max_entries = max_entries
+        self.backend = backend
+        self.solves = solves
+        self.choice = None
+        self.solvers = OrderedDict()
+
+    def __call__(self, dt):
+        if dt in self.solvers:
+            self.solvers.move_to_end(dt)
+        else:
+            (A_rhs, A) = trapezoidal_matrices(self.C, self.G, dt)
+            if self.choice is None:
+                self.choice = linalg.select_backend(A, self.backend, self.solves, reuse=True)
+                logger.info('transient solver: %s', self.choice)
+            self.solvers[dt] = (A_rhs, linalg.Factorization(A, backend=self.choice, solves=self.solves))
+            if len(self.solvers) > self.max_entries:
+                self.solvers.popitem(last=False)
+        (A_rhs, factorization) = self.solvers[dt]
+        return (A_rhs, factorization.solve)
+
+    def update(self, C, G):
+        if C is self.C and G is self.G:
+            return
+        if C.shape != self.C.shape:
+            # states were added, the ordering starts over as well
+            self.choice = None
+        (self.C, self.G) = (C, G)
+        self.solvers.clear()
+
+def adaptive_integrate_outputs(C, G, b, B, x0, ti, tf, L_select, u=square_wave, breakpoints=None, rtol=1e-3, atol=1e-6,
+                               dt_max=None, dt_min=None, dt_init=None, solvers=None):
+    # Trapezoidal integration with local truncation error (LTE) control, returns (t, y) at the accepted
+    # (non-uniform) timesteps, with y = L_select*x
+    #
+    # LTE estimate: the quadratic through the last three accepted states predicts x(t+dt) with error
+    # x'''*(dt)*(dt+h1)*(dt+h1+h2)/6 [h1, h2 are the previous step sizes], while the trapezoidal rule's error is
+    # -x'''*dt^3/12, so from the corrector - predictor difference d:
+    # LTE = d * (dt^3/12) / (dt*(dt+h1)*(dt+h1+h2)/6 + dt^3/12)
+    #
+    # the error is measured on the outputs y only, relative to the largest |y| so far plus atol: branch currents and
+    # states far from any output do not limit the step
+    #
+    # step sizes are kept to dt_max/2^k (except to land on a breakpoint), so that few distinct factorizations are
+    # needed (see TrapezoidalSolverCache); after a breakpoint (slope change of u) the history restarts at dt_init,
+    # and the first step is taken as two backward Euler half steps (which factor the same C + dt/2*G), as SPICE
+    # does: the trapezoidal rule alone would keep the modes much faster than the step ringing, which defeats the
+    # error estimate until the steps become tiny
+    if dt_max is None:
+        dt_max = (tf - ti) / 50
+    if dt_min is None:
+        dt_min = dt_max * 2.0**-20
+    if dt_init is None:
+        dt_init = dt_max * 2.0**-4
+    quantize = lambda dt: dt_max * 2.0**-math.ceil(math.log2(dt_max / min(max(dt, dt_min), dt_max)) - 1e-9)
+
+    if solvers is None:
+        solvers = TrapezoidalSolverCache(C, G)
+    C_rhs = linalg.sparsify(C)
+    if linalg.issparse(C_rhs):
+        C_rhs = C_rhs.tocsr()
+    if breakpoints is None:
+        breakpoints = stimulus.stimulus_breakpoints(u, ti, tf)
+    breakpoints = np.append(np.sort(np.asarray(breakpoints, dtype=float)), tf)
+    breakpoints = breakpoints[(breakpoints > ti) & (breakpoints <= tf)]
+    bp = 0  # next breakpoint
+
+    t_list = [ti]
+    y_list = [L_select @ x0]
+    history = [(ti, x0)]    # accepted (t, x) since the last breakpoint, at most three
+    t_curr = ti
+    x_curr = x0
+    u_curr = stimulus.sample(u, [ti])
+    peak = np.abs(L_select @ x0)
+    dt = quantize(dt_init)
+    while t_curr < tf:
+        h = dt
+        hit_breakpoint = t_curr + h >= breakpoints[bp] - 1e-3*dt_min
+        if hit_breakpoint:
+            h = breakpoints[bp] - t_curr
+        (A_rhs, solve) = solvers(h)
+        u_next = stimulus.sample(u, [t_curr + h])
+        with profiling.span('step_solve'):
+            if len(history) == 1:
+                # (C + h/2*G)*x(t+h/2) = C*x(t) + h/2*(b + B*u(t+h/2)), twice
+                u_half = stimulus.sample(u, [t_curr + h/2])
+                x_half = solve(C_rhs @ x_curr + (h/2)*(b + B @ u_half))
+                x_next = solve(C_rhs @ x_half + (h/2)*(b + B @ u_next))
+            else:
+                x_next = solve(A_rhs @ x_curr + h*(b + B @ (u_curr + u_next)/2))
+
+        factor = 1.0
+        if len(history) == 3:
+            ((t2, x2), (t1, x1), (t0, x_0)) = history
+            tn = t_curr + h
+            # quadratic (Lagrange) extrapolation through the last three accepted points
+            x_pred = (x_0 * ((tn - t1)*(tn - t2)) / ((t0 - t1)*(t0 - t2))
+                      + x1 * ((tn - t0)*(tn - t2)) / ((t1 - t0)*(t1 - t2))
+                      + x2 * ((tn - t0)*(tn - t1)) / ((t2 - t0)*(t2 - t1)))
+            trapezoidal_error = h**3/12
+            predictor_error = (tn - t0)*(tn - t1)*(tn - t2)/6
+            lte = (L_select @ (x_next - x_pred)) * trapezoidal_error / (predictor_error + trapezoidal_error)
+            scale = atol + rtol*np.maximum(peak, np.abs(L_select @ x_next))
+            error = np.max(np.abs(lte) / scale, initial=0.0)
+            if error > 1 and h > dt_min:
+                dt = quantize(min(dt, h) * max(0.9*error**(-1/3), 0.2))
+                continue    # reject
+            factor = min(max(0.9*error**(-1/3), 0.2) if error > 0 else 2.0, 2.0)
+
+        t_curr = breakpoints[bp] if hit_breakpoint else t_curr + h
+        x_curr = x_next
+        u_curr = u_next
+        t_list.append(t_curr)
+        y_list.append(L_select @ x_curr)
+        peak = np.maximum(peak, np.abs(y_list[-1]))
+        history = (history + [(t_curr, x_curr)])[-3:]
+        if hit_breakpoint:
+            bp += 1
+            history = [(t_curr, x_curr)]
+            dt = quantize(min(dt, dt_init))
+        else:
+            dt = quantize(dt * factor)
+
+    return (np.array(t_list), np.hstack(y_list))
+
+def phi1_complement(z):
+    # 1 - phi1(z) with phi1(z) = (e^z - 1)/z, i.e. -(e^z - 1 - z)/z, by its Taylor series near 0 (no cancellation)
+    z = np.asarray(z, dtype=complex)
+    small = np.abs(z) < 0.1
+    z_large = np.where(small, 1.0, z)
+    series = np.zeros(z.shape, dtype=complex)
+    term = np.full(z.shape, 0.5, dtype=complex)    # z^k/(k+2)!
+    for k in range(12):
+        series += term
+        term = term * z / (k+3)
+    return np.where(small, -z*series, -(np.expm1(z_large) - z_large) / z_large)
+
+class ModalIntegrator:
+    # Exact discretization of a small dense model in its modal coordinates:
+    # G^-1*C = V*diag(mu)*V^-1, x = V*z, f(t) = V^-1*G^-1*(b + B*u(t))
+    # G*x + C*x' = b + B*u  =>  mu_i*z_i' = -z_i + f_i(t)
+    # mu_i = 0 modes are algebraic (z_i = f_i), every other mode is a first order system with pole lambda_i = -1/mu_i.
+    # With u linear between the time points (exact for piecewise linear inputs sampled at their corners), one step
+    # of length h is exactly [e = e^(lambda*h)]:
+    # z[k+1] = e*z[k] + (1 - e)*f[k] + (1 - phi1(lambda*h))*(f[k+1] - f[k])
+    # which is a first order recurrence per mode, evaluated for all time points at once with lfilter. There is no
+    # timestep error, and stiff (fast) modes are simply settled within a step.
+    # The models are passive, so no mode grows (Re(mu) < 0): growing modes within growth_tol (relative to the largest
+    # |mu|) of 0 are algebraic modes perturbed by roundoff, larger ones leave the model defective.
+    def __init__(self, G, C, b, B, L_select, max_condition=1e10, zero_tol=1e-12, growth_tol=1e-8):
+        G = np.asarray(G.toarray() if linalg.issparse(G) else G)
+        C = np.asarray(C.toarray() if linalg.issparse(C) else C)
+        self.defective = True
+        try:
+            (mu, V) = np.linalg.eig(np.linalg.solve(G, C))
+            condition = np.linalg.cond(V)
+            if np.isfinite(condition) and condition <= max_condition:
+                self.mu = mu
+                self.V = V
+                self.f_b = np.linalg.solve(V, np.linalg.solve(G, b))
+                self.f_B = np.linalg.solve(V, np.linalg.solve(G, B))
+                self.L_V = L_select @ V
+                scale = np.max(np.abs(mu), initial=0.0)
+                growing = np.real(mu) < -growth_tol*np.abs(mu)
+                self.dynamic = (np.abs(mu) > zero_tol*scale) & ~(growing & (np.abs(mu) <= growth_tol*scale))
+                self.defective = bool(np.any(growing & self.dynamic))
+        except np.linalg.LinAlgError:
+            pass
+
+    def integrate_modes(self, x0, t, U):
+        # modal states Z (one column per time point of the uniform grid t) starting from x0, U holds the inputs
+        # sampled at t (one row per column of B)
+        with profiling.span('modal_scan', modes=self.mu.shape[0], points=t.shape[0]):
+            return self._integrate_modes(x0, t, U)
+
+    def _integrate_modes(self, x0, t, U):
+        F = self.f_b + self.f_B @ U
+        Z = np.empty(F.shape, dtype=complex)
+        Z[~self.dynamic, :] = F[~self.dynamic, :]
+        Z[self.dynamic, 0] = np.linalg.solve(self.V, x0)[self.dynamic, 0]
+        if t.shape[0] > 1:
+            h = t[1] - t[0]
+            lam = -1/self.mu[self.dynamic]
+            e = np.exp(lam*h)
+            w = phi1_complement(lam*h)
+            F_dyn = F[self.dynamic, :]
+            forcing = (1 - e)[:, np.newaxis]*F_dyn[:, :-1] + w[:, np.newaxis]*np.diff(F_dyn, axis=1)
+            for (k, i) in enumerate(np.flatnonzero(self.dynamic)):
+                Z[i, 1:] = scipy.signal.lfilter([1.0], [1.0, -e[k]], forcing[k, :], zi=[e[k]*Z[i, 0]])[0]
+        return Z
+
+    def outputs(self, x0, t, U):
+        Z = self.integrate_modes(x0, t, U)
+        with profiling.span('output_projection'):
+            return np.real(self.L_V @ Z)
+
+    def states(self, x0, t, U):
+        Z = self.integrate_modes(x0, t, U)
+        with profiling.span('output_projection'):
+            return np.real(self.V @ Z)
+
+def modal_integrator(C, G, b, B, L_select):
+    # a ModalIntegrator for small dense models whose modes are well separated, None otherwise
+    if linalg.issparse(G) or linalg.issparse(C) or G.shape[0] > MODAL_MAX_ORDER:
+        return None
+    integrator = ModalIntegrator(G, C, b, B, L_select)
+    return integrator if not integrator.defective else None
+
+def circuit_modal_integrator(circuit, modal, C, G, b, B, L_select):
+    # the ModalIntegrator of transient_analysis and periodic_steady_state or None: modal=None integrates reduced
+    # models (see CircuitModel.is_reduced) modally and keeps full circuits, whose elements set the timestep, on the
+    # trapezoidal rule whether built from the netlist or loaded from a cache, modal=True integrates any small dense
+    # model modally, modal=False none
+    if modal is False or (modal is None and not circuit.is_reduced):
+        return None
+    integrator = modal_integrator(C, G, b, B, L_select)
+    if integrator is None and modal:
+        logger.warning('the model is not small and dense with distinct modes, using the trapezoidal rule')
+    return integrator
+
+def output_selection_matrix(L_list, n):
+    # stacks the output vectors into a sparse (num_outputs x n) matrix
+    if len(L_list) == 0:
+        return scipy.sparse.csr_matrix((0, n))
+    return scipy.sparse.csr_matrix(np.hstack(L_list).transpose())
+
+def circuit_inputs(circuit, u=None):
+    # returns (B, u): with u given, or when no input source has a waveform in the netlist, every input follows u
+    # (square_wave by default) through the collapsed input_B_vector; otherwise each input follows its own waveform
+    # (square_wave for those without one) through the columns of input_B_matrix; a stimulus.Stimuli u gives one
+    # waveform per input source (in the order of input_B_matrix's columns)
+    if isinstance(u, stimulus.Stimuli):
+        return (circuit.input_B_matrix, u)
+    stimuli = circuit.input_stimuli
+    if u is not None or all(s is None for s in stimuli):
+        return (circuit.input_B_vector, u if u is not None else square_wave)
+    return (circuit.input_B_matrix, stimulus.Stimuli([s if s is not None else square_wave for s in stimuli]))
+
+def stream_transient_analysis(circuit, ti, tf, dt=0.02e-9, chunk_size=4096, u=None):
+    # yields (t, y) chunks, y has one row per (valid) output node, in the order of transient_analysis's outputs
+    (G, C, b) = circuit.mna_GCb_matrices
+    (B, u) = circuit_inputs(circuit, u)
+    L_select = output_selection_matrix(circuit.output_L_vectors, b.shape[0])
+
+    x0 = np.zeros(b.shape)
+    yield from implicit_integrate_outputs(C, G, b, B, x0, ti, tf, dt, L_select, chunk_size, u)
+
+def transient_analysis(circuit, ti, tf, dt=0.02e-9, full_state=False, adaptive=False, rtol=1e-3, atol=1e-6, u=None,
+                       modal=None, solvers=None, backend=None):
+    # returns (t, outputs), or a TransientResult (t, outputs, x) with the full state history x when full_state is
+    # requested
+    # adaptive=True chooses the timesteps by local truncation error (dt is then the largest step), the returned t
+    # is non-uniform; the error is measured on the outputs only, so adaptive cannot be combined with full_state
+    # u overrides the input waveform(s) (see circuit_inputs): a Stimulus, a function of t or values sampled on the
+    # time grid
+    # modal=None integrates small dense reduced models exactly in modal coordinates (see ModalIntegrator and
+    # circuit_modal_integrator) unless adaptive is requested, modal=True does so for full circuits as well,
+    # modal=False always uses the trapezoidal rule
+    # solvers (a TrapezoidalSolverCache of the circuit's C and G) keeps the factorizations for later calls, otherwise
+    # backend selects the solver backend (see TrapezoidalSolverCache)
+    if full_state and adaptive:
+        raise ValueError('full_state is not available with adaptive timesteps, which only follow the outputs')
+    (G, C, b) = circuit.mna_GCb_matrices
+    (B, u) = circuit_inputs(circuit, u)
+    L_list = circuit.output_L_vectors
+    node_names = [node_name for (node_name, L) in zip(circuit.output_node_names, L_list)]
+    L_select = output_selection_matrix(L_list, b.shape[0])
+
+    x0 = np.zeros(b.shape)
+    if solvers is not None:
+        solvers.update(C, G)
+    with profiling.span('transient_analysis', n=b.shape[0]):
+        integrator = circuit_modal_integrator(circuit, modal, C, G, b, B, L_select) if not adaptive else None
+        if integrator is None and solvers is None:
+            solvers = TrapezoidalSolverCache(C, G, backend=backend, solves=math.ceil((tf - ti) / dt))
+        if integrator is not None:
+            t = time_grid(ti, tf, dt)
+            U = stimulus.sample(u, t)
+            if full_state:
+                x = integrator.states(x0, t, U)
+                y = L_select @ x
+            else:
+                y = integrator.outputs(x0, t, U)
+        elif full_state:
+            (t, x) = implicit_integrate(C, G, b, B, x0, ti, tf, dt, u, solvers)
+            y = L_select @ x
+        elif adaptive:
+            (t, y) = adaptive_integrate_outputs(C, G, b, B, x0, ti, tf, L_select,
+                                                u, stimulus.stimulus_breakpoints(u, ti, tf), rtol, atol, dt_max=dt,
+                                                solvers=solvers)
+        else:
+            chunks = list(implicit_integrate_outputs(C, G, b, B, x0, ti, tf, dt, L_select, u=u, solvers=solvers))
+            t = np.concatenate([t_chunk for (t_chunk, y_chunk) in chunks])
+            y = np.hstack([y_chunk for (t_chunk, y_chunk) in chunks])
+
+    outputs = []
+    for (i, node_name) in enumerate(node_names):
+        outputs.append((node_name, y[i, :]))
+
+    if full_state:
+        return TransientResult(t, outputs, x)
+    return (t, outputs)
+
+def transient_analysis_batch(circuit, ti, tf, stimuli, dt=0.02e-9, modal=None, backend=None):
+    # transient_analysis for K input waveforms at once (see implicit_integrate_batch_outputs),
+    # returns (t, outputs) where each output is an array of shape (K, len(t)); modal and backend as for
+    # transient_analysis
     (G, C, b) = circuit.mna_GCb_matrices
     B = circuit.input_B_vector
     L_list = circuit.output_L_vectors
+    node_names = [node_name for (node_name, L) in zip(circuit.output_node_names, L_list)]
+    L_select = output_selection_matrix(L_list, b.shape[0])
 
     x0 = np.zeros(b.shape)
-    tic = time.perf_counter()
-    (t, x) = implicit_integrate(C, G, b, B, x0, ti, tf, 0.02e-9)
-    toc = time.perf_counter()
-    print("simulating the circuit took %.6f seconds" % (toc - tic))
+    with profiling.span('transient_analysis_batch', n=b.shape[0], stimuli=len(stimuli)):
+        integrator = circuit_modal_integrator(circuit, modal, C, G, b, B, L_select)
+        if integrator is not None:
+            t = time_grid(ti, tf, dt)
+            Y = np.stack([integrator.outputs(x0, t, stimulus.sample(u, t)) for u in stimuli], axis=1)
+        else:
+            (t, Y) = implicit_integrate_batch_outputs(C, G, b, B, x0, ti, tf, dt, L_select, stimuli, backend)
+
+    outputs = []
+    for (i, node_name) in enumerate(node_names):
+        outputs.append((node_name, Y[i, :, :]))
+
+    return (t, outputs)
+
+def periodic_steady_state(circuit, period=None, dt=0.02e-9, u=None, ti=None, rtol=1e-9, max_periods=100,
+                          damped=True, full_state=False, modal=None, solvers=None, backend=None):
+    # The settled periodic response to periodic inputs, over one period from ti to ti + period, without simulating
+    # the start-up transient: returns (t, outputs), or a TransientResult as transient_analysis.
+    # Shooting method: the map over one period of trapezoidal steps (period/dt of them, dt rounded so that they fit
+    # exactly) is affine, x(ti + period) = M*x(ti) + p, so the periodic initial state solves (I - M)*x0 = p. That is
+    # solved matrix free by GMRES, where every product with M integrates one period without inputs using the
+    # factored step (see TrapezoidalSolverCache, solvers and backend as for transient_analysis); only the modes that
+    # do not settle within a period take iterations, so it costs a few periods (at most max_periods) rather than the
+    # hundreds the transient takes to settle.
+    # The trapezoidal rule hardly damps modes much faster than dt (e.g. the LC resonances of a clock tree), which
+    # keep ringing in the transient and would each take an iteration. damped=True replaces the first step of the
+    # period by two backward Euler half steps, the damping SPICE applies at breakpoints, which factor the same
+    # C + dt/2*G; damped=False solves the trapezoidal map as is, for the period the transient settles to.
+    # Small dense reduced models (modal as for transient_analysis) are solved exactly mode by mode instead:
+    # z0 = z_p/(1 - e^(lambda*period)).
+    # period and ti default to those of the inputs (see stimulus.Stimulus.periodicity), ti to where they start
+    # repeating.
+    (G, C, b) = circuit.mna_GCb_matrices
+    (B, u) = circuit_inputs(circuit, u)
+    L_list = circuit.output_L_vectors
+    node_names = [node_name for (node_name, L) in zip(circuit.output_node_names, L_list)]
+    L_select = output_selection_matrix(L_list, b.shape[0])
+
+    periodicity = stimulus.stimulus_periodicity(u)
+    if period is None:
+        if periodicity is None or periodicity[0] <= 0:
+            raise ValueError('the inputs are not periodic, the period has to be given')
+        period = periodicity[0]
+    if ti is None:
+        ti = periodicity[1] if periodicity is not None else 0.0
+    num_steps = max(1, round(period / dt))
+    dt = period / num_steps
+    t = ti + dt*np.arange(num_steps+1)
+    U = stimulus.sample(u, t)
+    x_zero = np.zeros(b.shape)
+
+    if solvers is not None:
+        solvers.update(C, G)
+    with profiling.span('periodic_steady_state', n=b.shape[0], steps=num_steps):
+        integrator = circuit_modal_integrator(circuit, modal, C, G, b, B, L_select)
+        if integrator is not None:
+            Z = integrator.integrate_modes(x_zero, t, U)
+            lam_period = -period/integrator.mu[integrator.dynamic]
+            z0 = np.zeros(Z.shape[0], dtype=complex)
+            z0[integrator.dynamic] = Z[integrator.dynamic, -1] / -np.expm1(lam_period)
+            x0 = np.real(integrator.V @ z0).reshape(b.shape)
+            x = integrator.states(x0, t, U)
+            y = L_select @ x
+            logger.info('periodic steady state: %d modes solved exactly', np.count_nonzero(integrator.dynamic))
+        else:
+            if solvers is None:
+                solvers = TrapezoidalSolverCache(C, G, backend=backend, solves=num_steps*max_periods)
+            (A_rhs, solve) = solvers(dt)
+            forcing = dt*(b + B @ ((U[:, :-1] + U[:, 1:]) / 2))
+            # backward Euler half steps: (C + dt/2*G)*x(t+dt/2) = C*x(t) + dt/2*(b + B*u(t+dt/2))
+            half_forcing = (dt/2)*(b + B @ np.hstack((stimulus.sample(u, t[:1] + dt/2), U[:, 1:2])))
+            periods = [0]
+
+            def advance(x_curr, forced, y=None, x=None):
+                # x_curr after one period, with or without the inputs; the outputs (and states) are kept in y (and x)
+                periods[0] += 1
+                for i in range(num_steps):
+                    with profiling.span('step_solve'):
+                        if damped and i == 0:
+                            for j in range(2):
+                                x_curr = solve(C @ x_curr + half_forcing[:, j:j+1] if forced else C @ x_curr)
+                        else:
+                            x_curr = solve(A_rhs @ x_curr + forcing[:, i:i+1] if forced else A_rhs @ x_curr)
+                    if y is not None:
+                        y[:, i+1:i+2] = L_select @ x_curr
+                    if x is not None:
+                        x[:, i+1:i+2] = x_curr
+                return x_curr
+
+            n = b.shape[0]
+            p = advance(x_zero, True).ravel()
+            I_minus_M = scipy.sparse.linalg.LinearOperator(
+                (n, n), dtype=float, matvec=lambda v: v - advance(v.reshape(-1, 1), False).ravel())
+            (x0, info) = scipy.sparse.linalg.gmres(I_minus_M, p, x0=p, atol=0.0, restart=max_periods, maxiter=1,
+                                                   **{GMRES_RTOL: rtol})
+            if info != 0:
+                logger.warning('periodic steady state not within a relative residual of %g after %d periods', rtol,
+                               periods[0])
+            x0 = x0.reshape(b.shape)
+            y = np.empty((L_select.shape[0], num_steps+1))
+            y[:, 0:1] = L_select @ x0
+            x = np.empty((n, num_steps+1)) if full_state else None
+            if full_state:
+                x[:, 0:1] = x0
+            x_end = advance(x0, True, y, x)
+            logger.info('periodic steady state: %d periods, mismatch %g', periods[0],
+                        np.linalg.norm(x_end - x0) / max(np.linalg.norm(x0), np.finfo(float).tiny))
 
     outputs = []
-    for (node_name, L) in zip(circuit.output_node_names, L_list):
-        output = np.dot(L.transpose(), x).flatten()
-        outputs.append((node_name, output))
+    for (i, node_name) in enumerate(node_names):
+        outputs.append((node_name, y[i, :]))
 
+    if full_state:
+        return TransientResult(t, outputs, x)
     return (t, outputs)